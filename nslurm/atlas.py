@@ -0,0 +1,201 @@
+import os
+import json
+import hashlib
+import numpy as np
+import nibabel as nib
+
+#Resampled atlas cache: before extraction, the prep job (see stages.py) resamples roi_file and mask_img once to each
+#distinct grid (shape and affine) of the input files and saves them as .npy in logs/atlas. Jobs memory map them
+#read-only instead of each resampling the atlas again, which for large probabilistic atlases (e.g. DiFuMo 1024) is a
+#large part of the run.
+#A cached array is named after a hash of the source file (path, size, modification time) and the grid, so a changed
+#atlas is resampled again.
+ATLAS_DIR = 'logs/atlas'
+
+def get_grid(shape, affine):
+    """Get a hashable key for a voxel grid.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the image, only the first 3 dimensions are used.
+    affine : numpy.ndarray
+        Affine of the image.
+    Returns
+    -------
+    tuple
+        Shape of a volume and affine (rounded to 1e-6) as a list.
+    """
+    return tuple([int(i) for i in shape[:3]]), tuple(np.round(affine, 6).ravel().tolist())
+
+def get_cache_path(out_path, source, grid):
+    """Get the path of the cached array of an atlas resampled to a grid.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    source : str
+        Path to the atlas (roi_file or mask_img).
+    grid : tuple
+        Output of get_grid.
+    Returns
+    -------
+    str
+        Path to the .npy file.
+    """
+    st = os.stat(source)
+    key = json.dumps([os.path.abspath(source), st.st_size, st.st_mtime_ns, grid])
+    return os.path.join(out_path, ATLAS_DIR, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+def is_atlas(source):
+    """Check if a roi_file or mask_img is a NIfTI image that can be cached (not coordinates or a nilearn query)."""
+    return isinstance(source, str) and source.endswith(('.nii', '.nii.gz')) and os.path.isfile(source)
+
+def resample_atlas(source, grid, interpolation=None):
+    """Resample an atlas to a grid, with nilearn as the masker would.
+
+    Parameters
+    ----------
+    source : str
+        Path to the atlas.
+    grid : tuple
+        Output of get_grid.
+    interpolation : str, None
+        nilearn interpolation. If None, 'continuous' for a 4D (probabilistic) atlas and 'nearest' otherwise.
+    Returns
+    -------
+    numpy.ndarray
+        Resampled data, float32 for a probabilistic atlas, int32 otherwise.
+    """
+    from nilearn import image
+    img = nib.load(source)
+    probabilistic = len(img.shape) == 4
+    if interpolation is None:
+        interpolation = 'continuous' if probabilistic else 'nearest'
+    shape, affine = grid
+    resampled = image.resample_img(img, target_affine=np.array(affine).reshape(4, 4), target_shape=shape,
+                                   interpolation=interpolation)
+    return np.asarray(resampled.dataobj, dtype=np.float32 if probabilistic else np.int32)
+
+def save_array(path, data):
+    """Atomically save an array as .npy, so jobs never map a partly written file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp, path)
+
+def get_grids(files, headers=None):
+    """Get the distinct grids of input files, from their NIfTI headers.
+
+    Parameters
+    ----------
+    files : list
+        List of input_files.
+    headers : dict, None
+        Output of cost.read_headers for the files, read from the files if None.
+    Returns
+    -------
+    list
+        Distinct outputs of get_grid, in order of first appearance.
+    """
+    grids = []
+    for f in files:
+        if headers is not None:
+            grid = headers[f][1]
+        else:
+            img = nib.load(f)
+            grid = get_grid(img.shape, img.affine)
+        if grid not in grids:
+            grids.append(grid)
+    return grids
+
+def get_missing(files, params, out_path, headers=None):
+    """List the resampled atlases that are not cached yet, from the headers of the input files.
+
+    Parameters
+    ----------
+    files : list
+        List of input_files to be processed.
+    params : dict
+        Parameters from the config file.
+    out_path : str
+        Path to output directory.
+    headers : dict, None
+        Output of cost.read_headers for the files, read from the files if None.
+    Returns
+    -------
+    list
+        List of (source, grid, interpolation) to pass to compute_missing.
+    """
+    sources = [params.get(k) for k in ['roi_file', 'mask_img'] if is_atlas(params.get(k))]
+    if len(sources) == 0 or len(files) == 0:
+        return []
+    missing = []
+    for grid in get_grids(files, headers):
+        for source in sources:
+            if os.path.exists(get_cache_path(out_path, source, grid)):
+                continue
+            interpolation = 'nearest' if source == params.get('mask_img') else None
+            missing.append((source, grid, interpolation))
+    return missing
+
+def compute_missing(missing, out_path):
+    """Resample and cache atlases.
+
+    Parameters
+    ----------
+    missing : list
+        Output of get_missing.
+    out_path : str
+        Path to output directory.
+    Returns
+    -------
+    int
+        Number of arrays computed.
+    """
+    os.makedirs(os.path.join(out_path, ATLAS_DIR), exist_ok=True)
+    for source, grid, interpolation in missing:
+        save_array(get_cache_path(out_path, source, grid), resample_atlas(source, grid, interpolation))
+    return len(missing)
+
+def prepare_atlas_cache(files, params, out_path):
+    """Resample roi_file and mask_img to every grid of the input files that is not cached yet.
+
+    Parameters
+    ----------
+    files : list
+        List of input_files to be processed.
+    params : dict
+        Parameters from the config file.
+    out_path : str
+        Path to output directory.
+    Returns
+    -------
+    int
+        Number of arrays computed.
+    """
+    return compute_missing(get_missing(files, params, out_path), out_path)
+
+def load_resampled(out_path, source, img):
+    """Memory map the cached atlas resampled to the grid of an image.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    source : str
+        Path to the atlas.
+    img : nibabel.Nifti1Image
+        Input image giving the grid.
+    Returns
+    -------
+    nibabel.Nifti1Image, None
+        Resampled atlas backed by a read-only memory map, None if not cached.
+    """
+    if not is_atlas(source):
+        return None
+    path = get_cache_path(out_path, source, get_grid(img.shape, img.affine))
+    if not os.path.exists(path):
+        return None
+    return nib.Nifti1Image(np.load(path, mmap_mode='r'), img.affine)
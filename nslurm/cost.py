@@ -0,0 +1,385 @@
+import os
+import re
+import glob
+import json
+import math
+import heapq
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from . import atlas
+from . import labels
+
+#Runtime and memory model for nixtract-nifti, per input file.
+#Label atlases: time and memory scale with voxels x timepoints of the input (nilearn loads it as float64).
+#Probabilistic atlases (4D, e.g. DiFuMo): the masker also does a (voxels x regions) x (voxels x timepoints)
+#product and holds the resampled maps in memory.
+#Fitted to ~5s and ~500M peak per subject on ADHD200/development fMRI with MIST64 and MIST444.
+SEC_OVERHEAD = 2.
+SEC_PER_VALUE = 6e-8
+SEC_PER_VALUE_REGION = 1e-9
+MEM_OVERHEAD = 300 * 2**20
+BYTES_PER_VALUE = 8
+
+#Native backend with a label atlas (see labels.py): the input is streamed a block of volumes at a time, so memory
+#does not grow with the number of timepoints. It is the block (and its scaled copy), the index of the atlas (a few
+#arrays per voxel of the grid) and the region signals.
+STREAM_BYTES = 2 * labels.READ_BYTES
+INDEX_BYTES_PER_VOXEL = 24
+
+#Inputs read ahead by a worker with --prefetch (see extract.run_pipeline) are held decompressed, up to float64 when
+#scaled, each as large as the file being extracted. The native backend then reads the current one from memory too.
+
+#Multiplier applied to the predicted peak memory when setting --mem.
+MEM_SAFETY = 1.2
+
+#Bounds on the predicted length of a job when choosing the number of jobs: long enough that scheduling and
+#startup overhead stay small, short enough that jobs still fit in backfill windows and wait less in the queue.
+TASK_MIN_SECONDS = 600
+TASK_MAX_SECONDS = 3*3600
+
+#Seconds per file assumed without predicted costs (--static_resources), as in nixtract-slurm's get_slurm_params.
+STATIC_SECONDS = 5
+
+def get_makespan(seconds, slots=None):
+    """Predict when the last of a list of jobs ends, started in order as soon as one of the slots is free
+    (SLURM starts array tasks in order). Time spent waiting in the queue is not included.
+
+    Parameters
+    ----------
+    seconds : list
+        Predicted seconds of each job.
+    slots : int, None
+        Number of jobs running at the same time (array throttle). If None, all jobs run at once.
+    Returns
+    -------
+    float
+        Seconds until the last job ends.
+    """
+    if len(seconds) == 0:
+        return 0.
+    if slots is None or slots >= len(seconds):
+        return float(max(seconds))
+    ends = [0.] * slots
+    for sec in seconds:
+        heapq.heappush(ends, heapq.heappop(ends) + sec)
+    return float(max(ends))
+
+def get_shape(fname):
+    """Get the shape of a NIfTI image from its header, without loading the data.
+
+    Parameters
+    ----------
+    fname : str
+        Path to NIfTI image.
+    Returns
+    -------
+    tuple
+        Number of voxels per volume and number of timepoints (1 for a 3D image).
+    """
+    return get_size(nib.load(fname).header.get_data_shape())
+
+def get_size(shape):
+    """Get the number of voxels per volume and of timepoints (1 for a 3D image) of an image shape."""
+    n_voxels = int(np.prod(shape[:3]))
+    n_timepoints = int(shape[3]) if len(shape) > 3 else 1
+    return n_voxels, n_timepoints
+
+def read_headers(files):
+    """Read the shape and grid of input files from their NIfTI headers, once for all the steps of a submission that
+    need them (costs, batch weights and atlas cache).
+
+    Parameters
+    ----------
+    files : list
+        List of input_files.
+    Returns
+    -------
+    dict
+        Mapping from input file to its shape and its grid (see atlas.get_grid), the same tuple for files on the same
+        grid.
+    """
+    headers = {}
+    grids = {}
+    for f in files:
+        img = nib.load(f)
+        shape = tuple([int(d) for d in img.header.get_data_shape()])
+        grid = atlas.get_grid(shape, img.affine)
+        headers[f] = shape, grids.setdefault(grid, grid)
+    return headers
+
+def get_atlas_info(roi_file):
+    """Get the number of regions in the atlas and whether it is probabilistic.
+    For a 4D (probabilistic) atlas only the header is read, for a 3D label atlas the labels are counted.
+
+    Parameters
+    ----------
+    roi_file : str
+        roi_file from the nixtract config, a NIfTI atlas or a coordinates .tsv/.csv file.
+    Returns
+    -------
+    int
+        Number of regions, 0 if unknown (e.g. nilearn query string).
+    bool
+        True if the atlas is probabilistic (4D).
+    int
+        Number of voxels per volume of the atlas, 0 if not a NIfTI atlas.
+    """
+    if not isinstance(roi_file, str) or not os.path.exists(roi_file):
+        return 0, False, 0
+    if roi_file.endswith('.tsv'):
+        return len(pd.read_table(roi_file)), False, 0
+    if roi_file.endswith('.csv'):
+        return len(pd.read_csv(roi_file)), False, 0
+
+    img = nib.load(roi_file)
+    shape = img.header.get_data_shape()
+    n_voxels = int(np.prod(shape[:3]))
+    if len(shape) == 4:
+        return int(shape[3]), True, n_voxels
+    labels = np.unique(np.asarray(img.dataobj))
+    return int(np.count_nonzero(labels)), False, n_voxels
+
+def estimate_file_cost(n_voxels, n_timepoints, atlas_info, model=None, backend='nilearn', prefetch=0):
+    """Predict runtime and peak memory of nixtract-nifti for one input file.
+
+    Parameters
+    ----------
+    n_voxels : int
+        Number of voxels per volume of the input.
+    n_timepoints : int
+        Number of timepoints of the input.
+    atlas_info : tuple
+        Output of get_atlas_info.
+    model : dict, None
+        Calibration fitted on previous runs (see fit_model). If None, the static model is used.
+    backend : str
+        Extraction backend of the jobs, 'native' streams label atlases.
+    prefetch : int
+        Number of inputs read ahead by the worker.
+    Returns
+    -------
+    float
+        Predicted runtime in seconds.
+    int
+        Predicted peak memory in bytes.
+    """
+    n_rois, probabilistic, atlas_voxels = atlas_info
+    n_values = n_voxels * n_timepoints
+    sec = SEC_OVERHEAD + SEC_PER_VALUE * n_values
+    mem = MEM_OVERHEAD + BYTES_PER_VALUE * n_values
+    if backend == 'native' and not probabilistic and atlas_voxels > 0:
+        mem = (MEM_OVERHEAD + STREAM_BYTES + INDEX_BYTES_PER_VOXEL * max(n_voxels, atlas_voxels) +
+               3 * BYTES_PER_VALUE * n_timepoints * n_rois)
+        if prefetch > 0:
+            mem += BYTES_PER_VALUE * n_values
+    mem += prefetch * BYTES_PER_VALUE * n_values
+    if probabilistic:
+        #maps are resampled to the input grid
+        sec += SEC_PER_VALUE_REGION * n_values * n_rois
+        mem += 2 * BYTES_PER_VALUE * max(n_voxels, atlas_voxels) * n_rois
+    if model is not None:
+        sec = model['sec'][0] + model['sec'][1] * sec
+        mem = model['mem'][0] + model['mem'][1] * mem
+    return sec, int(mem)
+
+def estimate_costs(files, roi_file, model=None, backend='nilearn', prefetch=0, headers=None):
+    """Predict runtime and peak memory for each input file, reading only the NIfTI headers.
+
+    Parameters
+    ----------
+    files : list
+        List of input_files.
+    roi_file : str
+        roi_file from the nixtract config.
+    model : dict, None
+        Calibration fitted on previous runs (see fit_model).
+    backend : str
+        Extraction backend of the jobs.
+    prefetch : int
+        Number of inputs read ahead by the worker.
+    headers : dict, None
+        Output of read_headers for the files, read from the files if None.
+    Returns
+    -------
+    list
+        List of (seconds, bytes) tuples, one per input file.
+    """
+    atlas_info = get_atlas_info(roi_file)
+    costs = []
+    for f in files:
+        n_voxels, n_timepoints = get_size(headers[f][0]) if headers is not None else get_shape(f)
+        costs.append(estimate_file_cost(n_voxels, n_timepoints, atlas_info, model, backend, prefetch))
+    return costs
+
+def format_mem(n_bytes):
+    """Format a number of bytes as a SLURM memory string, rounded up to the megabyte.
+
+    Parameters
+    ----------
+    n_bytes : int, float
+        Number of bytes.
+    Returns
+    -------
+    str
+        Memory string e.g. '1500M'.
+    """
+    return '{}M'.format(int(math.ceil(n_bytes / 2**20)))
+
+def parse_mem(mem):
+    """Parse a SLURM memory string into a number of bytes.
+
+    Parameters
+    ----------
+    mem : str
+        Memory string e.g. '1G', '500MB' or '2048' (megabytes, the SLURM default unit).
+    Returns
+    -------
+    int
+        Number of bytes.
+    Raises
+    ------
+    ValueError
+       mem is not a valid SLURM memory string.
+    """
+    m = re.match(r'^(\d+)([KMGT]?)B?$', mem.strip().upper())
+    if m is None:
+        raise ValueError("Memory must be formatted for SLURM e.g. '1G', '500MB'.")
+    return int(m.group(1)) * 2**(10*'KMGT'.index(m.group(2) or 'M') + 10)
+
+def parse_time(runtime):
+    """Convert a SLURM time to seconds.
+
+    Parameters
+    ----------
+    runtime : str
+        Time formatted 'hours:minutes:seconds', 'minutes:seconds' or 'days-hours:minutes:seconds'.
+    Returns
+    -------
+    int
+        Number of seconds.
+    """
+    days = 0
+    if '-' in runtime:
+        days, runtime = runtime.split('-')
+    parts = [int(x) for x in runtime.split(':')]
+    if len(parts) == 3:
+        sec = parts[0]*3600 + parts[1]*60 + parts[2]
+    else:
+        sec = parts[0]*60 + parts[1]
+    return int(days)*86400 + sec
+
+def format_time(sec):
+    """Format a number of seconds as a SLURM time, e.g. '2:30:00', or '1-06:00:00' above a day."""
+    days, sec = divmod(int(math.ceil(sec)), 86400)
+    h, m, s = sec//3600, sec%3600//60, sec%60
+    if days == 0:
+        return '{}:{:02d}:{:02d}'.format(h, m, s)
+    return '{}-{:02d}:{:02d}:{:02d}'.format(days, h, m, s)
+
+def get_n_workers(mem, peak, cpus):
+    """Get how many files can be processed at the same time within a memory limit.
+
+    Parameters
+    ----------
+    mem : str
+        Memory per job, formatted for SLURM.
+    peak : int
+        Predicted peak memory of the largest file, in bytes.
+    cpus : int
+        Number of CPUs per job.
+    Returns
+    -------
+    int
+        Number of workers, between 1 and cpus.
+    """
+    return max(1, min(cpus, int(parse_mem(mem) // (MEM_SAFETY * peak))))
+
+def record_history(path, rows):
+    """Append per-file measurements to a history file (one JSON object per line).
+    Each job writes its own history file, so no locking is needed.
+
+    Parameters
+    ----------
+    path : str
+        Path to the history file.
+    rows : list
+        List of dicts with keys 'file', 'roi_file', 'n_voxels', 'n_timepoints', 'n_rois', 'probabilistic',
+        'atlas_voxels', 'seconds', 'peak_bytes' (None if unknown), 'backend' and 'prefetch'.
+    """
+    with open(path, 'a') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+def load_history(history_dir, roi_file=None, backend=None):
+    """Read all history files written by previous runs.
+
+    Parameters
+    ----------
+    history_dir : str
+        Directory containing the .jsonl history files (logs/history).
+    roi_file : str, None
+        If given, only keep measurements made with this atlas.
+    backend : str, None
+        If given, only keep measurements made with this extraction backend (nilearn for older runs).
+    Returns
+    -------
+    list
+        List of dicts, one per processed file.
+    """
+    rows = []
+    for path in glob.glob(os.path.join(history_dir, '*.jsonl')):
+        with open(path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    #job killed mid-write
+                    continue
+                if roi_file is not None and row.get('roi_file') != roi_file:
+                    continue
+                if backend is None or row.get('backend', 'nilearn') == backend:
+                    rows.append(row)
+    return rows
+
+def _fit_linear(pred, obs):
+    """Least squares fit of obs = a + b*pred, falling back to a pure scale factor when the fit is degenerate or its
+    intercept is negative (small files would then be predicted to take no time or memory)."""
+    pred = np.asarray(pred, dtype=float)
+    obs = np.asarray(obs, dtype=float)
+    if len(np.unique(pred)) > 1:
+        b, a = np.polyfit(pred, obs, 1)
+        if b > 0 and a >= 0:
+            return a, b
+    return 0., obs.sum() / pred.sum()
+
+def fit_model(history):
+    """Fit the cost model to measurements from previous runs.
+    The static prediction of each file is rescaled linearly to match the measured runtimes. For memory the fitted
+    line is shifted up so that no measured peak is above it.
+
+    Parameters
+    ----------
+    history : list
+        Measurements from load_history.
+    Returns
+    -------
+    dict, None
+        Model to pass to estimate_costs, None if history is empty.
+    """
+    if len(history) == 0:
+        return None
+    pred = [estimate_file_cost(h['n_voxels'], h['n_timepoints'], (h['n_rois'], h['probabilistic'], h['atlas_voxels']),
+                               backend=h.get('backend', 'nilearn'), prefetch=h.get('prefetch', 0)) for h in history]
+    sec = _fit_linear([p[0] for p in pred], [h['seconds'] for h in history])
+
+    mem_rows = [(p[1], h['peak_bytes']) for p, h in zip(pred, history) if h.get('peak_bytes')]
+    if len(mem_rows) == 0:
+        mem = (0., 1.)
+    else:
+        pred_mem = np.array([m[0] for m in mem_rows], dtype=float)
+        obs_mem = np.array([m[1] for m in mem_rows], dtype=float)
+        a, b = _fit_linear(pred_mem, obs_mem)
+        a += max(0., (obs_mem - (a + b * pred_mem)).max())
+        mem = (a, b)
+    return {'sec': sec, 'mem': mem, 'n': len(history)}
@@ -0,0 +1,560 @@
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import traceback
+import itertools
+import collections
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from . import index
+from . import atlas
+from . import labels
+from . import telemetry
+
+#In-process extraction: nixtract is imported once per worker and the masker (atlas loaded, and resampled to the
+#grid of the inputs) is built once, then reused for every file of the batch. This replaces one nixtract-nifti run
+#per batch, which pays interpreter startup, imports and atlas loading, and reloads the atlas for every file.
+#nixtract is only imported when extracting, so nslurm can plan jobs without it.
+#With the native backend, region means of label atlases are computed by labels.get_signals instead of the masker,
+#from an index of the atlas built once per grid, like the masker, streaming the image a block of volumes at a time.
+#The extractor still reads the regressors and writes the output.
+
+#Extraction backends: the nilearn masker of nixtract, or native (see labels.py) for the atlases it supports.
+BACKENDS = ['nilearn', 'native']
+
+#Defaults of the nixtract-nifti command line, completed by the config file as nixtract does.
+NIXTRACT_DEFAULTS = {'input_files': None, 'roi_file': None, 'mask_img': None, 'labels': None, 'as_voxels': False,
+                     'radius': None, 'allow_overlap': False, 'smoothing_fwhm': None, 'regressor_files': None,
+                     'regressors': None, 'load_confounds_kwargs': None, 'standardize': False, 't_r': None,
+                     'high_pass': None, 'low_pass': None, 'detrend': False, 'discard_scans': None, 'n_jobs': 1,
+                     'n_decimals': None, 'verbose': False}
+
+#Masker arguments passed by nixtract's NiftiExtractor.
+MASKER_KEYS = ['mask_img', 'radius', 'allow_overlap', 'standardize', 't_r', 'high_pass', 'low_pass', 'detrend',
+               'smoothing_fwhm']
+
+#Regressor files of the next REGRESSOR_PREFETCH files of a batch are read on REGRESSOR_THREADS threads while files
+#are extracted, so parsing the confounds of a file (the fMRIPrep TSV with pandas, and the load_confounds strategy)
+#no longer adds to its time.
+REGRESSOR_PREFETCH = 8
+REGRESSOR_THREADS = 2
+
+#Pipeline of a job extracting one file at a time (see run_pipeline): with --prefetch N, a thread reads and decompresses
+#the next N inputs into memory while the current one is extracted, and a writer thread writes the outputs, so reading
+#from the shared filesystem, extracting and writing overlap. Each input read ahead is held in memory decompressed, so
+#the job needs N more inputs' worth of memory (see cost.estimate_file_cost). Up to WRITE_QUEUE outputs wait for the
+#writer. With several workers, files already overlap between the worker processes.
+WRITE_QUEUE = 2
+
+#State of the current process, set by init_extraction.
+_STATE = {}
+
+def get_nixtract_params(config_path, out_path, input_files=None):
+    """Read a batch config the way nixtract-nifti does, resolving nilearn atlas queries and label files.
+
+    Parameters
+    ----------
+    config_path : str
+        Path to the batch config file.
+    out_path : str
+        Path to output dir.
+    input_files : list, None
+        If given, replaces the input_files of the config.
+    Returns
+    -------
+    dict
+        Validated nixtract parameters.
+    """
+    from nixtract.cli.nifti import _check_nifti_params
+    params = dict(NIXTRACT_DEFAULTS, config=None, out_dir=out_path)
+    with open(config_path) as f:
+        params.update(json.load(f))
+    if input_files is not None:
+        params['input_files'] = input_files
+    return _check_nifti_params(params)
+
+def get_masker(img):
+    """Get the masker for the grid of an image, building it on first use.
+    Label and probabilistic atlases, and mask_img, are resampled to the grid here, so nilearn does not resample them
+    again for each file. They are mapped from the cache made before submission (see atlas.prepare_atlas_cache) when
+    available.
+
+    Parameters
+    ----------
+    img : nibabel.Nifti1Image
+        Input image.
+    Returns
+    -------
+    nilearn masker
+        Masker, fitted by NiftiExtractor.extract.
+    int
+        Number of regions.
+    """
+    import numpy as np
+    import nibabel as nib
+    from sklearn.base import clone
+    from nilearn import image
+    from nixtract.extractors.nifti_extractor import _set_volume_masker
+
+    key = atlas.get_grid(img.shape, img.affine)
+    if key in _STATE['maskers']:
+        return _STATE['maskers'][key]
+    params = _STATE['params']
+    if _STATE['base'] is None:
+        kwargs = dict([(k, params[k]) for k in MASKER_KEYS])
+        _STATE['base'] = _set_volume_masker(params['roi_file'], params['as_voxels'], **kwargs)
+    base, n_rois = _STATE['base']
+
+    masker = clone(base)
+    #only the grid is used, without loading the data of a 4D image
+    ref = nib.Nifti1Image(np.zeros(img.shape[:3], dtype=np.int8), img.affine)
+    for attr, interpolation in [('labels_img', 'nearest'), ('maps_img', 'continuous')]:
+        if getattr(masker, attr, None) is None:
+            continue
+        resample = [(attr, params['roi_file'], interpolation)]
+        if masker.mask_img is not None:
+            resample.append(('mask_img', params['mask_img'], 'nearest'))
+        for name, source, interp in resample:
+            resampled = atlas.load_resampled(_STATE['out_path'], source, img)
+            if resampled is None:
+                resampled = image.resample_to_img(getattr(masker, name), ref, interpolation=interp)
+            setattr(masker, name, resampled)
+    _STATE['maskers'][key] = masker, n_rois
+    return _STATE['maskers'][key]
+
+def make_extractor(fname, img=None):
+    """Make a nixtract NiftiExtractor for a file, sharing the masker of its grid.
+    NiftiExtractor.__init__ is skipped since it loads the atlas again.
+
+    Parameters
+    ----------
+    fname : str
+        Input file.
+    img : nibabel.Nifti1Image, None
+        The input already read into memory, loaded from fname otherwise.
+    Returns
+    -------
+    nixtract.extractors.NiftiExtractor
+        Extractor ready for set_regressors, discard_scans and extract.
+    """
+    import nibabel as nib
+    from nixtract.extractors import NiftiExtractor
+
+    params = _STATE['params']
+    extractor = NiftiExtractor.__new__(NiftiExtractor)
+    extractor.fname = fname
+    extractor.img = img if img is not None else nib.load(fname)
+    extractor.roi_file = params['roi_file']
+    extractor.labels = params['labels']
+    extractor.as_voxels = params['as_voxels']
+    extractor.verbose = params['verbose']
+    extractor.masker, extractor.n_rois = get_masker(extractor.img)
+    extractor.masker_type = extractor.masker.__class__.__name__
+    extractor.regressor_names = None
+    extractor.regressor_array = None
+    return extractor
+
+def get_index(img):
+    """Get the index of the label atlas for the grid of an image (see labels.make_index), building it on first use.
+    The masker of the grid must have been built by get_masker."""
+    import numpy as np
+
+    key = atlas.get_grid(img.shape, img.affine)
+    if key not in _STATE['indices']:
+        masker = _STATE['maskers'][key][0]
+        mask = None if masker.mask_img is None else np.asanyarray(masker.mask_img.dataobj)
+        _STATE['indices'][key] = labels.make_index(np.asanyarray(masker.labels_img.dataobj), mask,
+                                                   masker.background_label)
+    return _STATE['indices'][key]
+
+def extract_native(extractor, discard_scans=0):
+    """Extract the timeseries of a label atlas with labels.get_signals, setting extractor.timeseries as
+    NiftiExtractor.extract does. The image is streamed from its file unless already in memory, discarded scans are
+    skipped rather than loaded."""
+    import nibabel as nib
+    import pandas as pd
+
+    extractor.show_extract_msg(extractor.fname)
+    idx = get_index(extractor.img)
+    data = extractor.img.dataobj
+    if not extractor.img.in_memory:
+        #kept open, so each block continues where the last one stopped in a .nii.gz
+        data = nib.load(extractor.fname, keep_file_open=True).dataobj
+    signals = labels.get_signals(data, idx, discard_scans)
+    confounds = extractor.regressor_array
+    if confounds is not None:
+        confounds = confounds[discard_scans:]
+    signals = labels.clean_signals(signals, extractor.masker, confounds)
+    extractor.timeseries = pd.DataFrame(signals)
+    if extractor.labels is None:
+        extractor.timeseries.columns = ['region{}'.format(int(i)) for i in idx['labels']]
+    else:
+        extractor.timeseries.columns = extractor.labels
+    return extractor
+
+def use_native(masker):
+    """Check if a file with this masker is extracted natively, warning once per process when it cannot be."""
+    if _STATE['backend'] != 'native':
+        return False
+    if labels.is_supported(masker):
+        return True
+    if not _STATE['warned']:
+        print('The native backend only supports label atlases without smoothing, using the nilearn masker.')
+        _STATE['warned'] = True
+    return False
+
+def init_extraction(params, out_path, work_dir=None, backend='nilearn'):
+    """Set the parameters of the current process, before extract_file. Also the initializer of worker processes.
+    Outputs are written to work_dir (e.g. node-local scratch) if given, out_path otherwise."""
+    _STATE.clear()
+    _STATE.update({'params': params, 'out_path': out_path, 'work_dir': work_dir or out_path, 'base': None,
+                   'maskers': {}, 'backend': backend, 'indices': {}, 'warned': False})
+
+def load_regressors(regressor_file, params):
+    """Read the regressors of a file as NiftiExtractor.set_regressors does, on a prefetch thread.
+
+    Parameters
+    ----------
+    regressor_file : str
+        Regressor file.
+    params : dict
+        Validated nixtract parameters.
+    Returns
+    -------
+    tuple, str
+        Regressor names, regressor array and whether they came from load_confounds, or the traceback if reading
+        failed, so the error is reported with the file.
+    """
+    from nixtract.extractors import NiftiExtractor
+    extractor = NiftiExtractor.__new__(NiftiExtractor)
+    #nixtract pops from the kwargs
+    kwargs = params['load_confounds_kwargs']
+    try:
+        extractor.set_regressors(regressor_file, params['regressors'], dict(kwargs) if kwargs is not None else None)
+    except Exception:
+        return traceback.format_exc()
+    return extractor.regressor_names, extractor.regressor_array, extractor._load_confounds
+
+def prefetch_regressors(tasks, params, depth=REGRESSOR_PREFETCH):
+    """Read the regressor files of the next depth tasks on REGRESSOR_THREADS threads.
+
+    Parameters
+    ----------
+    tasks : iterable
+        (input_file, regressor_file) pairs.
+    params : dict
+        Validated nixtract parameters.
+    depth : int
+        Number of tasks read ahead.
+    Returns
+    -------
+    generator
+        (input_file, regressor_file, regressors) tuples in the order of tasks, regressors is the output of
+        load_regressors (None without regressor file).
+    """
+    with ThreadPoolExecutor(REGRESSOR_THREADS) as executor:
+        ahead = collections.deque()
+        for fname, regressor_file in tasks:
+            future = None if regressor_file is None else executor.submit(load_regressors, regressor_file, params)
+            ahead.append((fname, regressor_file, future))
+            while len(ahead) > depth or (len(ahead) != 0 and ahead[0][2] is None):
+                fname, regressor_file, future = ahead.popleft()
+                yield fname, regressor_file, future.result() if future is not None else None
+        for fname, regressor_file, future in ahead:
+            yield fname, regressor_file, future.result() if future is not None else None
+
+def set_regressors(extractor, regressor_file, loaded=None):
+    """Set the regressors of an extractor, from the output of load_regressors if they were prefetched."""
+    params = _STATE['params']
+    if loaded is None:
+        extractor.set_regressors(regressor_file, params['regressors'], params['load_confounds_kwargs'])
+        return
+    if not isinstance(loaded, tuple):
+        raise RuntimeError('Reading the regressors from {} failed:\n{}'.format(regressor_file, loaded))
+    extractor.regressor_file = regressor_file
+    extractor.regressor_names, extractor.regressor_array, extractor._load_confounds = loaded
+
+def get_peak():
+    """Get the peak resident memory of the current process in bytes (ru_maxrss is in kilobytes on linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def compute_file(args, img=None):
+    """Extract the timeseries of one file, without writing it (see write_output).
+    Errors are printed and reported, so the other files of the batch are still processed.
+
+    Parameters
+    ----------
+    args : tuple
+        Input file and its regressor file (or None), and the regressors if prefetched (see prefetch_regressors).
+    img : nibabel.Nifti1Image, None
+        The input already read into memory (see load_input), read from its file otherwise.
+    Returns
+    -------
+    tuple
+        Result of the file as for extract_file, without the write.
+    nixtract.extractors.NiftiExtractor, None
+        Extractor holding the timeseries, None if the file failed.
+    """
+    fname, regressor_file = args[:2]
+    params = _STATE['params']
+    start = time.time()
+    io_start = telemetry.get_io()
+    stages = {}
+    try:
+        t = time.time()
+        extractor = make_extractor(fname, img)
+        stages['setup'] = time.time() - t
+        if regressor_file is not None:
+            t = time.time()
+            set_regressors(extractor, regressor_file, args[2] if len(args) > 2 else None)
+            stages['regressors'] = time.time() - t
+        native = use_native(extractor.masker)
+        discard_scans = params['discard_scans'] or 0
+        if discard_scans > 0 and not native:
+            extractor.discard_scans(discard_scans)
+        t = time.time()
+        if native:
+            extract_native(extractor, discard_scans)
+        else:
+            extractor.extract()
+        stages['extract'] = time.time() - t
+        #not needed to write, and may hold the whole input while the output waits for the writer
+        extractor.img = None
+    except Exception:
+        traceback.print_exc()
+        sys.stdout.flush()
+        return (fname, time.time() - start, get_peak(), None, False, True, telemetry.get_stats(stages, io_start)), None
+    names = list(extractor.regressor_names) if extractor.regressor_names is not None else None
+    return (fname, time.time() - start, get_peak(), names, getattr(extractor, '_load_confounds', False), False,
+            telemetry.get_stats(stages, io_start)), extractor
+
+def write_output(result, extractor):
+    """Write the _timeseries.tsv of a file from compute_file to the work dir, as nixtract's extract_nifti does.
+
+    Parameters
+    ----------
+    result : tuple
+        Result from compute_file.
+    extractor : nixtract.extractors.NiftiExtractor, None
+        Extractor from compute_file, None if the file failed.
+    Returns
+    -------
+    tuple
+        Result of the file as for extract_file, including the write.
+    """
+    if extractor is None:
+        return result
+    fname, seconds, peak, names, load_confounds, failed, stats = result
+    start = time.time()
+    io_start = telemetry.get_io()
+    try:
+        extractor.save(index.get_output(fname, _STATE['work_dir']), _STATE['params']['n_decimals'])
+    except Exception:
+        traceback.print_exc()
+        names, load_confounds, failed = None, False, True
+    sys.stdout.flush()
+    stats['stages']['write'] = time.time() - start
+    written = telemetry.get_stats({}, io_start)
+    if stats['bytes_read'] is not None and written['bytes_read'] is not None:
+        stats['bytes_read'] += written['bytes_read']
+        stats['bytes_written'] += written['bytes_written']
+    return fname, seconds + stats['stages']['write'], max(peak, get_peak()), names, load_confounds, failed, stats
+
+def extract_file(args):
+    """Extract the timeseries of one file and write its _timeseries.tsv to the work dir, as nixtract's extract_nifti does.
+    Errors are printed and reported, so the other files of the batch are still processed.
+
+    Parameters
+    ----------
+    args : tuple
+        Input file and its regressor file (or None), and the regressors if prefetched (see prefetch_regressors).
+    Returns
+    -------
+    tuple
+        Input file, seconds, peak memory in bytes, regressor names (None if no regressors or on error),
+        whether the regressors came from load_confounds, True if the file failed, and the time spent in each stage
+        with the bytes read and written (see telemetry.get_stats).
+    """
+    return write_output(*compute_file(args))
+
+def load_input(fname):
+    """Read and decompress an input into memory, on the prefetch thread of run_pipeline. Reading and zlib release the
+    GIL, so this overlaps the extraction of the current file."""
+    import numpy as np
+    import nibabel as nib
+    img = nib.load(fname)
+    return nib.Nifti1Image(np.asanyarray(img.dataobj), img.affine, img.header)
+
+def run_pipeline(tasks, depth, finish):
+    """Extract files one at a time in this thread, with the next depth inputs read on a prefetch thread and the
+    outputs written on a writer thread.
+
+    Parameters
+    ----------
+    tasks : iterable
+        Tasks for compute_file.
+    depth : int
+        Number of inputs read ahead, each held in memory decompressed.
+    finish : callable
+        Called with the result of each file once written, from the writer thread.
+    """
+    outputs = queue.Queue(WRITE_QUEUE)
+    errors = []
+
+    def write_outputs():
+        for item in iter(outputs.get, None):
+            try:
+                finish(write_output(*item))
+            except Exception as e:
+                #raised in the main thread once the writer is done
+                errors.append(e)
+
+    writer = threading.Thread(target=write_outputs)
+    writer.start()
+    try:
+        with ThreadPoolExecutor(1) as reader:
+            tasks = iter(tasks)
+            ahead = collections.deque()
+            while True:
+                while len(ahead) <= depth:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    ahead.append((task, reader.submit(load_input, task[0])))
+                if len(ahead) == 0:
+                    break
+                task, future = ahead.popleft()
+                t = time.time()
+                #a file that cannot be read is read again by compute_file, which reports the error
+                img = future.result() if future.exception() is None else None
+                wait = time.time() - t
+                result, extractor = compute_file(task, img)
+                result[6]['stages']['read'] = wait
+                outputs.put(((result[0], result[1] + wait) + result[2:], extractor))
+    finally:
+        outputs.put(None)
+        writer.join()
+    if len(errors) != 0:
+        raise errors[0]
+
+def write_metadata(params, results, sharded=False):
+    """Write nixtract_data/parameters.json, a copy of the atlas and the load_confounds regressors, as nixtract does.
+
+    Parameters
+    ----------
+    params : dict
+        Validated nixtract parameters.
+    results : list
+        Outputs of extract_file.
+    sharded : bool
+        Outputs are listed with their path in the sharded layout.
+    """
+    from nixtract.cli.base import make_param_file
+
+    metadata_path = make_param_file(params)
+    if os.path.isfile(params['roi_file']):
+        shutil.copy2(params['roi_file'], metadata_path)
+    done = [r for r in results if not r[5]]
+    regressors = dict([(index.get_output(r[0], params['out_dir'], sharded), r[3]) for r in done if r[3] is not None])
+    if len(regressors) != 0 and all([r[4] for r in done]):
+        with open(os.path.join(metadata_path, 'load_confounds_regressors.json'), 'w') as f:
+            json.dump(regressors, f, indent=2)
+
+def run_in_process(config_path, out_path, n_workers=1, on_done=None, tasks=None, work_dir=None, sharded=False,
+                   on_stats=None, backend='nilearn', prefetch=0, prefetch_inputs=0):
+    """Extract a batch inside this process, or in n_workers worker processes that each build the masker once.
+    Files are handed to the workers one at a time, so a slow file does not hold up a whole part of the batch.
+
+    Parameters
+    ----------
+    config_path : str
+        Path to the batch config file.
+    out_path : str
+        Path to output dir.
+    n_workers : int
+        Number of files processed at the same time.
+    on_done : callable, None
+        Called with (file, seconds, peak_bytes) as soon as each file is finished, from this process.
+    tasks : iterable, None
+        (input_file, regressor_file) pairs to process instead of the files of the config, taken one at a time
+        as workers become free (e.g. claimed from a work queue).
+    work_dir : str, None
+        Directory the outputs are written to, e.g. node-local scratch. Default: out_path. on_done is called while the
+        output is still there, moving it is up to the caller.
+    sharded : bool
+        Outputs end up in the sharded layout, for the metadata.
+    on_stats : callable, None
+        Called with (file, seconds, peak_bytes, failed, stats) for every file, including failed ones, from this
+        process (see telemetry.make_row).
+    backend : str
+        One of BACKENDS.
+    prefetch : int
+        Number of files whose regressor files are read ahead (see prefetch_regressors), 0 to read them with each
+        file. Tasks are then taken that many files ahead, so not with a work queue.
+    prefetch_inputs : int
+        With n_workers=1, number of inputs read into memory ahead of the extraction, with the outputs written on
+        another thread (see run_pipeline). Tasks are then taken that many files ahead, so not with a work queue.
+    Returns
+    -------
+    int
+        1 if any file failed, 0 otherwise.
+    list
+        List of (file, seconds, peak_bytes) for each file that was processed.
+    """
+    if tasks is None:
+        params = get_nixtract_params(config_path, out_path)
+        regressor_files = params['regressor_files'] or [None] * len(params['input_files'])
+        if len(regressor_files) != len(params['input_files']):
+            raise ValueError('Number of regressor files do not equal number of input files')
+        tasks = zip(params['input_files'], regressor_files)
+    else:
+        #nixtract validates the input_files of the config, give it the first task
+        tasks = iter(tasks)
+        first = next(tasks, None)
+        if first is None:
+            return 0, []
+        params = get_nixtract_params(config_path, out_path, [first[0]])
+        tasks = itertools.chain([first], tasks)
+
+    init_extraction(params, out_path, work_dir, backend)
+    if prefetch > 0:
+        tasks = prefetch_regressors(tasks, params, prefetch)
+    done = []
+
+    def finish(r):
+        done.append(r)
+        if on_stats is not None:
+            on_stats(r[0], r[1], r[2], r[5], r[6])
+        if not r[5] and on_done is not None:
+            on_done(*r[:3])
+
+    if n_workers <= 1 and prefetch_inputs > 0:
+        run_pipeline(tasks, prefetch_inputs, finish)
+    elif n_workers <= 1:
+        for task in tasks:
+            finish(extract_file(task))
+    else:
+        with ProcessPoolExecutor(n_workers, initializer=init_extraction,
+                                 initargs=(params, out_path, work_dir, backend)) as executor:
+            running = set()
+            tasks = iter(tasks)
+            while True:
+                #only take the next task once a worker is free
+                if len(running) == n_workers:
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        finish(future.result())
+                task = next(tasks, None)
+                if task is None:
+                    break
+                running.add(executor.submit(extract_file, task))
+            for future in as_completed(running):
+                finish(future.result())
+
+    write_metadata(params, done, sharded)
+    returncode = 1 if any([r[5] for r in done]) else 0
+    return returncode, [r[:3] for r in done if not r[5]]
@@ -0,0 +1,373 @@
+import os
+import time
+import glob
+import json
+import fcntl
+import shutil
+import hashlib
+import contextlib
+
+#Completion index: each job appends a record for every input file it has finished to its own shard in
+#logs/completed, one tab separated line per file. Nobody else writes to a shard, and a line without its newline
+#(job killed mid-write) is ignored when reading. A job locks its shard while appending, so a merge that renames the
+#shard (see compact_index) does not read it in the middle of a write. Shards are merged into index.txt on the
+#next submission. A record is the input basename, optionally followed by the fingerprint below. Records with
+#only a name come from scanning out_path for _timeseries.tsv files.
+INDEX_DIR = 'logs/completed'
+INDEX_FILE = 'index.txt'
+#Name of a shard being merged by compact_index. A merged shard ending with an incomplete line is kept for the next
+#merge if it changed in the last STALE_SECONDS (the line is still being written), and removed otherwise (job killed).
+COMPACTING_SUFFIX = '.compacting.txt'
+STALE_SECONDS = 60
+#Merges (get_todo, the cleanup job, another submission) hold an exclusive lock on this file, so one merge does not
+#replace index.txt with an index read before another merge's shards were added to it and removed.
+LOCK_FILE = 'index.lock'
+RECORD_FIELDS = ['name', 'input_mtime', 'input_size', 'params_hash', 'n_rows', 'out_size']
+
+#Sharded output layout (--shard_outputs): instead of every _timeseries.tsv in out_path, each output goes to
+#timeseries/<xx>/, where xx are the first hex digits of a hash of the input basename. The 256 directories each stay
+#small, so creating files and listing them does not go through one huge directory on the metadata server. The
+#completion index only stores basenames, so completed files are found in either layout.
+SHARD_DIR = 'timeseries'
+SHARD_WIDTH = 2
+
+#Config keys that differ between batches or do not change the output.
+BATCH_KEYS = ['input_files', 'regressor_files', 'verbose', 'n_jobs']
+
+def get_index_dir(out_path):
+    """Get the path to the completion index directory.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    Returns
+    -------
+    str
+        Path to the index directory (logs/completed).
+    """
+    return os.path.join(out_path, INDEX_DIR)
+
+def get_shard(name):
+    """Get the shard directory of an output, from a hash of its input basename."""
+    return hashlib.sha1(name.encode()).hexdigest()[:SHARD_WIDTH]
+
+def get_output(input_file, out_path, sharded=False):
+    """Get the path of the _timeseries.tsv written by nixtract for an input file.
+
+    Parameters
+    ----------
+    input_file : str
+        Input file.
+    out_path : str
+        Path to output dir.
+    sharded : bool
+        Path in the sharded layout, out_path/timeseries/<shard>/.
+    Returns
+    -------
+    str
+        Path to the output file.
+    """
+    name = os.path.basename(input_file)
+    output = name.replace('.nii.gz','_timeseries.tsv')
+    if sharded:
+        return os.path.join(out_path, SHARD_DIR, get_shard(name), output)
+    return os.path.join(out_path, output)
+
+def find_output(input_file, out_path):
+    """Get the path of the output of an input file in whichever layout it was written, the flat path if none exists."""
+    sharded = get_output(input_file, out_path, sharded=True)
+    if os.path.exists(sharded):
+        return sharded
+    return get_output(input_file, out_path)
+
+def list_outputs(out_path):
+    """List the _timeseries.tsv files in out_path and in its shard directories.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output dir.
+    Returns
+    -------
+    list
+        Paths to the output files.
+    """
+    outputs = [os.path.join(out_path, f) for f in os.listdir(out_path) if f.endswith('_timeseries.tsv')]
+    shard_dir = os.path.join(out_path, SHARD_DIR)
+    if os.path.isdir(shard_dir):
+        for shard in sorted(os.listdir(shard_dir)):
+            path = os.path.join(shard_dir, shard)
+            if os.path.isdir(path):
+                outputs += [os.path.join(path, f) for f in os.listdir(path) if f.endswith('_timeseries.tsv')]
+    return outputs
+
+def move_outputs(outputs):
+    """Move outputs to their final location, e.g. from node-local scratch or into their shard.
+
+    Parameters
+    ----------
+    outputs : list
+        List of (source, destination) paths.
+    """
+    made = set()
+    for src, dst in outputs:
+        d = os.path.dirname(dst)
+        if d not in made:
+            os.makedirs(d, exist_ok=True)
+            made.add(d)
+        shutil.move(src, dst)
+
+def get_expected_rows(n_timepoints, params):
+    """Get the number of lines nixtract writes for an input file: a header and one row per kept timepoint.
+
+    Parameters
+    ----------
+    n_timepoints : int
+        Number of timepoints of the input.
+    params : dict
+        Parameters from the config file.
+    Returns
+    -------
+    int
+        Expected number of lines of the _timeseries.tsv.
+    """
+    discard = params.get('discard_scans') or 0
+    return n_timepoints - discard + 1
+
+def hash_params(params):
+    """Hash the nixtract parameters that determine the output, ignoring the batch specific ones.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters from the config file.
+    Returns
+    -------
+    str
+        Hex digest of the parameters.
+    """
+    p = dict([(k, v) for k, v in params.items() if k not in BATCH_KEYS])
+    return hashlib.sha1(json.dumps(p, sort_keys=True).encode()).hexdigest()
+
+def count_rows(path, chunk_size=2**20):
+    """Count the lines of a text file without parsing it.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+    chunk_size : int
+        Number of bytes read at a time.
+    Returns
+    -------
+    int
+        Number of newline terminated lines, -1 if the last line has no newline (truncated file).
+    """
+    n = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            n += chunk.count(b'\n')
+            last = chunk[-1:]
+    if last != b'\n':
+        return -1
+    return n
+
+def make_record(input_file, output_file, params_hash):
+    """Make the completion record of a finished input file.
+
+    Parameters
+    ----------
+    input_file : str
+        Path to the input file.
+    output_file : str
+        Path to its _timeseries.tsv.
+    params_hash : str
+        Output of hash_params.
+    Returns
+    -------
+    dict
+        Record with keys RECORD_FIELDS.
+    """
+    st = os.stat(input_file)
+    return {'name': os.path.basename(input_file), 'input_mtime': st.st_mtime_ns, 'input_size': st.st_size,
+            'params_hash': params_hash, 'n_rows': count_rows(output_file),
+            'out_size': os.path.getsize(output_file)}
+
+def format_record(record):
+    """Format a record as a line of the index.
+
+    Parameters
+    ----------
+    record : dict
+        Record from make_record, may only contain 'name'.
+    Returns
+    -------
+    str
+        Tab separated line, with its newline.
+    """
+    if len(record) == 1:
+        return record['name'] + '\n'
+    return '\t'.join([str(record[k]) for k in RECORD_FIELDS]) + '\n'
+
+def parse_record(line):
+    """Parse a line of the index.
+
+    Parameters
+    ----------
+    line : str
+        Line without its newline.
+    Returns
+    -------
+    dict
+        Record, with only 'name' if the line has no fingerprint.
+    """
+    fields = line.split('\t')
+    if len(fields) != len(RECORD_FIELDS):
+        return {'name': fields[0]}
+    record = dict(zip(RECORD_FIELDS, fields))
+    for k in ['input_mtime', 'input_size', 'n_rows', 'out_size']:
+        record[k] = int(record[k])
+    return record
+
+def check_record(record, input_file, output_file, expected_rows=None):
+    """Check that a completed output is still valid: the input has not changed since and the output is complete.
+    Costs one stat per file, the output is only read for records without a fingerprint.
+
+    Parameters
+    ----------
+    record : dict
+        Record from the index.
+    input_file : str
+        Path to the input file.
+    output_file : str, None
+        Path to its _timeseries.tsv. None if the output has been moved to the consolidated store, then only the
+        input is checked.
+    expected_rows : int, None
+        Expected number of lines of the output, used for records without a fingerprint.
+    Returns
+    -------
+    bool
+        True if the output can be kept.
+    """
+    if output_file is not None and not os.path.exists(output_file):
+        return False
+    if len(record) == 1:
+        return output_file is None or expected_rows is None or count_rows(output_file) == expected_rows
+    st = os.stat(input_file)
+    if st.st_mtime_ns != record['input_mtime'] or st.st_size != record['input_size']:
+        return False
+    return output_file is None or os.path.getsize(output_file) == record['out_size']
+
+def record_completed(path, records):
+    """Append records of finished input files to a job's index shard.
+
+    Parameters
+    ----------
+    path : str
+        Path to the shard, unique to the job.
+    records : list
+        Records from make_record.
+    """
+    while True:
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                same = os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+            except FileNotFoundError:
+                same = False
+            #renamed by compact_index since it was opened: write to a new shard instead
+            if same:
+                f.write(''.join([format_record(r) for r in records]))
+                f.flush()
+                return
+
+def read_shard(path):
+    """Read the complete lines of an index shard.
+
+    Parameters
+    ----------
+    path : str
+        Path to the shard.
+    Returns
+    -------
+    list
+        Records of the finished input files.
+    """
+    with open(path) as f:
+        data = f.read()
+    lines = data.split('\n')
+    #last element is '' if the file ends with a newline, otherwise an incomplete line
+    return [parse_record(l) for l in lines[:-1] if l != '']
+
+@contextlib.contextmanager
+def lock_index(index_dir):
+    """Hold an exclusive lock on the completion index while merging, waiting for any other merge to finish."""
+    with open(os.path.join(index_dir, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def compact_index(out_path, extra=()):
+    """Merge the job shards into the index file, so later reads only open one file.
+    Each shard is first renamed to a private name, so a job still running appends its next records to a new shard
+    instead of to a file about to be removed. The merged index is written to a temporary file and renamed, then the
+    renamed shards are removed, unless one ends with a line still being written, which is left for the next merge
+    (see STALE_SECONDS). Merges are serialized with lock_index.
+    Newer records replace older ones for the same file.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    extra : iterable
+        Additional basenames to add to the index (e.g. found by scanning out_path).
+    Returns
+    -------
+    dict
+        Mapping from input basename to its record.
+    """
+    index_dir = get_index_dir(out_path)
+    os.makedirs(index_dir, exist_ok=True)
+    index_file = os.path.join(index_dir, INDEX_FILE)
+
+    with lock_index(index_dir):
+        completed = dict([(n, {'name': n}) for n in extra])
+        if os.path.exists(index_file):
+            completed.update([(r['name'], r) for r in read_shard(index_file)])
+        shards = []
+        for path in glob.glob(os.path.join(index_dir, '*.txt')):
+            if path == index_file:
+                continue
+            private = path if path.endswith(COMPACTING_SUFFIX) else path[:-len('.txt')] + COMPACTING_SUFFIX
+            try:
+                os.replace(path, private)
+            except FileNotFoundError:
+                #removed since it was listed
+                continue
+            shards.append(private)
+        shards.sort(key=os.path.getmtime)
+        done = []
+        for path in shards:
+            with open(path) as f:
+                #wait for a write started before the rename
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = f.read()
+            completed.update([(r['name'], r) for r in read_shard(path)])
+            if data.endswith('\n') or data == '' or time.time() - os.path.getmtime(path) > STALE_SECONDS:
+                done.append(path)
+
+        tmp = '{}.{}.tmp'.format(index_file, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(''.join([format_record(completed[n]) for n in sorted(completed)]))
+        os.replace(tmp, index_file)
+
+        for path in done:
+            os.remove(path)
+    return completed
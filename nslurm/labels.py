@@ -0,0 +1,174 @@
+import numpy as np
+
+#Native extraction for label atlases: instead of the nilearn masker, which loops over timepoints and calls
+#scipy.ndimage.mean on every volume, the voxels of all regions are sorted by label once per atlas and grid (an
+#"index"), then the region means of a few volumes at a time are one gather of those voxels and one np.add.reduceat
+#over the runs of each label. Signals are then cleaned (confounds, detrending, filtering, standardizing) with nilearn's
+#signal.clean, with the parameters of the masker, so the output is the masker's up to float rounding. Confounds are
+#regressed out of all regions at once by regress_confounds when there are no filters.
+#Only for what the labels masker does without resampling the data: mean of each region, no smoothing. Other atlases
+#and parameters go through the masker.
+
+#Streaming: the image is read this many bytes of volumes at a time, from a file kept open so the .nii.gz is
+#decompressed once from start to end. Memory is then the block and the index, whatever the length of the scan,
+#instead of the whole 4D image.
+READ_BYTES = 2**25
+
+#Volumes of a block are gathered a few at a time, about this many bytes, so the copy stays in cache for the sums.
+CHUNK_BYTES = 2**21
+
+def is_supported(masker):
+    """Check if native extraction gives the output of a nilearn masker.
+
+    Parameters
+    ----------
+    masker : nilearn masker
+        Masker of the extractor, with labels_img (and mask_img) already resampled to the grid of the inputs.
+    Returns
+    -------
+    bool
+        True for a NiftiLabelsMasker taking region means on the grid of the data, without smoothing.
+    """
+    return (type(masker).__name__ == 'NiftiLabelsMasker' and getattr(masker, 'smoothing_fwhm', None) is None and
+            getattr(masker, 'strategy', 'mean') == 'mean' and getattr(masker, 'resampling_target', 'data') == 'data')
+
+def make_index(labels_data, mask_data=None, background=0):
+    """Sort the voxels of a label atlas by region, as the offsets for np.add.reduceat.
+    Regions are the labels of the atlas other than background, in increasing order, as nilearn lists them. Voxels
+    outside the mask are background, a region with no voxel left gets a zero signal as in nilearn.
+
+    Parameters
+    ----------
+    labels_data : numpy.ndarray
+        3D label atlas on the grid of the inputs.
+    mask_data : numpy.ndarray, None
+        3D mask on the same grid.
+    background : int
+        Label of the background.
+    Returns
+    -------
+    dict
+        'labels' of the regions, 'voxels' (flat indices, in Fortran order, of the voxels sorted by region), 'starts'
+        of each region present in voxels and its 'counts', and the 'columns' of those regions in labels.
+    """
+    labels_data = np.asarray(labels_data)
+    labels = np.unique(labels_data)
+    labels = labels[labels != background]
+    flat = labels_data.ravel(order='F')
+    if mask_data is not None:
+        flat = np.where(np.asarray(mask_data).ravel(order='F') != 0, flat, background)
+    voxels = np.flatnonzero(flat != background)
+    #stable, so voxels of a region stay in memory order for the gather
+    voxels = voxels[np.argsort(flat[voxels], kind='stable')]
+    present, starts, counts = np.unique(flat[voxels], return_index=True, return_counts=True)
+    return {'labels': labels, 'voxels': voxels, 'starts': starts, 'counts': counts,
+            'columns': np.searchsorted(labels, present)}
+
+def get_signals(data, idx, start=0):
+    """Compute the mean signal of each region, reading the data READ_BYTES at a time.
+
+    Parameters
+    ----------
+    data : numpy.ndarray, nibabel.arrayproxy.ArrayProxy
+        3D or 4D data on the grid of the index, time last. With the dataobj of an image loaded with
+        keep_file_open=True, only a block of volumes is in memory at a time.
+    idx : dict
+        Output of make_index.
+    start : int
+        First volume to extract (discard_scans).
+    Returns
+    -------
+    numpy.ndarray
+        Signals of shape (timepoints, regions), float32 if data is float32 and float64 otherwise, as nilearn.
+    """
+    if len(data.shape) == 3:
+        data = np.asanyarray(data)[..., np.newaxis]
+    n_volumes = data.shape[3]
+    #room for the scaled values (up to float64) of a block
+    block = max(1, READ_BYTES // (int(np.prod(data.shape[:3])) * 8))
+    sums = np.zeros((max(n_volumes - start, 0), len(idx['starts'])))
+    dtype = np.float64
+    for first in range(start, n_volumes, block):
+        #one row per volume, a view of the Fortran ordered arrays nibabel returns
+        volumes = np.asanyarray(data[..., first:first + block])
+        dtype = np.float32 if volumes.dtype == np.float32 else np.float64
+        volumes = volumes.reshape(-1, volumes.shape[3], order='F').T
+        if len(idx['voxels']) == 0:
+            continue
+        step = max(1, CHUNK_BYTES // (len(idx['voxels']) * volumes.itemsize))
+        for i in range(0, len(volumes), step):
+            values = np.take(volumes[i:i + step], idx['voxels'], axis=1)
+            if values.dtype.kind == 'f':
+                #nilearn replaces non-finite values with zeros
+                values[~np.isfinite(values)] = 0
+            row = first - start + i
+            sums[row:row + len(values)] = np.add.reduceat(values, idx['starts'], axis=1, dtype=np.float64)
+    signals = np.zeros((len(sums), len(idx['labels'])), dtype=dtype)
+    if len(idx['voxels']) != 0:
+        signals[:, idx['columns']] = sums / idx['counts']
+    return signals
+
+def regress_confounds(signals, confounds, detrend=False, standardize_confounds=True):
+    """Regress confounds out of the signals of all regions at once, as nilearn's signal.clean does without filters.
+    The confounds are detrended or centered and scaled as nilearn does, then projected out with the Q of their pivoted
+    economic QR as Q (Q.T signals) rather than (Q Q.T) signals, so the cost grows with timepoints x confounds x
+    regions instead of timepoints^2 x regions.
+
+    Parameters
+    ----------
+    signals : numpy.ndarray
+        Signals of shape (timepoints, regions).
+    confounds : numpy.ndarray
+        Regressors, one row per timepoint.
+    detrend : bool
+        The signals are detrended by signal.clean, so are the confounds.
+    standardize_confounds : bool
+        z-score the confounds (centered), otherwise they are only scaled.
+    Returns
+    -------
+    numpy.ndarray
+        Residuals, with the dtype of signals.
+    """
+    from scipy import linalg
+    confounds = np.asarray(confounds, dtype=np.float64)
+    if confounds.ndim == 1:
+        confounds = confounds[:, np.newaxis]
+    if detrend:
+        trend = np.linalg.qr(np.vstack([np.ones(len(confounds)), np.arange(len(confounds))]).T)[0]
+        confounds = confounds - trend.dot(trend.T.dot(confounds))
+    elif standardize_confounds:
+        confounds = confounds - confounds.mean(axis=0)
+    scale = confounds.std(axis=0) if standardize_confounds else np.abs(confounds).max(axis=0)
+    scale[scale < np.finfo(np.float64).eps] = 1
+    q, r, _ = linalg.qr(confounds / scale, mode='economic', pivoting=True)
+    q = q[:, np.abs(np.diag(r)) > np.finfo(np.float64).eps * 100.]
+    return (signals - q.dot(q.T.dot(signals))).astype(signals.dtype)
+
+def clean_signals(signals, masker, confounds=None):
+    """Clean region signals as the nilearn masker does after extracting them.
+    Without filters, confounds are regressed out by regress_confounds before the rest of signal.clean, which gives
+    the same result since the confounds are orthogonal to the trend removed by detrending.
+
+    Parameters
+    ----------
+    signals : numpy.ndarray
+        Output of get_signals.
+    masker : nilearn masker
+        Masker giving the cleaning parameters.
+    confounds : numpy.ndarray, None
+        Regressors, one row per timepoint.
+    Returns
+    -------
+    numpy.ndarray
+        Cleaned signals.
+    """
+    from nilearn import signal
+    kwargs = {}
+    #not in older nilearn
+    if hasattr(masker, 'standardize_confounds'):
+        kwargs['standardize_confounds'] = masker.standardize_confounds
+    if confounds is not None and masker.low_pass is None and masker.high_pass is None:
+        signals = regress_confounds(signals, confounds, masker.detrend, kwargs.get('standardize_confounds', True))
+        confounds = None
+    return signal.clean(signals, detrend=masker.detrend, standardize=masker.standardize, t_r=masker.t_r,
+                        low_pass=masker.low_pass, high_pass=masker.high_pass, confounds=confounds, **kwargs)
@@ -1,14 +1,41 @@
 # For now just for nixtract-nifti, TODO include -cifti and -gifti 
 
 import os
-import glob
 import json
+import subprocess
 import natsort
 import time
-import datetime
+import heapq
+import math
+import sys
+import struct
 import pandas as pd
 from string import Template
 from argparse import ArgumentParser
+from . import cost
+from . import index
+from . import scan
+from . import atlas
+from . import workqueue
+from . import supervisor
+from . import stages
+from . import store
+from . import telemetry
+
+#Batch assignment (see make_config): the parameters shared by all batches are written once to logs/params.json and
+#the files of all batches to logs/batches.txt, one "input_file<TAB>regressor_file" line per file in batch order.
+#logs/batches.offsets holds the byte offset of the first line of each batch, and of the end of the file, as int64,
+#so a task reads 16 bytes and then only its own lines. Submission writes three files whatever the number of jobs.
+PARAMS_FILE = 'params.json'
+BATCHES_FILE = 'batches.txt'
+OFFSETS_FILE = 'batches.offsets'
+
+#Input staging (--stage_inputs): each job copies the input and regressor files of its batch to node-local disk before
+#extracting them, so the shared filesystem sees one sequential read per file instead of many small reads. Batches are
+#split so that their files fit in --local_disk (LOCAL_DISK by default) with LOCAL_DISK_SAFETY room for the outputs,
+#and jobs request that much node-local disk with #SBATCH --tmp.
+LOCAL_DISK = '100G'
+LOCAL_DISK_SAFETY = 1.2
 
 def generate_parser():
     parser = ArgumentParser()
@@ -18,17 +45,43 @@ def generate_parser():
     parser.add_argument("--time",help='Optional: Specify time (per job) for SLURM. Must be formatted "hours:minutes:seconds".',dest='time',required=False)
     parser.add_argument("--mem",help='Optional: Specify memory (per job) for SLURM.',dest='mem',required=False)
     parser.add_argument("--n_jobs",help='Optional: Specify number of jobs for SLURM.',dest='n_jobs',required=False,type=int)
+    parser.add_argument("--cpus_per_task",help='Optional: Number of CPUs per job, each processing one file at a time. The --mem of the job is the total for all its CPUs: the predicted memory is multiplied by the number of CPUs (a given --mem is not). Default: 1.',dest='cpus_per_task',required=False,type=int,default=1)
+    parser.add_argument("--max_jobs",help='Optional: Maximum number of jobs that can be submitted (e.g. QOS MaxSubmitJobs), including the prep and cleanup jobs. Jobs are made bigger to fit.',dest='max_jobs',required=False,type=int)
+    parser.add_argument("--max_array_size",help='Optional: Maximum number of jobs in one job array (SLURM MaxArraySize), jobs are split over several arrays above this. Default: 1000.',dest='max_array_size',required=False,type=int,default=1000)
+    parser.add_argument("--max_concurrent",help='Optional: Maximum number of jobs running at the same time (array throttle).',dest='max_concurrent',required=False,type=int)
     parser.add_argument("--rerun_completed",help='Flag to ignore completed output in out_path and process all input.',dest='rerun_completed',action='store_true')
+    parser.add_argument("--rescan_inputs",help='Flag to expand the input_files and regressor_files globs again instead of using the inventory cached in logs from a previous run.',dest='rescan_inputs',action='store_true')
+    parser.add_argument("--verify_completed",help='Flag to check that completed outputs are complete and their input has not changed since (one stat per file), and process them again otherwise.',dest='verify_completed',action='store_true')
+    parser.add_argument("--static_resources",help='Flag to skip reading the NIfTI headers to predict time and memory, and use the static defaults (~5s and 1G per file) instead.',dest='static_resources',action='store_true')
+    parser.add_argument("--no_atlas_cache",help='Flag to skip resampling roi_file and mask_img to the grid of the input files before submission, each job then resamples them itself.',dest='no_atlas_cache',action='store_true')
+    parser.add_argument("--queue",help='Flag to have jobs claim files one at a time from a work queue in logs/queue (heaviest first) instead of processing fixed batches.',dest='queue',action='store_true')
+    parser.add_argument("--supervise",help='Flag to wait for the jobs and resubmit the files that are not completed, with twice the time after a timeout and twice the memory after running out of memory.',dest='supervise',action='store_true')
+    parser.add_argument("--max_retries",help='Optional: Maximum number of resubmissions with --supervise. Default: 3.',dest='max_retries',required=False,type=int,default=3)
+    parser.add_argument("--poll_interval",help='Optional: Seconds between two checks of the jobs with --supervise. Default: 60.',dest='poll_interval',required=False,type=int,default=60)
+    parser.add_argument("--store",help='Flag to gather the outputs into one HDF5 file, out_path/timeseries.h5, once all jobs have ended (needs h5py). The _timeseries.tsv files are removed once stored.',dest='store',action='store_true')
+    parser.add_argument("--shard_outputs",help='Flag to write each output to out_path/timeseries/<xx>/, one of 256 directories chosen by a hash of the input file name, instead of all in out_path.',dest='shard_outputs',action='store_true')
+    parser.add_argument("--stage_outputs",help='Flag to have jobs write their outputs to node-local $SLURM_TMPDIR and move them to out_path in groups.',dest='stage_outputs',action='store_true')
+    parser.add_argument("--stage_inputs",help='Flag to have each job copy the input and regressor files of its batch to node-local $SLURM_TMPDIR, extract them there and move all outputs to out_path at the end. Not with --queue.',dest='stage_inputs',action='store_true')
+    parser.add_argument("--local_disk",help='Optional: Node-local disk available to each job with --stage_inputs, formatted for SLURM. Batches are split so that their files fit. Default: {}.'.format(LOCAL_DISK),dest='local_disk',required=False,default=LOCAL_DISK)
+    parser.add_argument("--backend",help='Optional: Extraction backend of the jobs. "native" computes the region means of label atlases from an index of the atlas built once per job, without the nilearn masker; other atlases still use it. Default: nilearn.',dest='backend',choices=['nilearn','native'],default='nilearn')
+    parser.add_argument("--prefetch",help='Optional: Number of inputs each job reads and decompresses into memory ahead of the extraction, writing outputs on another thread, so reading from the shared filesystem overlaps the extraction. Each input read ahead adds its decompressed size to the memory of the job. Not with --queue or --cpus_per_task. Default: 0.',dest='prefetch',type=int,default=0)
+    parser.add_argument("--dry_run","--dry-run",help='Flag to only print the plan (jobs, predicted time per job, makespan and core-hours) without writing job files or submitting anything.',dest='dry_run',action='store_true')
+    parser.add_argument("--packing",help='Optional: How to split files into batches. "count" splits by number of files, "size" and "voxels" balance batches by file size on disk or by voxels x timepoints from the NIfTI header.',dest='packing',choices=['count','size','voxels'],default='count')
     return parser
 
-def check_glob(x):
-    """Get files based on glob pattern.
+def check_glob(x, sort=True, dirs=None):
+    """Get files based on glob pattern. Directories are listed concurrently (see scan.iter_glob).
 
     Parameters
     ----------
-    x : str, list
+    x : str, list, None
         A glob pattern string or a list of files. If a list, glob pattern 
-        matching is not performed.
+        matching is not performed. None is treated as an empty list.
+    sort : bool
+        Naturally sort the files matching a glob pattern. Only needed when the order matters,
+        e.g. to pair input_files with regressor_files.
+    dirs : dict, None
+        If given, filled with the modification times of the directories the result depends on.
     Returns
     -------
     list
@@ -39,21 +92,30 @@ def check_glob(x):
        x is neither a string nor list of strings
     """
     if isinstance(x, str):
-        return natsort.natsorted(glob.glob(x))
+        files = list(scan.iter_glob(x, dirs=dirs))
+        if sort:
+            files = natsort.natsorted(files)
+        return files
     elif isinstance(x, list):
         return x
+    elif x is None:
+        return []
     else:
         raise ValueError('Input data files (images and confounds) must be a'
                          'string or list of string')
 
-def read_config(config_path):
+def read_config(config_path, inventory_path=None):
     """Read config file for nixtract, expanding glob for input and regressor files. 
     In the case that input and regressor files are specified as lists (not glob), assumes the lists are ordered the same way.
+    Globs are only sorted when there are regressor files to pair with the input files.
 
     Parameters
     ----------
     config_path : str
         Path to the config file.
+    inventory_path : str, None
+        Path to the inventory file caching glob expansions (logs/inventory.json). The cached files are used
+        as long as none of the directories they were found in have changed. If None, globs are always expanded.
     Returns
     -------
     dict
@@ -65,9 +127,24 @@ def read_config(config_path):
     """
     with open(config_path) as f:
         config = json.load(f)
-    input_files = check_glob(config['input_files'])
-    conf_files = check_glob(config['regressor_files'])
-    
+
+    use_inventory = inventory_path is not None and (isinstance(config['input_files'], str) or
+                                                    isinstance(config['regressor_files'], str))
+    #relative globs depend on the working directory
+    key = json.dumps([os.getcwd(), config['input_files'], config['regressor_files']])
+    entry = scan.load_inventory(inventory_path, key) if use_inventory else None
+    if entry is not None:
+        print('Using cached inventory of input files...')
+        input_files = entry['input_files']
+        conf_files = entry['regressor_files']
+    else:
+        dirs = {}
+        conf_files = check_glob(config['regressor_files'], dirs=dirs)
+        input_files = check_glob(config['input_files'], sort=len(conf_files) != 0, dirs=dirs)
+        if use_inventory:
+            scan.save_inventory(inventory_path, key, {'dirs': dirs, 'input_files': input_files,
+                                                      'regressor_files': conf_files})
+
     if (len(conf_files) != 0) and (len(input_files) != len(conf_files)):
         raise ValueError("Number of regressor files must be either be 0 or match number of input files.")
 
@@ -89,8 +166,31 @@ def replace_file_ext(fname):
     """
     return fname.replace('_timeseries.tsv','.nii.gz')
 
+def get_completed_records(out_path):
+    """Get the completion records of finished .nii.gz files from the completion index in out_path/logs/completed.
+    If there is no index yet, the out_path directory (and its shards) and the consolidated store are scanned once to
+    seed it.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    Returns
+    -------
+    dict
+        Mapping from .nii.gz file name to its completion record (see index.make_record).
+    """
+    if os.path.isdir(index.get_index_dir(out_path)):
+        completed = index.compact_index(out_path)
+    else:
+        scanned = [replace_file_ext(os.path.basename(i)) for i in index.list_outputs(out_path)]
+        scanned += [name + '.nii.gz' for name in store.list_stored(store.get_store_path(out_path))]
+        completed = index.compact_index(out_path, scanned)
+    print('Found {} completed subjects.'.format(len(completed)))
+    return completed
+
 def get_completed(out_path):
-    """Make a list of completed .nii.gz files based on _timeseries.tsv files in the out_path directory.
+    """Make a list of completed .nii.gz files from the completion index (see get_completed_records).
 
     Parameters
     ----------
@@ -101,11 +201,47 @@ def get_completed(out_path):
     list
         List of .nii.gz files that have matching _timeseries.tsv files in the out_path directory.
     """
-    completed = [ i for i in os.listdir(out_path) if i.endswith('_timeseries.tsv')]
-    print('Found {} completed subjects.'.format(len(completed)))
-    return [i for i in map(replace_file_ext,completed)]
+    return list(get_completed_records(out_path))
+
+def is_completed(record, input_file, out_path, params_hash=None, params=None, verify=False, stored=()):
+    """Check if an input file still has a valid output.
 
-def get_todo(inputs, conf, out_path):
+    Parameters
+    ----------
+    record : dict, None
+        Completion record of the input file, None if it was never completed.
+    input_file : str
+        Path to the input file.
+    out_path : str
+        Path to output directory.
+    params_hash : str, None
+        Hash of the current parameters (see index.hash_params). Outputs made with other parameters are stale.
+    params : dict, None
+        Current parameters, used to get the expected number of rows of outputs without a fingerprint.
+    verify : bool
+        If True, also check that the input is unchanged and the output is complete (one stat per file).
+    stored : set
+        Keys of the subjects in the consolidated store (see store.get_name), whose _timeseries.tsv was removed.
+    Returns
+    -------
+    bool
+        True if the input file does not need to be processed again.
+    """
+    if record is None:
+        return False
+    if params_hash is not None and record.get('params_hash', params_hash) != params_hash:
+        return False
+    if not verify:
+        return True
+    output_file = index.find_output(input_file, out_path)
+    if not os.path.exists(output_file) and store.get_name(input_file) in stored:
+        output_file = None
+    expected = None
+    if len(record) == 1 and params is not None and output_file is not None:
+        expected = index.get_expected_rows(cost.get_shape(input_file)[1], params)
+    return index.check_record(record, input_file, output_file, expected)
+
+def get_todo(inputs, conf, out_path, params=None, verify=False):
     """Get list of input_files and regressor_files filtered to those that haven't been completed on a previous run.
 
     Parameters
@@ -116,6 +252,10 @@ def get_todo(inputs, conf, out_path):
         List of regressor_files
     out_path : str
         Path to output directory.
+    params : dict, None
+        Parameters from the config file. If given, outputs made with different parameters are processed again.
+    verify : bool
+        If True, outputs whose input has changed or that are truncated are processed again.
     Returns
     -------
     list
@@ -123,21 +263,24 @@ def get_todo(inputs, conf, out_path):
     list
         List of accompanying regressor_files. If conf was an empty list, returns an empty list.
     """
-    completed = get_completed(out_path)
+    records = get_completed_records(out_path)
+    params_hash = None if params is None else index.hash_params(params)
+    stored = set(store.list_stored(store.get_store_path(out_path))) if verify else set()
+    done = [is_completed(records.get(os.path.basename(i)), i, out_path, params_hash, params, verify, stored) for i in inputs]
     if len(conf) != 0:
         inputs_filt = []
         conf_filt = []
         for i in range(len(inputs)):
-            if os.path.basename(inputs[i]) in completed:
+            if done[i]:
                 pass
             else:
                 inputs_filt.append(inputs[i])
                 conf_filt.append(conf[i])
         return inputs_filt,conf_filt
     else:
-       return [i for i in inputs if os.path.basename(i) not in completed], conf
+       return [inputs[i] for i in range(len(inputs)) if not done[i]], conf
 
-def get_slurm_params(n,runtime=None,mem=None,n_jobs=None):
+def get_slurm_params(n,runtime=None,mem=None,n_jobs=None,costs=None,max_jobs=None,cpus=1):
     """Get remaining parameters to submit SLURM jobs based on specified parameters and number of files to process.
 
     Parameters
@@ -150,6 +293,14 @@ def get_slurm_params(n,runtime=None,mem=None,n_jobs=None):
         Memory, string formatted for SLURM e.g. '1G', '500MB'.
     n_jobs : int, None
         Number of SLURM jobs to launch.
+    costs : list, None
+        Predicted (seconds, bytes) per file (see cost.estimate_costs). If None, assumes ~5s and 1G per file.
+        When the number of jobs is not specified, each job is then sized to take between
+        cost.TASK_MIN_SECONDS and cost.TASK_MAX_SECONDS.
+    max_jobs : int, None
+        Maximum number of jobs that can be submitted (e.g. QOS MaxSubmitJobs). Jobs are made bigger to fit.
+    cpus : int
+        Number of CPUs per job, each processing one file at a time. Time is divided and memory multiplied accordingly.
     Returns
     -------
     str
@@ -162,8 +313,22 @@ def get_slurm_params(n,runtime=None,mem=None,n_jobs=None):
     #TIME ~5s per subject (ADHD200 and fmri dev dataset)
     #MEM 1G overall (cleans up after each subject, takes about peak around ~500)
     #Tested w/ MIST64 and MIST444
+    if costs is not None and len(costs) != 0:
+        total = sum([c[0] for c in costs])
+        longest = max([c[0] for c in costs])
+        peak = max([c[1] for c in costs])
+    else:
+        costs = None
+
+    if n_jobs != None and max_jobs != None and n_jobs > max_jobs:
+        print('Can only submit {} job(s), instead of {}.'.format(max_jobs,n_jobs))
+        n_jobs = max_jobs
+
     if mem == None:
-        mem = '1G'
+        if costs is None:
+            mem = '{}G'.format(cpus)
+        else:
+            mem = cost.format_mem(cost.MEM_SAFETY*peak*cpus)
 
     if runtime==None:
         if n_jobs==None:
@@ -175,23 +340,41 @@ def get_slurm_params(n,runtime=None,mem=None,n_jobs=None):
                 n_per_job = 500
 
             n_jobs = int(n/n_per_job)
+            if costs is not None:
+                #long enough to amortize scheduling and startup, short enough to backfill
+                n_jobs = min(n_jobs, int(total/(cpus*cost.TASK_MIN_SECONDS)))
+                n_jobs = min(max(n_jobs, int(math.ceil(2*total/(cpus*cost.TASK_MAX_SECONDS)))), n)
+            if max_jobs != None and n_jobs > max_jobs:
+                n_jobs = max_jobs
+                n_per_job = int(math.ceil(n/n_jobs))
         else:
             n_per_job = int(n/n_jobs) #round down (add one later to calc for time)
             if n_per_job == 0:
                 n_per_job = 1
 
-        sec = 2*n_per_job*5 #(seconds)
+        if costs is None:
+            sec = 2*int(math.ceil(n_per_job/cpus))*5 #(seconds)
+        else:
+            #files claimed from the work queue even out within one file of the mean load, fixed batches are sized
+            #again from the largest one once split (see get_batch_runtime)
+            sec = int(2*(total/(max(n_jobs,1)*cpus) + longest))
         if sec < 300:
             sec = 300
-        runtime = str(datetime.timedelta(seconds=sec))
+        runtime = cost.format_time(sec)
 
     else:
-        if len(runtime.split(':')) == 3:
-            sec = int(runtime.split(':')[0])*3600 + int(runtime.split(':')[1])*60 + int(runtime.split(':')[2])
-        elif len(runtime.split(':')) == 2:
-            sec = int(runtime.split(':')[1])*60 + int(runtime.split(':')[2])
+        sec = cost.parse_time(runtime)
         if n_jobs == None:
-            n_jobs = int((10*n)/sec)
+            if costs is None:
+                n_jobs = int((10*n)/(sec*cpus))
+            else:
+                n_jobs = min(max(int((2*total)/(sec*cpus)), 1), n)
+            if max_jobs != None and n_jobs > max_jobs:
+                print('Can only submit {} job(s), instead of {}: runtime may be too short.'.format(max_jobs,n_jobs))
+                n_jobs = max_jobs
+        if costs is not None and longest > sec:
+            print('Warning: the longest file is predicted to take {}, more than --time {}.'.format(
+                cost.format_time(longest), runtime))
 
     if n_jobs == 0:
                 n_jobs = 1
@@ -222,8 +405,99 @@ def split_list(n,ls):
         chunks.append(ls[i:(i + m)])
     return chunks
 
-def get_batches(n_jobs, files, conf_files):
+def get_file_weights(files, packing='size', headers=None):
+    """Get a processing weight for each input file, used to balance batches.
+    Parameters
+    ----------
+    files : list
+        List of input_files.
+    packing : str
+        'size' to weight by size on disk, 'voxels' to weight by voxels x timepoints from the header.
+    headers : dict, None
+        Output of cost.read_headers for the files, read from the files if None.
+    Returns
+    -------
+    list
+        Weight of each file.
+    Raises
+    ------
+    ValueError
+       packing is not one of 'size' or 'voxels'.
+    """
+    if packing == 'size':
+        return [os.path.getsize(f) for f in files]
+    elif packing == 'voxels':
+        sizes = [cost.get_size(headers[f][0]) if headers is not None else cost.get_shape(f) for f in files]
+        return [n_voxels * n_timepoints for n_voxels, n_timepoints in sizes]
+    else:
+        raise ValueError("packing must be one of 'size' or 'voxels'.")
+
+def pack_list(n,weights):
+    """Split indices of weighted items into n chunks of approximately equal total weight.
+    Uses longest-processing-time-first greedy packing: items are taken heaviest first and each
+    goes into the currently lightest chunk. Indices within a chunk keep their original order.
+    Parameters
+    ----------
+    n : int
+        Number of chunks.
+    weights : list
+        Weight of each item.
+    Returns
+    -------
+    list
+        List of n chunks of indices into weights.
+    """
+    chunks = [[] for i in range(n)]
+    heap = [(0,i) for i in range(n)]
+    order = sorted(range(len(weights)), key=lambda i: weights[i], reverse=True)
+    for idx in order:
+        load, i = heapq.heappop(heap)
+        chunks[i].append(idx)
+        heapq.heappush(heap, (load + weights[idx], i))
+    return [sorted(c) for c in chunks]
+
+def get_file_sizes(files, conf_files):
+    """Get the size on disk of each input file with its regressor file.
+    Parameters
+    ----------
+    files : list
+        List of input_files.
+    conf_files : list
+        List of corresponding regressor_files, may be empty.
+    Returns
+    -------
+    list
+        Bytes of each input file and its regressor file.
+    """
+    sizes = [os.path.getsize(f) for f in files]
+    if len(conf_files) != 0:
+        sizes = [s + os.path.getsize(c) for s, c in zip(sizes, conf_files)]
+    return sizes
+
+def get_batch_runtime(batches,costs=None,cpus=1):
+    """Get the time per job from the largest batch, with the margin of get_slurm_params (twice the prediction).
+    Parameters
+    ----------
+    batches : list
+        List of batches of input files.
+    costs : dict, None
+        Predicted (seconds, bytes) per input file. If None, ~5s per file.
+    cpus : int
+        Number of CPUs per job, each processing one file at a time.
+    Returns
+    -------
+    str
+        Time per job, formatted for SLURM.
+    """
+    if costs is None:
+        sec = max([2*int(math.ceil(len(b)/cpus))*5 for b in batches])
+    else:
+        sec = max([2*cost.get_makespan([costs[f][0] for f in b], cpus) for b in batches if len(b) != 0] + [0])
+    return cost.format_time(max(sec, 300))
+
+def get_batches(n_jobs, files, conf_files, weights=None, sizes=None, max_bytes=None):
     """Split input and regressor files into batches.
+    With max_bytes, more batches are made until the files of each batch fit in max_bytes (see --stage_inputs).
     Parameters
     ----------
     n_jobs : int
@@ -232,15 +506,55 @@ def get_batches(n_jobs, files, conf_files):
         List of input_files.
     conf_files : list
         List of corresponding regressor_files.
+    weights : list, None
+        Weight of each input file (see get_file_weights). If None, files are split by count,
+        otherwise batches are packed to have approximately equal total weight.
+    sizes : list, None
+        Bytes of each input file with its regressor file (see get_file_sizes), read from disk if None.
+    max_bytes : int, None
+        Maximum bytes of the files of a batch.
     Returns
     -------
     list
-        List of n_jobs batches of input_files.
+        List of n_jobs batches of input_files, or more to fit in max_bytes.
     list
-        List of n_jobs batches of corresponding regressor_files. If input was empty list, this will be a list of n_jobs empty lists.
+        List of corresponding batches of regressor_files. If input was empty list, this will be a list of empty lists.
+    Raises
+    ------
+    ValueError
+       A file alone does not fit in max_bytes.
     """
-    batches = split_list(n_jobs,files)
-    batches_conf = split_list(n_jobs,conf_files)
+    if max_bytes is None or len(files) == 0:
+        return _split_batches(n_jobs, files, conf_files, weights)
+    if sizes is None:
+        sizes = get_file_sizes(files, conf_files)
+    size_by_file = dict(zip(files, sizes))
+    if max(sizes) > max_bytes:
+        largest = files[sizes.index(max(sizes))]
+        raise ValueError("{} does not fit in the local disk of a job ({}).".format(largest, cost.format_mem(max_bytes)))
+    n = max(n_jobs, min(len(files), int(math.ceil(sum(sizes) / max_bytes))))
+    while True:
+        batches, batches_conf = _split_batches(n, files, conf_files, weights)
+        largest = max([sum([size_by_file[f] for f in b]) for b in batches])
+        #one file per batch always fits
+        if largest <= max_bytes or n >= len(files):
+            return batches, batches_conf
+        #uneven batches need more than the total alone
+        n = min(len(files), max(n + 1, int(math.ceil(n * largest / max_bytes))))
+
+def _split_batches(n_jobs, files, conf_files, weights=None):
+    """Split input and regressor files into n_jobs batches, by count or by weight (see get_batches)."""
+    if weights is None:
+        batches = split_list(n_jobs,files)
+        batches_conf = split_list(n_jobs,conf_files)
+        return batches, batches_conf
+
+    chunks = pack_list(n_jobs,weights)
+    batches = [[files[i] for i in c] for c in chunks]
+    if len(conf_files) != 0:
+        batches_conf = [[conf_files[i] for i in c] for c in chunks]
+    else:
+        batches_conf = [[] for i in range(n_jobs)]
     return batches, batches_conf
 
 def log_batches(batches,out_path):
@@ -257,8 +571,8 @@ def log_batches(batches,out_path):
         json.dump(d, json_file)
 
 def make_config(batches,batches_conf,params,out_path):
-    """Make config file for each SLURM job with appropriate input and regressor files and params from provided config file.
-    These files will get deleted by the SLURM job once it has been run.
+    """Write the params shared by all SLURM jobs, and the input and regressor files of each batch, for read_batch.
+    Verbose is switched on so that nixtract-slurm-worker can time each file.
     Parameters
     ----------
     batches : list
@@ -270,16 +584,92 @@ def make_config(batches,batches_conf,params,out_path):
     out_path : str
         Path to output dir.
     """
-    for i in range(len(batches)):
-        p = params.copy()
-        p['input_files'] = batches[i]
-        p['regressor_files'] = batches_conf[i]
-        with open(os.path.join(out_path,'config_{}.json'.format(i)), 'w') as json_file:
-            json.dump(p, json_file)
-    
-
-def make_sh(account,runtime,mem,n_jobs,out_path):
+    p = dict([(k,v) for k,v in params.items() if k not in ['input_files','regressor_files']])
+    p['verbose'] = True
+    with open(os.path.join(out_path,PARAMS_FILE), 'w') as json_file:
+        json.dump(p, json_file)
+
+    offsets = [0]
+    with open(os.path.join(out_path,BATCHES_FILE), 'wb') as f:
+        for i in range(len(batches)):
+            for j in range(len(batches[i])):
+                line = str(batches[i][j]) if len(batches_conf[i]) == 0 else '{}\t{}'.format(batches[i][j],batches_conf[i][j])
+                f.write((line + '\n').encode())
+            offsets.append(f.tell())
+    with open(os.path.join(out_path,OFFSETS_FILE), 'wb') as f:
+        f.write(struct.pack('<{}q'.format(len(offsets)),*offsets))
+
+def read_batch(out_path,batch):
+    """Read the input and regressor files of one batch written by make_config.
+    Parameters
+    ----------
+    out_path : str
+        Path to output dir.
+    batch : int
+        Batch number.
+    Returns
+    -------
+    list
+        List of input_files of the batch.
+    list
+        List of accompanying regressor_files, empty if there are none.
+    """
+    logs = os.path.join(out_path,'logs')
+    with open(os.path.join(logs,OFFSETS_FILE), 'rb') as f:
+        f.seek(8*batch)
+        start, end = struct.unpack('<2q', f.read(16))
+    with open(os.path.join(logs,BATCHES_FILE), 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode().splitlines()
+    files = [l.split('\t')[0] for l in lines]
+    conf = [l.split('\t')[1] for l in lines if '\t' in l]
+    return files, conf
+
+
+def plan_submissions(n_jobs,max_array_size=1000,max_concurrent=None):
+    """Split the jobs into as few job arrays as the scheduler allows (MaxArraySize).
+    Array task ids must be below MaxArraySize, so each array runs the batches from its offset.
+    With max_concurrent, each array gets a share of it as throttle (at least 1). With more arrays than max_concurrent,
+    only max_concurrent arrays run at a time: each later array starts after the one max_concurrent before it (its
+    'after'), so the total number of running tasks never exceeds max_concurrent.
+    Parameters
+    ----------
+    n_jobs : int
+        Number of jobs/batches.
+    max_array_size : int
+        Maximum number of tasks in one job array.
+    max_concurrent : int, None
+        Maximum number of tasks running at the same time over all arrays (the %N throttle), shared between the arrays.
+    Returns
+    -------
+    list
+        List of dicts with the 'offset' of the first batch, the number of tasks ('size'), the 'throttle' (or None) of
+        each array and the index of the array it starts after ('after', or None).
+    """
+    offsets = list(range(0,n_jobs,max_array_size))
+    #arrays running at the same time, each later one takes the place of an earlier one
+    slots = len(offsets) if max_concurrent == None else max(1, min(len(offsets), max_concurrent))
+    submissions = []
+    for k,offset in enumerate(offsets):
+        throttle = None
+        if max_concurrent != None:
+            throttle = max(1, max_concurrent//slots + (k % slots < max_concurrent % slots))
+        after = k - slots if k >= slots else None
+        submissions.append({'offset':offset,'size':min(max_array_size,n_jobs - offset),'throttle':throttle,'after':after})
+    return submissions
+
+def get_array_spec(size,throttle=None):
+    """Format the --array option of a job array of size tasks, e.g. '0-99%10'."""
+    spec = '0-{}'.format(size - 1)
+    if throttle != None:
+        spec += '%{}'.format(throttle)
+    return spec
+
+def make_sh(account,runtime,mem,n_jobs,out_path,throttle=None,cpus=1,queue=False,shard=False,stage_outputs=False,backend='nilearn',prefetch=0,stage_inputs=None):
     """Make .sh file to submit SLURM jobs.
+    Each task runs the batch SLURM_ARRAY_TASK_ID + NSLURM_OFFSET (set by submit_jobs when the jobs are split over several
+    arrays) and writes its output to logs/slurm_output/batch_<batch>.out. Messages from SLURM itself go to slurm_<job>_<task>.out.
+    The files of the batch are read from the batch table written by make_config.
     Parameters
     ----------
     account : str
@@ -292,32 +682,288 @@ def make_sh(account,runtime,mem,n_jobs,out_path):
         Number of SLURM jobs to submit.
     out_path : str
         Path to output dir.
+    throttle : int, None
+        Maximum number of jobs running at the same time.
+    cpus : int
+        Number of CPUs per job. nixtract-slurm-worker processes this many files at the same time.
+    queue : bool
+        Jobs claim files from the work queue (see workqueue.make_queue) until it is empty or their time is nearly up.
+    shard : bool
+        Write outputs in the sharded layout (see index.get_output).
+    stage_outputs : bool
+        Write outputs to $SLURM_TMPDIR (/tmp if not set) and move them to out_path in groups.
+    backend : str
+        Extraction backend of the worker (see extract.BACKENDS).
+    prefetch : int
+        Number of inputs the worker reads ahead (see extract.run_pipeline).
+    stage_inputs : int, None
+        If given, bytes of node-local disk to request: the files of the batch are copied to $SLURM_TMPDIR (/tmp if not
+        set) before extraction and the outputs moved to out_path at the end.
     """
     src = Template("#!/bin/bash\n"
                     "#SBATCH --job-name=nixtract-slurm\n"
                     "#SBATCH --time=$time\n"
                     "#SBATCH --mem=$mem\n"
                     "#SBATCH --account=$account\n"
-                    "#SBATCH --array=0-$n_jobs\n"
-                    "#SBATCH -o $out_path/logs/slurm_output/batch_%a.out\n"
-                    "$command -c $out_path/logs/config_$${SLURM_ARRAY_TASK_ID}.json $out_path\n"
-                    "rm $out_path/logs/config_*.json")
-
-    d = {'account':account,'time': runtime,'mem': mem,'n_jobs': (n_jobs-1),'out_path':out_path,'command':'nixtract-nifti'}
+                    "#SBATCH --array=$array\n"
+                    "$cpus"
+                    "$tmp"
+                    "#SBATCH -o $out_path/logs/slurm_output/slurm_%A_%a.out\n"
+                    "BATCH=$$((SLURM_ARRAY_TASK_ID + $${NSLURM_OFFSET:-0}))\n"
+                    "exec >> $out_path/logs/slurm_output/batch_$${BATCH}.out 2>&1\n"
+                    "$command -c $out_path/logs/$params --batch $${BATCH} $out_path\n")
+
+    d = {'account':account,'time': runtime,'mem': mem,'array': get_array_spec(n_jobs,throttle),
+         'cpus': '#SBATCH --cpus-per-task={}\n'.format(cpus) if cpus > 1 else '',
+         'tmp': '#SBATCH --tmp={}\n'.format(cost.format_mem(stage_inputs)) if stage_inputs is not None else '','out_path':out_path,'command':'nixtract-slurm-worker','params':PARAMS_FILE}
+    if queue:
+        d['command'] += ' --queue --time_limit {}'.format(cost.parse_time(runtime))
+    if shard:
+        d['command'] += ' --shard_outputs'
+    if stage_outputs or stage_inputs is not None:
+        d['command'] += ' --scratch ${SLURM_TMPDIR:-/tmp}'
+    if stage_inputs is not None:
+        d['command'] += ' --stage_inputs'
+    if backend != 'nilearn':
+        d['command'] += ' --backend {}'.format(backend)
+    if prefetch > 0:
+        d['command'] += ' --prefetch {}'.format(prefetch)
     result = src.substitute(d)
     sh = open(os.path.join(out_path,"logs/submit.sh"), "w")
     sh.write(result)
     sh.close()
 
-def submit_jobs(out_path):
+def get_plan(batches,costs,runtime,mem,cpus=1,max_concurrent=None):
+    """Predict the time of each job and of the whole submission.
+    Parameters
+    ----------
+    batches : list
+        List of batches of input files.
+    costs : dict, None
+        Predicted (seconds, bytes) per input file. If None, cost.STATIC_SECONDS per file.
+    runtime : str
+        Time per job, formatted for SLURM.
+    mem : str
+        Memory per job, formatted for SLURM.
+    cpus : int
+        Number of CPUs per job, each processing one file at a time.
+    max_concurrent : int, None
+        Maximum number of jobs running at the same time.
+    Returns
+    -------
+    dict
+        'seconds' of each job, 'largest' job (batch number, files and seconds), 'makespan' in seconds, predicted
+        'core_hours' used and 'requested_core_hours', number of jobs predicted to run 'over_time', and the inputs.
+    """
+    seconds = []
+    for batch in batches:
+        secs = [costs[f][0] if costs is not None else cost.STATIC_SECONDS for f in batch]
+        #files are handed to the CPUs one at a time: at least the longest file, at best an even share
+        seconds.append(max([sum(secs)/cpus] + secs) if len(secs) != 0 else 0.)
+    largest = max(range(len(batches)), key=lambda i: seconds[i])
+    limit = cost.parse_time(runtime)
+    return {'n_jobs':len(batches),'n_files':sum([len(b) for b in batches]),'runtime':runtime,'mem':mem,'cpus':cpus,
+            'max_concurrent':max_concurrent,'seconds':seconds,
+            'largest':{'batch':largest,'n_files':len(batches[largest]),'seconds':seconds[largest]},
+            'makespan':cost.get_makespan(seconds,max_concurrent),'core_hours':sum(seconds)*cpus/3600.,
+            'requested_core_hours':len(batches)*cpus*limit/3600.,'over_time':len([s for s in seconds if s > limit])}
+
+def print_plan(plan):
+    """Print the output of get_plan."""
+    print('Plan for {} file(s) in {} job(s), with {} CPU(s), time={} and memory={} each:'.format(
+        plan['n_files'],plan['n_jobs'],plan['cpus'],plan['runtime'],plan['mem']))
+    seconds = sorted(plan['seconds'])
+    print('  Predicted time per job: median {}, max {} (batch {}, {} file(s)).'.format(
+        cost.format_time(seconds[len(seconds)//2]),cost.format_time(plan['largest']['seconds']),
+        plan['largest']['batch'],plan['largest']['n_files']))
+    if plan['max_concurrent'] != None:
+        print('  Predicted makespan: {} with at most {} job(s) at a time, not counting time in the queue.'.format(
+            cost.format_time(plan['makespan']),plan['max_concurrent']))
+    else:
+        print('  Predicted makespan: {} if all jobs run at once, not counting time in the queue.'.format(
+            cost.format_time(plan['makespan'])))
+    print('  Core-hours: {:.1f} predicted, {:.1f} requested.'.format(plan['core_hours'],plan['requested_core_hours']))
+    if plan['over_time'] != 0:
+        print('  Warning: {} job(s) predicted to take longer than time={}.'.format(plan['over_time'],plan['runtime']))
+
+def submit_jobs(out_path,submissions=None,command='sbatch',dependency=None):
     """Submit the .sh file in the output dir to SLURM.
     Parameters
     ----------
     out_path : str
         Path to output dir (containing the .sh file).
+    submissions : list, None
+        Job arrays from plan_submissions. If None or a single array, the .sh file is submitted as is.
+    command : str
+        sbatch command.
+    dependency : str, None
+        SLURM dependency of the arrays, e.g. 'afterany:123'.
+    Returns
+    -------
+    list
+        Job ids of the submitted arrays.
     """
     p = os.path.join(out_path,'logs/submit.sh')
-    os.system('sbatch {}'.format(p))
+    if submissions == None or len(submissions) == 1:
+        submissions = [None]
+    #job id of each array, None if its submission failed
+    ids = []
+    for s in submissions:
+        dependencies = [dependency] if dependency != None else []
+        if s != None and s['after'] != None and ids[s['after']] != None:
+            dependencies.append('afterany:{}'.format(ids[s['after']]))
+        cmd = command
+        if len(dependencies) != 0:
+            cmd += ' --dependency={}'.format(','.join(dependencies))
+        if s == None:
+            cmd += ' --parsable {}'.format(p)
+        else:
+            cmd += ' --parsable --array={} --export=ALL,NSLURM_OFFSET={} {}'.format(get_array_spec(s['size'],s['throttle']),s['offset'],p)
+        stdout = subprocess.run(cmd,shell=True,stdout=subprocess.PIPE,universal_newlines=True).stdout.strip()
+        #--parsable prints "jobid" or "jobid;cluster"
+        ids.append(stdout.split(';')[0] if stdout != '' else None)
+        if ids[-1] != None:
+            print('Submitted batch job {}'.format(ids[-1]))
+    return [i for i in ids if i != None]
+
+def submit(args, params, runtime=None, mem=None, n_jobs=None, rerun_completed=False, files_per_job=None):
+    """Plan and submit jobs for the input files that are not completed yet.
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments.
+    params : dict
+        Parameters from read_config.
+    runtime : str, None
+        Time per job, predicted if None.
+    mem : str, None
+        Memory per job, predicted if None.
+    n_jobs : int, None
+        Number of jobs, chosen from the time per job if None.
+    rerun_completed : bool
+        Process all input files, including completed ones.
+    files_per_job : int, None
+        If given, sets the number of jobs from the number of files to process instead of n_jobs.
+    Returns
+    -------
+    dict, None
+        Submitted 'job_ids', 'runtime', 'mem', 'n_jobs' and 'n_files', None if there was nothing to submit or with
+        --dry_run (the plan is printed instead).
+    """
+    input_files = params['input_files']
+    confound_files = params['regressor_files']
+
+    #Check which files have already been completed
+    if not rerun_completed:
+        print('Making todo list...')
+        input_filt, confound_filt = get_todo(input_files, confound_files, args.out_path, params, args.verify_completed)
+        input_files = input_filt
+        confound_files = confound_filt
+        print('Processing {} subject(s).'.format(len(input_files)))
+    if len(input_files) == 0:
+        print('Nothing to do.')
+        return None
+
+    costs = None
+    predicted = None
+    #shape and grid of each input file, read once for the costs, the batch weights and the atlas cache
+    headers = None
+    if not args.static_resources and (runtime is None or mem is None or args.dry_run):
+        #smoothing and single region voxels go through the masker whatever the backend
+        backend = 'nilearn' if params.get('smoothing_fwhm') or params.get('as_voxels') else args.backend
+        history = cost.load_history(os.path.join(args.out_path, 'logs/history'), params.get('roi_file'), backend)
+        model = cost.fit_model(history)
+        if model is not None:
+            print('Calibrating resources on {} file(s) from previous runs...'.format(model['n']))
+        print('Reading headers to estimate resources...')
+        headers = cost.read_headers(input_files)
+        predicted = cost.estimate_costs(input_files, params.get('roi_file'), model, backend, args.prefetch, headers)
+        #the plan of a dry run uses the predictions even when time and memory are given, not the resources
+        if runtime is None or mem is None:
+            costs = predicted
+
+    cpus = args.cpus_per_task
+    if cpus > 1 and mem is not None and costs:
+        #only as many files at the same time as fit in memory
+        n_workers = cost.get_n_workers(mem, max([c[1] for c in costs]), cpus)
+        if n_workers < cpus:
+            print('Only {} file(s) fit in mem={} at the same time, using {} CPU(s) per job.'.format(n_workers,mem,n_workers))
+            cpus = n_workers
+
+    missing = []
+    if not args.no_atlas_cache:
+        missing = atlas.get_missing(input_files, params, args.out_path, headers)
+    #the prep and cleanup jobs count against MaxSubmitJobs too
+    max_jobs = args.max_jobs
+    if max_jobs is not None:
+        max_jobs -= (len(missing) != 0) + 1
+        if max_jobs < 1:
+            raise ValueError("--max_jobs leaves no room for the extraction jobs next to the prep and cleanup jobs.")
+
+    if files_per_job is not None:
+        n_jobs = int(math.ceil(len(input_files)/files_per_job))
+    size_runtime = runtime is None
+    runtime, mem, n_jobs = get_slurm_params(len(input_files),runtime,mem,n_jobs,costs,max_jobs,cpus)
+
+    weights = None
+    if args.queue and args.dry_run:
+        #jobs claiming files heaviest first end up close to packed batches
+        weights = [c[0] for c in predicted] if predicted else [os.path.getsize(f) for f in input_files]
+    elif args.packing != 'count' and not args.queue:
+        if args.packing == 'voxels' and headers is None:
+            headers = cost.read_headers(input_files)
+        weights = get_file_weights(input_files, args.packing, headers)
+    sizes, max_bytes = None, None
+    if args.stage_inputs:
+        sizes = get_file_sizes(input_files, confound_files)
+        max_bytes = int(cost.parse_mem(args.local_disk) / LOCAL_DISK_SAFETY)
+    #with a work queue, every job gets the same config and claims its files from the queue
+    input_batches, confound_batches = [[]]*n_jobs, [[]]*n_jobs
+    if not args.queue or args.dry_run:
+        input_batches, confound_batches = get_batches(n_jobs, input_files, confound_files, weights, sizes, max_bytes)
+    if len(input_batches) > n_jobs:
+        n_jobs = len(input_batches)
+        print('Using {} job(s) so that the files of each batch fit in {} of local disk.'.format(n_jobs,args.local_disk))
+        if max_jobs is not None and n_jobs > max_jobs:
+            raise ValueError("The batches do not fit in --local_disk with at most --max_jobs jobs.")
+    if size_runtime and not args.queue:
+        #batches split by count put the remainder in the last one, so the largest batch sets the time
+        runtime = get_batch_runtime(input_batches, dict(zip(input_files, costs)) if costs else None, cpus)
+    submissions = plan_submissions(n_jobs,args.max_array_size,args.max_concurrent)
+
+    if args.dry_run:
+        costs_by_file = dict(zip(input_files, predicted)) if predicted else None
+        print_plan(get_plan(input_batches,costs_by_file,runtime,mem,cpus,args.max_concurrent))
+        print('Nothing was submitted (--dry_run).')
+        return None
+
+    print('Submitting {} SLURM job(s) in {} array(s), with time={} and memory={} each...'.format(n_jobs,len(submissions),runtime,mem))
+    if args.queue:
+        workqueue.make_queue(input_files, confound_files, args.out_path, workqueue.get_order(input_files, costs))
+    else:
+        log_batches(input_batches, args.out_path)
+
+    tmp = None
+    if args.stage_inputs:
+        size_by_file = dict(zip(input_files, sizes))
+        tmp = LOCAL_DISK_SAFETY * max([sum([size_by_file[f] for f in b]) for b in input_batches])
+    make_config(input_batches,confound_batches, params, os.path.join(args.out_path,"logs"))
+    make_sh(args.account,runtime,mem,submissions[0]['size'],args.out_path,submissions[0]['throttle'],cpus,args.queue,args.shard_outputs,args.stage_outputs,args.backend,args.prefetch,tmp)
+
+    #prep -> extraction arrays -> cleanup, chained with dependencies
+    prep_id = None
+    if len(missing) != 0:
+        print('Resampling atlas to {} input grid(s) in a prep job...'.format(len(missing)))
+        stages.save_prep(missing, args.out_path)
+        prep_time, prep_mem = stages.get_prep_resources(missing)
+        prep_id = stages.submit_stage(args.out_path,args.account,'prep',prep_time,prep_mem)
+    job_ids = submit_jobs(args.out_path,submissions,dependency='afterany:{}'.format(prep_id) if prep_id != None else None)
+    cleanup_id = None
+    if len(job_ids) != 0:
+        cleanup_time, cleanup_mem = stages.get_cleanup_resources(len(params['input_files']), args.store)
+        cleanup_id = stages.submit_stage(args.out_path,args.account,'cleanup',cleanup_time,cleanup_mem,'afterany:{}'.format(':'.join(job_ids)),options=['--store'] if args.store else [])
+    job_ids = [j for j in [prep_id] + job_ids + [cleanup_id] if j != None]
+    return {'job_ids':job_ids,'runtime':runtime,'mem':mem,'n_jobs':n_jobs,'n_files':len(input_files)}
 
 def test_import():
     try:
@@ -326,11 +972,15 @@ def test_import():
         raise ImportError("nixtract must be installed to use nixtract-slurm. See documentation for installation instructions.")
 
 def main():
-    """Entry point to nixtract-slurm."""
+    """Entry point to nixtract-slurm. "nixtract-slurm report out_path" summarizes the telemetry of the jobs instead."""
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        return telemetry.main(sys.argv[2:])
     parser = generate_parser()
     args = parser.parse_args()
 
     test_import()
+    if args.store:
+        store.test_h5py()
     
     if not os.path.exists(args.out_path):
         raise ValueError("Provided out_path does not exist.")
@@ -339,10 +989,10 @@ def main():
     if not os.path.exists(args.config_path):
         raise ValueError("Provided config_path does not exist.")
 
-    params = read_config(args.config_path)
-    input_files = check_glob(params['input_files'])
-    confound_files = check_glob(params['regressor_files'])
-    print('Found {} input file(s), and {} regressor file(s).'.format(len(input_files),len(confound_files)))
+    if args.prefetch > 0 and (args.queue or args.cpus_per_task > 1):
+        raise ValueError("--prefetch only works with fixed batches and one CPU per job (not with --queue or --cpus_per_task).")
+    if args.stage_inputs and args.queue:
+        raise ValueError("--stage_inputs copies the files of fixed batches, it does not work with --queue.")
 
     # Create logs dir.
     print('Looking for logs...')
@@ -354,20 +1004,18 @@ def main():
     if not os.path.isdir(os.path.join(args.out_path, 'logs/slurm_output')):
         os.makedirs(os.path.join(args.out_path, 'logs/slurm_output'))
 
-    #Check which files have already been completed
-    if not args.rerun_completed:
-        print('Making todo list...')
-        input_filt, confound_filt = get_todo(input_files, confound_files, args.out_path)
-        input_files = input_filt
-        confound_files = confound_filt
-        print('Processing {} subject(s).'.format(len(input_files)))
-    
-    runtime, mem, n_jobs = get_slurm_params(len(input_files), args.time,args.mem,args.n_jobs)
-    print('Submitting {} SLURM job(s), with time={} and memory={} each...'.format(n_jobs,runtime,mem))
+    inventory_path = None
+    if not args.rescan_inputs:
+        inventory_path = os.path.join(args.out_path, 'logs/inventory.json')
+    params = read_config(args.config_path, inventory_path)
+    print('Found {} input file(s), and {} regressor file(s).'.format(len(params['input_files']),len(params['regressor_files'])))
 
-    input_batches, confound_batches = get_batches(n_jobs, input_files, confound_files)
-    log_batches(input_batches, args.out_path)
+    job = submit(args, params, args.time, args.mem, args.n_jobs, args.rerun_completed)
+    if args.supervise and job is not None:
+        def resubmit(runtime, mem, files_per_job):
+            return submit(args, params, runtime, mem, files_per_job=files_per_job)
 
-    make_config(input_batches,confound_batches, params, os.path.join(args.out_path,"logs"))
-    make_sh(args.account,runtime,mem,n_jobs,args.out_path)
-    submit_jobs(args.out_path)
+        def remaining():
+            return len(get_todo(params['input_files'], params['regressor_files'], args.out_path, params)[0])
+
+        supervisor.supervise(resubmit, remaining, job, args.max_retries, args.poll_interval)
@@ -0,0 +1,182 @@
+import os
+import glob
+import json
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+#Directory listings are I/O bound (network filesystems), so many more threads than cores are useful.
+N_THREADS = 16
+
+def _list_matches(dirname, component, dirs_only):
+    """List the entries of a directory matching one glob pattern component.
+    Hidden entries are only matched by components starting with '.', as with glob.
+
+    Parameters
+    ----------
+    dirname : str
+        Directory to list.
+    component : str
+        Pattern for the entry names (no separators).
+    dirs_only : bool
+        Only keep directories (for intermediate components).
+    Returns
+    -------
+    list
+        Paths of the matching entries, empty if dirname can't be listed.
+    """
+    matches = []
+    try:
+        with os.scandir(dirname or os.curdir) as it:
+            for entry in it:
+                if entry.name.startswith('.') and not component.startswith('.'):
+                    continue
+                if not fnmatch.fnmatchcase(entry.name, component):
+                    continue
+                if dirs_only:
+                    try:
+                        if not entry.is_dir():
+                            continue
+                    except OSError:
+                        continue
+                matches.append(os.path.join(dirname, entry.name))
+    except OSError:
+        pass
+    return matches
+
+def get_mtime(path):
+    """Get the modification time of a path in nanoseconds, None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def iter_glob(pattern, n_threads=N_THREADS, dirs=None):
+    """Expand a glob pattern, listing the directories of each level concurrently and yielding matches as they are
+    found. Matches the same files as glob.glob(pattern) (non recursive, '**' behaves as '*'), in no particular order.
+
+    Parameters
+    ----------
+    pattern : str
+        Glob pattern.
+    n_threads : int
+        Number of directories listed at the same time.
+    dirs : dict, None
+        If given, filled with the modification time of every directory the result depends on
+        (see inventory_is_valid).
+    Yields
+    ------
+    str
+        Matching path.
+    """
+    if not glob.has_magic(pattern):
+        if dirs is not None:
+            d = os.path.dirname(pattern) or os.curdir
+            dirs[d] = get_mtime(d)
+        if os.path.lexists(pattern):
+            yield pattern
+        return
+
+    drive, rest = os.path.splitdrive(pattern)
+    components = rest.split(os.sep)
+    #leading literal components give the directory to start from
+    k = 0
+    while not glob.has_magic(components[k]):
+        k += 1
+    base = drive + os.sep.join(components[:k])
+    if k > 0 and base == drive:
+        base = drive + os.sep
+    components = [c for c in components[k:] if c != '']
+
+    frontier = [base]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for depth, component in enumerate(components):
+            last = depth == len(components) - 1
+            if dirs is not None:
+                #entries appearing in or disappearing from any of these change its mtime
+                dirs.update(zip(frontier, executor.map(get_mtime, [d or os.curdir for d in frontier])))
+            if not glob.has_magic(component):
+                frontier = [os.path.join(d, component) for d in frontier]
+                if last:
+                    for path in frontier:
+                        if os.path.lexists(path):
+                            yield path
+                continue
+
+            futures = [executor.submit(_list_matches, d, component, not last) for d in frontier]
+            frontier = []
+            for future in as_completed(futures):
+                if last:
+                    for path in future.result():
+                        yield path
+                else:
+                    frontier.extend(future.result())
+
+def inventory_is_valid(dirs, n_threads=N_THREADS):
+    """Check that none of the directories a glob result depends on have changed, with concurrent stats.
+
+    Parameters
+    ----------
+    dirs : dict
+        Mapping from directory to modification time, filled by iter_glob.
+    n_threads : int
+        Number of stats at the same time.
+    Returns
+    -------
+    bool
+        True if the result of the glob is unchanged.
+    """
+    paths = list(dirs)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        mtimes = executor.map(get_mtime, [p or os.curdir for p in paths])
+        return all([dirs[p] == m for p, m in zip(paths, mtimes)])
+
+def load_inventory(path, key):
+    """Get a cached glob expansion, if it is still valid.
+
+    Parameters
+    ----------
+    path : str
+        Path to the inventory file (logs/inventory.json).
+    key : str
+        Key of the expansion, from the glob patterns.
+    Returns
+    -------
+    dict, None
+        Cached entry with 'dirs', 'input_files' and 'regressor_files', None if missing or out of date.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            inventory = json.load(f)
+    except ValueError:
+        return None
+    entry = inventory.get(key)
+    if entry is None or not inventory_is_valid(entry['dirs']):
+        return None
+    return entry
+
+def save_inventory(path, key, entry):
+    """Atomically add a glob expansion to the inventory file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the inventory file.
+    key : str
+        Key of the expansion, from the glob patterns.
+    entry : dict
+        Entry with 'dirs', 'input_files' and 'regressor_files'.
+    """
+    inventory = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                inventory = json.load(f)
+        except ValueError:
+            pass
+    inventory[key] = entry
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(inventory, f)
+    os.replace(tmp, path)
@@ -0,0 +1,193 @@
+import os
+import glob
+import json
+import shlex
+import subprocess
+import nibabel as nib
+from argparse import ArgumentParser
+from . import atlas
+from . import cost
+from . import index
+from . import store
+
+#Stages of a submission, chained with SLURM dependencies so the pipeline runs without the login node:
+#  prep     resamples the atlas to the input grids (atlas cache), only submitted if something is missing.
+#  extract  the job arrays, start after prep has ended (afterany: if prep fails, jobs resample the atlas themselves).
+#  cleanup  after all arrays have ended (afterany), removes batch configs left by killed --subprocess workers and merges
+#           the completion index.
+#           With --store, also moves the completed outputs into the consolidated store (see store.py).
+PREP_FILE = 'logs/atlas/todo.json'
+
+#Resources of the prep job (see get_prep_resources). nilearn resamples one atlas at a time, holding the source and the
+#resampled maps as float64 with a working copy, so memory is set by the largest atlas and time grows with the values
+#resampled over all the missing grids. A 4D probabilistic atlas (e.g. DiFuMo) counts every one of its maps.
+PREP_SECONDS = 600
+PREP_SEC_PER_VALUE = 1e-7
+PREP_MEM = 2**30
+PREP_BYTES_PER_VALUE = 16
+
+#Resources of the cleanup job, which reads every completion record, and with --store every new output, so they grow
+#with the number of input files (see get_cleanup_resources). The store is copied once per round (see store.aggregate).
+CLEANUP_SECONDS = 900
+CLEANUP_SEC_PER_FILE = 0.01
+STORE_SEC_PER_FILE = 0.1
+CLEANUP_MEM = 2**30
+CLEANUP_BYTES_PER_FILE = 2**11
+
+def generate_parser():
+    parser = ArgumentParser()
+    parser.add_argument("stage",help='Required: Stage to run. "aggregate" moves the completed outputs into the consolidated store.',choices=['prep','cleanup','aggregate'])
+    parser.add_argument("out_path",help='Required: Path to output directory.')
+    parser.add_argument("--store",help='Flag to also aggregate the outputs into the consolidated store during cleanup.',dest='store',action='store_true')
+    return parser
+
+def save_prep(missing, out_path):
+    """Write the list of atlases for the prep job to resample.
+
+    Parameters
+    ----------
+    missing : list
+        Output of atlas.get_missing.
+    out_path : str
+        Path to output directory.
+    """
+    os.makedirs(os.path.join(out_path, atlas.ATLAS_DIR), exist_ok=True)
+    with open(os.path.join(out_path, PREP_FILE), 'w') as f:
+        json.dump(missing, f)
+
+def run_prep(out_path):
+    """Resample the atlases listed by save_prep.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    Returns
+    -------
+    int
+        Number of arrays computed.
+    """
+    path = os.path.join(out_path, PREP_FILE)
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        missing = json.load(f)
+    n = atlas.compute_missing(missing, out_path)
+    os.remove(path)
+    return n
+
+def run_cleanup(out_path, aggregate=False):
+    """Remove the batch configs left by killed jobs and merge the completion index shards of the jobs.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    aggregate : bool
+        Also move the completed outputs into the consolidated store.
+    Returns
+    -------
+    int
+        Number of completed files in the index.
+    """
+    for path in glob.glob(os.path.join(out_path, 'logs/config_*.json')):
+        os.remove(path)
+    completed = index.compact_index(out_path)
+    if aggregate:
+        print('Stored {} subject(s) in {}.'.format(store.aggregate(out_path, completed), store.get_store_path(out_path)))
+    return len(completed)
+
+def get_prep_resources(missing):
+    """Get the time and memory of the prep job, from the size of the atlases and of the grids to resample them to.
+
+    Parameters
+    ----------
+    missing : list
+        Output of atlas.get_missing.
+    Returns
+    -------
+    str
+        Time, formatted for SLURM.
+    str
+        Memory, formatted for SLURM.
+    """
+    sec = PREP_SECONDS
+    peak = 0
+    for source, grid, interpolation in missing:
+        n_voxels, n_maps = cost.get_size(nib.load(source).header.get_data_shape())
+        n_target = cost.get_size(grid[0])[0] * n_maps
+        sec += PREP_SEC_PER_VALUE * n_target
+        peak = max(peak, PREP_BYTES_PER_VALUE * (n_voxels * n_maps + n_target))
+    return cost.format_time(sec), cost.format_mem(cost.MEM_SAFETY * (PREP_MEM + peak))
+
+def get_cleanup_resources(n_files, aggregate=False):
+    """Get the time and memory of the cleanup job.
+
+    Parameters
+    ----------
+    n_files : int
+        Number of input files of the dataset.
+    aggregate : bool
+        The cleanup job also fills the consolidated store.
+    Returns
+    -------
+    str
+        Time, formatted for SLURM.
+    str
+        Memory, formatted for SLURM.
+    """
+    sec = CLEANUP_SECONDS + n_files * (CLEANUP_SEC_PER_FILE + (STORE_SEC_PER_FILE if aggregate else 0))
+    return cost.format_time(sec), cost.format_mem(CLEANUP_MEM + n_files * CLEANUP_BYTES_PER_FILE)
+
+def submit_stage(out_path, account, stage, runtime, mem, dependency=None, command='sbatch', options=()):
+    """Submit a prep or cleanup job.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    account : str
+        Account name for submission.
+    stage : str
+        'prep' or 'cleanup'.
+    runtime : str
+        Time for the job, formatted for SLURM.
+    mem : str
+        Memory for the job, formatted for SLURM.
+    dependency : str, None
+        SLURM dependency, e.g. 'afterany:123:124'.
+    command : str
+        sbatch command.
+    options : iterable
+        Arguments added to the nixtract-slurm-stage command, e.g. ['--store'].
+    Returns
+    -------
+    str, None
+        Job id, None if the submission failed.
+    """
+    cmd = '{} --parsable --job-name=nixtract-slurm-{} --time={} --mem={} --account={} -o {}'.format(
+        command, stage, runtime, mem, shlex.quote(account),
+        shlex.quote(os.path.join(out_path, 'logs/slurm_output', stage + '_%j.out')))
+    if dependency is not None:
+        cmd += ' --dependency={}'.format(dependency)
+    #quoted once for the shell running the job, once for the shell running sbatch
+    wrap = ' '.join([shlex.quote(a) for a in ['nixtract-slurm-stage', stage, out_path] + list(options)])
+    cmd += ' --wrap={}'.format(shlex.quote(wrap))
+    stdout = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.strip()
+    if stdout == '':
+        return None
+    print('Submitted {} job {}'.format(stage, stdout.split(';')[0]))
+    return stdout.split(';')[0]
+
+def main():
+    """Entry point to nixtract-slurm-stage, run by the prep and cleanup jobs (or by hand to aggregate)."""
+    parser = generate_parser()
+    args = parser.parse_args()
+    if args.stage == 'prep':
+        print('Resampled {} atlas image(s).'.format(run_prep(args.out_path)))
+    elif args.stage == 'cleanup':
+        print('{} file(s) completed.'.format(run_cleanup(args.out_path, args.store)))
+    else:
+        store.test_h5py()
+        completed = index.compact_index(args.out_path)
+        print('Stored {} subject(s) in {}.'.format(store.aggregate(args.out_path, completed), store.get_store_path(args.out_path)))
@@ -0,0 +1,141 @@
+import os
+import shutil
+import pandas as pd
+from . import index
+
+#Consolidated output store (--store): the _timeseries.tsv files written by the jobs are gathered into one HDF5 file,
+#out_path/timeseries.h5, by the cleanup job (see stages.py), and removed once stored. Each subject is a dataset
+#timeseries/<name>, where name is the input file name without .nii.gz, with its column labels as an attribute. So a
+#subject is read without parsing text or listing a directory of hundreds of thousands of files. Datasets are chunked
+#by columns and gzip compressed. Only the cleanup job writes to the store, so there is never more than one writer.
+#A killed HDF5 writer can leave the whole file unreadable, so each round writes into a copy of the store
+#(timeseries.h5.tmp) that replaces it once closed, and only then are the stored _timeseries.tsv files removed.
+#h5py is only needed with --store (pip install nixtract-slurm[store]).
+TMP_SUFFIX = '.tmp'
+STORE_FILE = 'timeseries.h5'
+GROUP = 'timeseries'
+SUFFIX = '_timeseries.tsv'
+
+#Columns per chunk: reading a few regions of a subject only decompresses their chunks.
+CHUNK_COLUMNS = 64
+
+def test_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py must be installed to use --store (pip install nixtract-slurm[store], or pip install h5py).")
+
+def get_store_path(out_path):
+    """Get the path of the consolidated store in out_path."""
+    return os.path.join(out_path, STORE_FILE)
+
+def get_name(fname):
+    """Get the key of a subject in the store from its input file or _timeseries.tsv (file name without extension)."""
+    name = os.path.basename(fname)
+    for ext in ['.nii.gz', SUFFIX]:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def write_timeseries(f, name, df):
+    """Write the timeseries of a subject to an open store, replacing any previous version.
+
+    Parameters
+    ----------
+    f : h5py.File
+        Store opened for writing.
+    name : str
+        Key of the subject (see get_name).
+    df : pandas.DataFrame
+        Timeseries, one row per timepoint and one column per region.
+    """
+    group = f.require_group(GROUP)
+    if name in group:
+        del group[name]
+    data = df.to_numpy(dtype=float)
+    chunks = (max(data.shape[0], 1), max(min(data.shape[1], CHUNK_COLUMNS), 1))
+    dset = group.create_dataset(name, data=data, chunks=chunks, compression='gzip', shuffle=True)
+    dset.attrs['columns'] = [str(c) for c in df.columns]
+
+def read_timeseries(store_path, name):
+    """Read the timeseries of one subject from the store.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store.
+    name : str
+        Key of the subject, or its input file.
+    Returns
+    -------
+    pandas.DataFrame
+        Timeseries with the region labels as columns, as in the _timeseries.tsv.
+    """
+    import h5py
+    with h5py.File(store_path, 'r') as f:
+        dset = f[GROUP][get_name(name)]
+        columns = [c.decode() if isinstance(c, bytes) else c for c in dset.attrs['columns']]
+        return pd.DataFrame(dset[()], columns=columns)
+
+def list_stored(store_path):
+    """List the keys of the subjects in the store, empty if there is no store.
+
+    Parameters
+    ----------
+    store_path : str
+        Path to the store.
+    Returns
+    -------
+    list
+        Keys of the stored subjects.
+    """
+    if not os.path.exists(store_path):
+        return []
+    import h5py
+    with h5py.File(store_path, 'r') as f:
+        if GROUP not in f:
+            return []
+        return list(f[GROUP].keys())
+
+def aggregate(out_path, completed=None, remove=True):
+    """Move the _timeseries.tsv files of out_path (in either output layout) into the store.
+    The files are written into a copy of the store, which replaces the store once closed, and are only removed then.
+    An interrupted run leaves the previous store and the _timeseries.tsv files as they were, to be stored on the
+    next run.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    completed : iterable, None
+        If given, only the outputs of these input file names are stored (e.g. from the completion index), so
+        outputs cut short by a killed job are left to be processed again.
+    remove : bool
+        Remove the _timeseries.tsv files once stored.
+    Returns
+    -------
+    int
+        Number of subjects stored.
+    """
+    import h5py
+    files = index.list_outputs(out_path)
+    if completed is not None:
+        names = set([get_name(n) for n in completed])
+        files = [f for f in files if get_name(f) in names]
+    if len(files) == 0:
+        return 0
+    store_path = get_store_path(out_path)
+    tmp_path = store_path + TMP_SUFFIX
+    #left by a killed run
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    if os.path.exists(store_path):
+        shutil.copyfile(store_path, tmp_path)
+    with h5py.File(tmp_path, 'a') as f:
+        for path in files:
+            write_timeseries(f, get_name(path), pd.read_table(path))
+    os.replace(tmp_path, store_path)
+    if remove:
+        for path in files:
+            os.remove(path)
+    return len(files)
@@ -0,0 +1,176 @@
+import time
+import subprocess
+from . import cost
+
+#Supervisor mode: after submitting, nixtract-slurm waits for the jobs with sacct (squeue forgets jobs once they end,
+#so it can't tell how they ended), classifies how each task ended and resubmits the files that are not completed,
+#with more time after a TIMEOUT and more memory after an OUT_OF_MEMORY, until everything is done.
+
+#sacct states of tasks that have ended.
+TERMINAL_STATES = ['COMPLETED', 'FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'CANCELLED', 'NODE_FAIL', 'PREEMPTED',
+                   'BOOT_FAIL', 'DEADLINE']
+
+#Failure type of each state: 'time' and 'mem' are escalated, 'node' (the node failed or the job was preempted) and
+#'error' (nixtract failed or the job was cancelled) are resubmitted with the same resources.
+FAILURE_TYPES = {'TIMEOUT': 'time', 'DEADLINE': 'time', 'OUT_OF_MEMORY': 'mem', 'NODE_FAIL': 'node',
+                 'PREEMPTED': 'node', 'BOOT_FAIL': 'node', 'FAILED': 'error', 'CANCELLED': 'error'}
+
+def parse_sacct(output):
+    """Parse the output of sacct -n -P -X -o JobID,State.
+
+    Parameters
+    ----------
+    output : str
+        Output of sacct, one 'jobid|state' line per task (pending tasks of an array may be on one line).
+    Returns
+    -------
+    dict
+        Mapping from task id to its state, e.g. {'123_4': 'TIMEOUT'}. 'CANCELLED by <uid>' becomes 'CANCELLED'.
+    """
+    states = {}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 2:
+            continue
+        states[fields[0]] = fields[1].split(' ')[0]
+    return states
+
+def get_states(job_ids, command='sacct'):
+    """Get the state of every task of the job arrays.
+
+    Parameters
+    ----------
+    job_ids : list
+        Ids of the job arrays.
+    command : str
+        sacct command (replaced by a stub in tests).
+    Returns
+    -------
+    dict
+        Output of parse_sacct, empty if sacct failed (e.g. jobs not yet in the accounting database).
+    """
+    cmd = '{} -n -P -X -o JobID,State -j {}'.format(command, ','.join([str(j) for j in job_ids]))
+    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        return {}
+    return parse_sacct(result.stdout)
+
+def is_finished(states):
+    """Check that all tasks have ended, False if there are no states yet."""
+    return len(states) != 0 and all([s in TERMINAL_STATES for s in states.values()])
+
+def wait_for_jobs(job_ids, poll_interval=60, command='sacct', sleep=time.sleep):
+    """Wait until all tasks of the job arrays have ended.
+
+    Parameters
+    ----------
+    job_ids : list
+        Ids of the job arrays.
+    poll_interval : int, float
+        Seconds between two sacct calls.
+    command : str
+        sacct command.
+    sleep : callable
+        Called with poll_interval between calls.
+    Returns
+    -------
+    dict
+        Final state of each task.
+    """
+    while True:
+        states = get_states(job_ids, command)
+        if is_finished(states):
+            return states
+        sleep(poll_interval)
+
+def classify(states):
+    """Count the failed tasks of each failure type.
+
+    Parameters
+    ----------
+    states : dict
+        Output of get_states.
+    Returns
+    -------
+    dict
+        Number of tasks for each failure type ('time', 'mem', 'node', 'error') that occurred.
+    """
+    failures = {}
+    for state in states.values():
+        if state in FAILURE_TYPES:
+            failures[FAILURE_TYPES[state]] = failures.get(FAILURE_TYPES[state], 0) + 1
+    return failures
+
+def escalate(runtime, mem, failures, factor=2.):
+    """Scale up the resources for the failures of the previous round.
+
+    Parameters
+    ----------
+    runtime : str
+        Time per job of the previous round, formatted for SLURM.
+    mem : str
+        Memory per job of the previous round, formatted for SLURM.
+    failures : dict
+        Output of classify.
+    factor : float
+        Multiplier applied to time after a timeout and to memory after running out of memory.
+    Returns
+    -------
+    str
+        Time per job for the next round.
+    str
+        Memory per job for the next round.
+    """
+    if 'time' in failures:
+        runtime = cost.format_time(factor * cost.parse_time(runtime))
+    if 'mem' in failures:
+        mem = cost.format_mem(factor * cost.parse_mem(mem))
+    return runtime, mem
+
+def supervise(submit, remaining, job, max_retries=3, poll_interval=60, command='sacct', sleep=time.sleep):
+    """Wait for the jobs and resubmit the files that are not completed, with escalated resources, until all files are
+    completed or max_retries resubmissions have been made.
+
+    Parameters
+    ----------
+    submit : callable
+        Called with (runtime, mem, files_per_job) to submit the files that are not completed, returns a dict like job
+        or None if there is nothing left to do.
+    remaining : callable
+        Returns the number of files that are not completed.
+    job : dict
+        Submission to watch, with 'job_ids', 'runtime', 'mem', 'n_jobs' and 'n_files'.
+    max_retries : int
+        Maximum number of resubmissions.
+    poll_interval : int, float
+        Seconds between two sacct calls.
+    command : str
+        sacct command.
+    sleep : callable
+        Called with poll_interval between calls.
+    Returns
+    -------
+    bool
+        True if all files are completed.
+    """
+    for retry in range(max_retries + 1):
+        print('Waiting for job(s) {}...'.format(', '.join([str(j) for j in job['job_ids']])))
+        states = wait_for_jobs(job['job_ids'], poll_interval, command, sleep)
+        failures = classify(states)
+        n_left = remaining()
+        print('{} task(s) ended, failures: {}. {} file(s) not completed.'.format(len(states), failures or 'none', n_left))
+        if n_left == 0:
+            print('All files completed.')
+            return True
+        if retry == max_retries:
+            break
+        runtime, mem = escalate(job['runtime'], job['mem'], failures)
+        #same number of files per job, so that more time is more time per file
+        files_per_job = max(1, job['n_files'] // max(job['n_jobs'], 1))
+        print('Resubmitting (retry {} of {}) with time={} and memory={}...'.format(retry + 1, max_retries, runtime, mem))
+        job = submit(runtime, mem, files_per_job)
+        if job is None:
+            print('All files completed.')
+            return True
+    print('Some files are still not completed after {} resubmission(s), see logs/slurm_output.'.format(max_retries))
+    return False
@@ -0,0 +1,210 @@
+import os
+import time
+import numpy as np
+from argparse import ArgumentParser
+from . import cost
+
+#Telemetry: the worker appends one JSON line per file to logs/telemetry/<job>_<task>.jsonl as soon as the file is
+#done (or failed), with the time spent in each stage of the extraction, the peak memory, the bytes read and written
+#and where it ran. "nixtract-slurm report out_path" summarizes them: throughput, stragglers and how well the jobs
+#used the resources they requested.
+#Stages of in-process extraction:
+#  setup       read the header and get the masker for its grid (loads and resamples the atlas on the first file).
+#  regressors  read the regressor file and select the regressors (only wait for them when read ahead by the worker).
+#  extract     read and decompress the image, mask and clean the signals (done together by the nilearn masker).
+#  read        with --prefetch, wait for the input read ahead (the image is then already in memory for extract).
+#  write       write the _timeseries.tsv (on a writer thread with --prefetch).
+#With --prefetch the bytes read and written of a file also count the reads ahead and writes of its neighbours, since
+#they are measured for the whole process.
+TELEMETRY_DIR = 'logs/telemetry'
+
+#A file is a straggler when it takes more than this many times the median time per file.
+STRAGGLER_FACTOR = 3.
+
+def generate_parser():
+    parser = ArgumentParser(prog='nixtract-slurm report')
+    parser.add_argument("out_path",help='Required: Path to output directory.')
+    parser.add_argument("--top",help='Optional: Number of stragglers and jobs to list. Default: 10.',dest='top',type=int,default=10)
+    return parser
+
+def get_io():
+    """Get the bytes read and written by this process so far (rchar and wchar in /proc/self/io).
+
+    Returns
+    -------
+    tuple, None
+        Bytes read and bytes written, None if not available (no /proc).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict([line.split(':') for line in f if ':' in line])
+        return int(fields['rchar']), int(fields['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def get_stats(stages, io_start):
+    """Gather the stage timings and the bytes read and written since io_start.
+
+    Parameters
+    ----------
+    stages : dict
+        Seconds spent in each stage.
+    io_start : tuple, None
+        Output of get_io before the file.
+    Returns
+    -------
+    dict
+        'stages', 'bytes_read' and 'bytes_written' (None if not available).
+    """
+    io_end = get_io()
+    if io_start is None or io_end is None:
+        return {'stages': stages, 'bytes_read': None, 'bytes_written': None}
+    return {'stages': stages, 'bytes_read': io_end[0] - io_start[0], 'bytes_written': io_end[1] - io_start[1]}
+
+def get_mem_limit():
+    """Get the memory allocated to the SLURM job in bytes, None outside of SLURM."""
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        return int(os.environ['SLURM_MEM_PER_NODE']) * 2**20
+    if 'SLURM_MEM_PER_CPU' in os.environ:
+        return int(os.environ['SLURM_MEM_PER_CPU']) * int(os.environ.get('SLURM_CPUS_PER_TASK', 1)) * 2**20
+    return None
+
+def make_row(fname, seconds, peak_bytes, failed, stats=None, batch=None, n_workers=1):
+    """Make the telemetry record of a file.
+
+    Parameters
+    ----------
+    fname : str
+        Input file.
+    seconds : float
+        Time spent on the file.
+    peak_bytes : int, None
+        Peak resident memory of the process that extracted it.
+    failed : bool
+        True if the file failed.
+    stats : dict, None
+        Output of get_stats, None if not measured (--subprocess).
+    batch : int, None
+        Batch of the job.
+    n_workers : int
+        Number of files the job processes at the same time.
+    Returns
+    -------
+    dict
+        Record for record_telemetry.
+    """
+    stats = stats or {'stages': {}, 'bytes_read': None, 'bytes_written': None}
+    return {'time': time.time(), 'file': fname, 'failed': failed, 'seconds': seconds, 'peak_bytes': peak_bytes,
+            'stages': stats['stages'], 'bytes_read': stats['bytes_read'], 'bytes_written': stats['bytes_written'],
+            'node': os.environ.get('SLURMD_NODENAME', os.uname()[1]),
+            'job': os.environ.get('SLURM_ARRAY_JOB_ID', str(os.getpid())), 'task': os.environ.get('SLURM_ARRAY_TASK_ID', '0'),
+            'batch': batch, 'n_workers': n_workers, 'mem_limit': get_mem_limit()}
+
+def record_telemetry(path, rows):
+    """Append telemetry records to a job's telemetry file (one JSON object per line)."""
+    cost.record_history(path, rows)
+
+def load_telemetry(out_path):
+    """Read the telemetry records of all jobs, skipping lines cut short by a killed job."""
+    return cost.load_history(os.path.join(out_path, TELEMETRY_DIR))
+
+def summarize(rows, top=10):
+    """Summarize telemetry records.
+
+    Parameters
+    ----------
+    rows : list
+        Records from load_telemetry.
+    top : int
+        Number of stragglers and jobs to list.
+    Returns
+    -------
+    dict
+        Counts, throughput, time per file, share of each stage, I/O, stragglers, nodes and jobs.
+    """
+    done = [r for r in rows if not r['failed']]
+    summary = {'n_files': len(done), 'n_failed': len(rows) - len(done)}
+    if len(done) == 0:
+        return summary
+    seconds = np.array([r['seconds'] for r in done])
+    span = max([r['time'] for r in done]) - min([r['time'] - r['seconds'] for r in done])
+    summary['span'] = span
+    summary['files_per_hour'] = 3600. * len(done) / max(span, 1e-9)
+    summary['seconds'] = {'median': float(np.median(seconds)), 'p95': float(np.percentile(seconds, 95)),
+                          'max': float(seconds.max()), 'total': float(seconds.sum())}
+
+    stages = {}
+    for r in done:
+        for name, sec in r['stages'].items():
+            stages[name] = stages.get(name, 0.) + sec
+    summary['stages'] = dict([(name, sec / seconds.sum()) for name, sec in stages.items()])
+
+    measured = [r for r in done if r['bytes_read'] is not None]
+    if len(measured) != 0:
+        summary['bytes_read'] = sum([r['bytes_read'] for r in measured])
+        summary['bytes_written'] = sum([r['bytes_written'] for r in measured])
+        summary['read_rate'] = summary['bytes_read'] / max(sum([r['seconds'] for r in measured]), 1e-9)
+
+    median = summary['seconds']['median']
+    stragglers = sorted([r for r in done if r['seconds'] > STRAGGLER_FACTOR * median], key=lambda r: -r['seconds'])
+    summary['n_stragglers'] = len(stragglers)
+    summary['stragglers'] = [dict([(k, r[k]) for k in ['file', 'seconds', 'node', 'job', 'task']]) for r in stragglers[:top]]
+
+    nodes = {}
+    for r in done:
+        nodes.setdefault(r['node'], []).append(r['seconds'])
+    summary['nodes'] = sorted([{'node': n, 'n_files': len(s), 'mean_seconds': float(np.mean(s))} for n, s in nodes.items()],
+                              key=lambda n: -n['mean_seconds'])
+
+    #how busy each job kept its CPUs between its first and last file, and how much of its memory it used
+    jobs = {}
+    for r in done:
+        jobs.setdefault((r['job'], r['task']), []).append(r)
+    summary['jobs'] = []
+    for (job, task), rs in jobs.items():
+        span = max([r['time'] for r in rs]) - min([r['time'] - r['seconds'] for r in rs])
+        busy = sum([r['seconds'] for r in rs]) / max(max([r['n_workers'] for r in rs]), 1)
+        peak = max([r['peak_bytes'] or 0 for r in rs])
+        limit = rs[0]['mem_limit']
+        summary['jobs'].append({'job': job, 'task': task, 'n_files': len(rs), 'cpu_efficiency': busy / max(span, 1e-9),
+                                'peak_bytes': peak, 'mem_efficiency': peak / limit if limit else None})
+    summary['jobs'].sort(key=lambda j: j['cpu_efficiency'])
+    return summary
+
+def format_summary(summary, top=10):
+    """Format the output of summarize as text."""
+    lines = ['{} file(s) done, {} failed.'.format(summary['n_files'], summary['n_failed'])]
+    if summary['n_files'] == 0:
+        return '\n'.join(lines)
+    s = summary['seconds']
+    lines.append('Throughput: {:.1f} files/hour over {}.'.format(summary['files_per_hour'], cost.format_time(summary['span'])))
+    lines.append('Time per file: median {:.2f}s, 95th percentile {:.2f}s, max {:.2f}s, {} in total.'.format(
+        s['median'], s['p95'], s['max'], cost.format_time(s['total'])))
+    if len(summary['stages']) != 0:
+        lines.append('Time per stage: ' + ', '.join(['{} {:.0%}'.format(n, v) for n, v in summary['stages'].items()]) + '.')
+    if 'bytes_read' in summary:
+        lines.append('I/O: {} read, {} written, {}/s read while extracting.'.format(
+            cost.format_mem(summary['bytes_read']), cost.format_mem(summary['bytes_written']),
+            cost.format_mem(summary['read_rate'])))
+    lines.append('{} straggler(s) (more than {:g}x the median):'.format(summary['n_stragglers'], STRAGGLER_FACTOR))
+    for r in summary['stragglers']:
+        lines.append('  {:.2f}s  {}  (node {}, job {}_{})'.format(r['seconds'], r['file'], r['node'], r['job'], r['task']))
+    lines.append('Slowest nodes:')
+    for n in summary['nodes'][:top]:
+        lines.append('  {}: {} file(s), {:.2f}s per file'.format(n['node'], n['n_files'], n['mean_seconds']))
+    lines.append('Least efficient jobs:')
+    for j in summary['jobs'][:top]:
+        mem = 'unknown' if j['mem_efficiency'] is None else '{:.0%}'.format(j['mem_efficiency'])
+        lines.append('  {}_{}: {} file(s), CPU {:.0%}, memory {} ({} peak)'.format(
+            j['job'], j['task'], j['n_files'], j['cpu_efficiency'], mem, cost.format_mem(j['peak_bytes'])))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    """Entry point to nixtract-slurm report."""
+    parser = generate_parser()
+    args = parser.parse_args(argv)
+    rows = load_telemetry(args.out_path)
+    if len(rows) == 0:
+        print('No telemetry found in {}.'.format(os.path.join(args.out_path, TELEMETRY_DIR)))
+        return
+    print(format_summary(summarize(rows, args.top), args.top))
@@ -0,0 +1,407 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from . import cost
+from . import index
+from . import extract
+from . import workqueue
+from . import telemetry
+from .nslurm import pack_list, read_batch
+
+#With --scratch, outputs are written to node-local disk and moved to out_path this many at a time, so the shared
+#filesystem sees a few bursts instead of a write per file. A job killed by its time limit loses at most this many
+#outputs, which are processed again on the next run since they are not in the completion index yet.
+STAGE_OUT_FILES = 20
+
+#With --stage_inputs, the input and regressor files of the batch are copied to the --scratch directory on this many
+#threads, in batch order, and each file is extracted as soon as it is copied. All outputs are then moved to out_path
+#at the end of the batch instead of STAGE_OUT_FILES at a time.
+STAGE_THREADS = 4
+
+def generate_parser():
+    parser = ArgumentParser()
+    parser.add_argument("-c","--config",help='Required: Path to the params file (or a batch config file) made by nixtract-slurm.',dest='config',required=True)
+    parser.add_argument("out_path",help='Required: Path to output directory.')
+    parser.add_argument("--batch",help='Optional: Batch to process, read from the batch table in logs. Default: the input_files of the config.',dest='batch',required=False,type=int)
+    parser.add_argument("--n_workers",help='Optional: Number of files processed at the same time. Default: SLURM_CPUS_PER_TASK, or 1.',dest='n_workers',required=False,type=int)
+    parser.add_argument("--queue",help='Optional: Claim files one at a time from the work queue in logs/queue instead of processing the files of the config.',dest='queue',action='store_true')
+    parser.add_argument("--time_limit",help='Optional: Time limit of the job in seconds. With --queue, no more files are claimed when the longest file so far would not finish in time.',dest='time_limit',required=False,type=int)
+    parser.add_argument("--shard_outputs",help='Optional: Move the outputs to the sharded layout, out_path/timeseries/<xx>/.',dest='shard_outputs',action='store_true')
+    parser.add_argument("--scratch",help='Optional: Node-local directory to write the outputs to before moving them to out_path in groups.',dest='scratch',required=False)
+    parser.add_argument("--stage_inputs",help='Optional: Copy the input and regressor files of the batch to the --scratch directory before extracting them, and move all outputs to out_path at the end.',dest='stage_inputs',action='store_true')
+    parser.add_argument("--backend",help='Optional: Extraction backend, "native" computes the region means of label atlases without the nilearn masker. Default: nilearn.',dest='backend',choices=extract.BACKENDS,default='nilearn')
+    parser.add_argument("--prefetch",help='Optional: Number of inputs read and decompressed into memory ahead of the extraction, with the outputs written on another thread. Only with one worker, not with --queue. Default: 0.',dest='prefetch',type=int,default=0)
+    parser.add_argument("--subprocess",help='Optional: Run the nixtract-nifti command on the batch instead of extracting in this process.',dest='subprocess',action='store_true')
+    return parser
+
+def get_peak_rss(pid):
+    """Get the peak resident memory of a running process from /proc.
+
+    Parameters
+    ----------
+    pid : int
+        Process id.
+    Returns
+    -------
+    int, None
+        Peak resident memory in bytes, None if not available (process ended or no /proc).
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def time_extraction(command, files, on_done=None):
+    """Run nixtract, timing each file from the 'Extracting <file>' lines it prints in verbose mode.
+    Output of the command is passed through to stdout. The peak memory recorded for a file is the peak of the
+    process so far when that file is finished, so it is an upper bound.
+
+    Parameters
+    ----------
+    command : list
+        Command to run.
+    files : list
+        List of input_files processed by the command.
+    on_done : callable, None
+        Called with (file, seconds, peak_bytes) as soon as each file is finished.
+    Returns
+    -------
+    int
+        Return code of the command.
+    list
+        List of (file, seconds, peak_bytes) for each file that was started.
+    """
+    by_name = dict([(os.path.basename(f), f) for f in files])
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, env=env)
+
+    timings = []
+    current = None
+    start = None
+    for line in proc.stdout:
+        sys.stdout.write(line)
+        m = re.search(r'Extracting (\S+)', line)
+        if m is None:
+            continue
+        now = time.time()
+        if current is not None:
+            timings.append((current, now - start, get_peak_rss(proc.pid)))
+            if on_done is not None:
+                on_done(*timings[-1])
+        current = by_name.get(m.group(1), m.group(1))
+        start = now
+    returncode = proc.wait()
+    if current is not None:
+        #ru_maxrss is in kilobytes on linux
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        timings.append((current, time.time() - start, peak))
+        if on_done is not None:
+            on_done(*timings[-1])
+    return returncode, timings
+
+def copy_task(task, stage_dir):
+    """Copy the input and regressor files of a task to their own directory, keeping their names so the outputs do.
+
+    Parameters
+    ----------
+    task : tuple
+        Input file and its regressor file (or None).
+    stage_dir : str
+        Directory for this task on node-local disk.
+    Returns
+    -------
+    tuple
+        Task with the copied files, or the task itself if they could not be copied.
+    """
+    try:
+        os.makedirs(stage_dir)
+        return tuple([None if f is None else shutil.copyfile(f, os.path.join(stage_dir, os.path.basename(f)))
+                      for f in task])
+    except (IOError, OSError) as e:
+        print('Could not stage {}, reading it from its location: {}'.format(task[0], e))
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        return task
+
+def stage_inputs(tasks, stage_dir, origin):
+    """Copy the input and regressor files of a batch to node-local disk, on STAGE_THREADS threads.
+
+    Parameters
+    ----------
+    tasks : list
+        (input_file, regressor_file) pairs of the batch.
+    stage_dir : str
+        Node-local directory.
+    origin : dict
+        Filled with the original path of each copied input file.
+    Yields
+    ------
+    tuple
+        Task with the copied files, in batch order, as soon as they are copied.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(STAGE_THREADS) as executor:
+        dirs = [os.path.join(stage_dir, str(i)) for i in range(len(tasks))]
+        for task, staged in zip(tasks, executor.map(copy_task, tasks, dirs)):
+            origin[staged[0]] = task[0]
+            yield staged
+    print('Staged {} file(s) in {:.1f}s.'.format(len(tasks), time.time() - start))
+    sys.stdout.flush()
+
+def get_history_rows(timings, roi_file, out_path, sharded=False, backend='nilearn', prefetch=0):
+    """Make history records for the files that were completed.
+
+    Parameters
+    ----------
+    timings : list
+        Output of time_extraction.
+    roi_file : str
+        roi_file from the config.
+    out_path : str
+        Path to output dir.
+    sharded : bool
+        Outputs are in the sharded layout.
+    backend : str
+        Extraction backend used.
+    prefetch : int
+        Number of inputs read ahead (see extract.run_pipeline).
+    Returns
+    -------
+    list
+        List of dicts to pass to cost.record_history.
+    """
+    atlas_info = cost.get_atlas_info(roi_file)
+    rows = []
+    for fname, sec, peak in timings:
+        if not os.path.exists(index.get_output(fname, out_path, sharded)):
+            continue
+        n_voxels, n_timepoints = cost.get_shape(fname)
+        rows.append({'file': fname, 'roi_file': roi_file, 'n_voxels': n_voxels, 'n_timepoints': n_timepoints,
+                     'n_rois': atlas_info[0], 'probabilistic': atlas_info[1], 'atlas_voxels': atlas_info[2],
+                     'seconds': sec, 'peak_bytes': peak, 'backend': backend,
+                     'prefetch': prefetch})
+    return rows
+
+def split_batch(params, n_workers):
+    """Split the files of a batch between workers, balanced by file size.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters from the batch config file.
+    n_workers : int
+        Number of workers.
+    Returns
+    -------
+    list
+        List of parameter dicts, one per worker with files to process, each processing its files one at a time.
+    """
+    files = params['input_files']
+    conf = params.get('regressor_files') or []
+    parts = []
+    for chunk in pack_list(n_workers, [os.path.getsize(f) for f in files]):
+        if len(chunk) == 0:
+            continue
+        p = params.copy()
+        p['input_files'] = [files[i] for i in chunk]
+        p['regressor_files'] = [conf[i] for i in chunk] if len(conf) != 0 else conf
+        p['n_jobs'] = 1
+        parts.append(p)
+    return parts
+
+def run_batch(params, config_path, out_path, n_workers=1, on_done=None):
+    """Run nixtract on a batch, with n_workers nixtract processes at the same time when n_workers > 1.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters from the batch config file.
+    config_path : str
+        Path to the batch config file. Configs for the workers are written next to it and removed after.
+    out_path : str
+        Path to output dir.
+    n_workers : int
+        Number of files processed at the same time.
+    on_done : callable, None
+        Called with (file, seconds, peak_bytes) as soon as each file is finished, from the worker's thread.
+    Returns
+    -------
+    int
+        Highest return code of the nixtract processes.
+    list
+        List of (file, seconds, peak_bytes) for each file that was started.
+    """
+    if n_workers <= 1:
+        command = ['nixtract-nifti', '-c', config_path, out_path]
+        return time_extraction(command, params['input_files'], on_done)
+
+    parts = split_batch(params, n_workers)
+    results = [None] * len(parts)
+
+    def run_part(k):
+        part_config = '{}.part{}.json'.format(os.path.splitext(config_path)[0], k)
+        with open(part_config, 'w') as f:
+            json.dump(parts[k], f)
+        try:
+            command = ['nixtract-nifti', '-c', part_config, out_path]
+            results[k] = time_extraction(command, parts[k]['input_files'], on_done)
+        finally:
+            os.remove(part_config)
+
+    threads = [threading.Thread(target=run_part, args=(k,)) for k in range(len(parts))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    returncode = max([r[0] if r is not None else 1 for r in results] + [0])
+    timings = sum([r[1] for r in results if r is not None], [])
+    return returncode, timings
+
+def get_n_workers(n_workers=None):
+    """Get the number of workers: n_workers if given, else the CPUs allocated by SLURM."""
+    if n_workers is not None:
+        return n_workers
+    return int(os.environ.get('SLURM_CPUS_PER_TASK', 1))
+
+def main():
+    """Entry point to nixtract-slurm-worker, run by each SLURM job on its batch."""
+    parser = generate_parser()
+    args = parser.parse_args()
+    if args.subprocess and (args.queue or args.scratch is not None or args.backend != 'nilearn'):
+        parser.error('--queue, --scratch and --backend only work with in-process extraction.')
+    if args.stage_inputs and (args.scratch is None or args.queue or args.subprocess):
+        parser.error('--stage_inputs needs --scratch, and only works with in-process extraction of a batch, not with --queue.')
+    if args.prefetch > 0 and (args.queue or args.subprocess):
+        parser.error('--prefetch only works with in-process extraction of a batch, not with --queue.')
+
+    with open(args.config) as f:
+        params = json.load(f)
+    tasks = None
+    if args.batch is not None and not args.queue:
+        params['input_files'], params['regressor_files'] = read_batch(args.out_path, args.batch)
+        tasks = zip(params['input_files'], params['regressor_files'] or [None] * len(params['input_files']))
+
+    name = '{}_{}'.format(os.environ.get('SLURM_ARRAY_JOB_ID', os.getpid()), os.environ.get('SLURM_ARRAY_TASK_ID', 0))
+    index_dir = index.get_index_dir(args.out_path)
+    os.makedirs(index_dir, exist_ok=True)
+    shard = os.path.join(index_dir, name + '.txt')
+
+    params_hash = index.hash_params(params)
+    lock = threading.Lock()
+    start = time.time()
+    longest = [0.]
+    claims = {}
+    #outputs waiting to be moved to out_path, then recorded as completed
+    pending = []
+    work_dir = args.out_path
+    if args.scratch is not None:
+        work_dir = tempfile.mkdtemp(prefix='nixtract-slurm-', dir=args.scratch)
+    group = STAGE_OUT_FILES if args.scratch is not None else 1
+    #original path of each staged input file, which the outputs, index and telemetry refer to
+    origin = {}
+    if args.stage_inputs:
+        if tasks is None:
+            tasks = zip(params['input_files'], params.get('regressor_files') or [None] * len(params['input_files']))
+        tasks = list(tasks)
+        #missing files are reported by the extraction
+        needed = sum([os.path.getsize(f) for t in tasks for f in t if f is not None and os.path.isfile(f)])
+        free = shutil.disk_usage(work_dir).free
+        if needed > free:
+            print('Not enough local disk to stage the batch ({} needed, {} free), reading the files from their location.'.format(
+                cost.format_mem(needed), cost.format_mem(free)))
+        else:
+            group = max(len(tasks), 1)
+            tasks = stage_inputs(tasks, os.path.join(work_dir, 'inputs'), origin)
+
+    def stage_out():
+        outputs = [(index.get_output(f, work_dir), index.get_output(f, args.out_path, args.shard_outputs)) for f, _ in pending]
+        index.move_outputs([(src, dst) for src, dst in outputs if src != dst])
+        index.record_completed(shard, [r for _, r in pending])
+        for fname, _ in pending:
+            if fname in claims:
+                workqueue.release(claims.pop(fname))
+        del pending[:]
+
+    def on_done(fname, sec, peak):
+        fname = origin.get(fname, fname)
+        longest[0] = max(longest[0], sec)
+        out = index.get_output(fname, work_dir)
+        if not os.path.exists(out):
+            return
+        record = index.make_record(fname, out, params_hash)
+        expected = index.get_expected_rows(cost.get_shape(fname)[1], params)
+        if record['n_rows'] != expected:
+            print('Incomplete output for {}: {} lines, expected {}.'.format(fname, record['n_rows'], expected))
+            return
+        with lock:
+            pending.append((fname, record))
+            if len(pending) >= group:
+                stage_out()
+
+    def stop():
+        #a file as long as the longest so far, with a margin, must still fit in the time limit
+        return args.time_limit is not None and time.time() - start + 1.5*longest[0] > args.time_limit
+
+    n_workers = get_n_workers(args.n_workers)
+    #with several workers, each process gets n_jobs=1, so timings are per file either way
+    if n_workers <= 1 and params.get('n_jobs', 1) != 1:
+        n_workers = params['n_jobs']
+    #several workers already overlap reading and extracting
+    prefetch = args.prefetch if n_workers <= 1 else 0
+
+    telemetry_dir = os.path.join(args.out_path, telemetry.TELEMETRY_DIR)
+    os.makedirs(telemetry_dir, exist_ok=True)
+    telemetry_path = os.path.join(telemetry_dir, name + '.jsonl')
+
+    def on_stats(fname, sec, peak, failed, stats):
+        fname = origin.get(fname, fname)
+        telemetry.record_telemetry(telemetry_path, [telemetry.make_row(fname, sec, peak, failed, stats, args.batch, n_workers)])
+    if args.queue:
+        tasks = workqueue.iter_claims(args.out_path, name, claims, stop)
+        returncode, timings = extract.run_in_process(args.config, args.out_path, n_workers, on_done, tasks, work_dir,
+                                                     args.shard_outputs, on_stats, args.backend)
+    elif args.subprocess:
+        config = args.config
+        if args.batch is not None:
+            #nixtract-nifti needs the files in its config
+            config = os.path.join(os.path.dirname(args.config), 'config_{}.json'.format(args.batch))
+            with open(config, 'w') as f:
+                json.dump(params, f)
+        try:
+            returncode, timings = run_batch(params, config, args.out_path, n_workers, on_done)
+        finally:
+            if config != args.config:
+                os.remove(config)
+        #no stage timings from nixtract-nifti
+        rows = [telemetry.make_row(f, sec, peak, not os.path.exists(index.get_output(f, work_dir)) and
+                                   not os.path.exists(index.get_output(f, args.out_path, args.shard_outputs)),
+                                   batch=args.batch, n_workers=n_workers) for f, sec, peak in timings]
+        telemetry.record_telemetry(telemetry_path, rows)
+    else:
+        returncode, timings = extract.run_in_process(args.config, args.out_path, n_workers, on_done, tasks, work_dir,
+                                                     args.shard_outputs, on_stats, args.backend,
+                                                     extract.REGRESSOR_PREFETCH, prefetch)
+        timings = [(origin.get(f, f), sec, peak) for f, sec, peak in timings]
+    stage_out()
+    for path in claims.values():
+        workqueue.release(path, failed=True)
+    if work_dir != args.out_path:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    history_dir = os.path.join(args.out_path, 'logs/history')
+    os.makedirs(history_dir, exist_ok=True)
+    rows = get_history_rows(timings, params.get('roi_file'), args.out_path, args.shard_outputs, args.backend, prefetch)
+    cost.record_history(os.path.join(history_dir, name + '.jsonl'), rows)
+    sys.exit(returncode)
@@ -0,0 +1,148 @@
+import os
+import json
+import shutil
+
+#Work queue on the shared filesystem, for --queue mode: instead of a fixed batch, each job claims one file at a time
+#until the queue is empty, so fast jobs keep working while a slow node or a big file only holds up one file.
+#Each file is an item in logs/queue/todo. A job claims an item by renaming it into logs/queue/claimed, which is atomic
+#(also on NFS), so exactly one job gets it without any lock or database. Items are numbered heaviest first, so
+#the biggest files start first and the array finishes close to the ideal makespan. A claimed item is removed once
+#its file is in the completion index, or moved to logs/queue/failed. Items left in claimed by a killed job are
+#processed again on the next submission, which rebuilds the queue from the todo list.
+QUEUE_DIR = 'logs/queue'
+
+def get_queue_dirs(out_path):
+    """Get the todo, claimed and failed directories of the work queue.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    Returns
+    -------
+    tuple
+        Paths to the todo, claimed and failed directories.
+    """
+    queue_dir = os.path.join(out_path, QUEUE_DIR)
+    return tuple([os.path.join(queue_dir, d) for d in ['todo', 'claimed', 'failed']])
+
+def make_queue(files, conf_files, out_path, order=None):
+    """Make a new work queue with one item per input file, replacing any previous queue.
+
+    Parameters
+    ----------
+    files : list
+        List of input files.
+    conf_files : list
+        List of regressor files, empty or one per input file.
+    out_path : str
+        Path to output directory.
+    order : list, None
+        Indices of the files in the order they should be claimed (e.g. heaviest first). Default: as given.
+    """
+    queue_dir = os.path.join(out_path, QUEUE_DIR)
+    if os.path.isdir(queue_dir):
+        shutil.rmtree(queue_dir)
+    todo, claimed, failed = get_queue_dirs(out_path)
+    for d in [todo, claimed, failed]:
+        os.makedirs(d)
+    if order is None:
+        order = range(len(files))
+    for k, i in enumerate(order):
+        item = {'input_file': files[i], 'regressor_file': conf_files[i] if len(conf_files) != 0 else None}
+        with open(os.path.join(todo, '{:08d}.json'.format(k)), 'w') as f:
+            json.dump(item, f)
+
+def claim(out_path, name, item):
+    """Try to claim an item of the queue.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    name : str
+        Name of the claiming job, added to the claimed item.
+    item : str
+        File name of the item in the todo directory.
+    Returns
+    -------
+    str, None
+        Path of the claimed item, None if another job claimed it first.
+    """
+    todo, claimed, _ = get_queue_dirs(out_path)
+    path = os.path.join(claimed, '{}.{}.json'.format(item[:-len('.json')], name))
+    try:
+        os.rename(os.path.join(todo, item), path)
+    except FileNotFoundError:
+        return None
+    return path
+
+def iter_claims(out_path, name, claims, stop=None):
+    """Claim items of the queue one at a time, in order, until it is empty.
+    The todo directory is only listed again once all the items of the previous listing have been tried.
+
+    Parameters
+    ----------
+    out_path : str
+        Path to output directory.
+    name : str
+        Name of the claiming job.
+    claims : dict
+        Filled with the path of the claimed item of each input file, for release.
+    stop : callable, None
+        Checked before each claim, no more items are claimed once it returns True (e.g. time limit near).
+    Yields
+    ------
+    tuple
+        Input file and regressor file (or None) of each claimed item.
+    """
+    todo = get_queue_dirs(out_path)[0]
+    while True:
+        items = sorted([i for i in os.listdir(todo) if i.endswith('.json')])
+        if len(items) == 0:
+            return
+        for item in items:
+            if stop is not None and stop():
+                return
+            path = claim(out_path, name, item)
+            if path is None:
+                continue
+            with open(path) as f:
+                d = json.load(f)
+            claims[d['input_file']] = path
+            yield d['input_file'], d['regressor_file']
+
+def release(path, failed=False):
+    """Remove a claimed item once its file is done, or move it to the failed directory.
+
+    Parameters
+    ----------
+    path : str
+        Path of the claimed item.
+    failed : bool
+        Keep the item in logs/queue/failed instead of removing it.
+    """
+    if failed:
+        os.rename(path, os.path.join(os.path.dirname(os.path.dirname(path)), 'failed', os.path.basename(path)))
+    else:
+        os.remove(path)
+
+def get_order(files, costs=None):
+    """Order files heaviest first, by predicted runtime if available, by size on disk otherwise.
+
+    Parameters
+    ----------
+    files : list
+        List of input files.
+    costs : list, None
+        Predicted (seconds, bytes) per file (see cost.estimate_costs).
+    Returns
+    -------
+    list
+        Indices of the files.
+    """
+    if costs:
+        weights = [c[0] for c in costs]
+    else:
+        weights = [os.path.getsize(f) for f in files]
+    return sorted(range(len(files)), key=lambda i: -weights[i])
@@ -9,6 +9,9 @@ setup(
       author_email='annabelle.harvey@umontreal.ca',
       license='MIT',
       packages=['nslurm','tests'],
+      extras_require={
+        'store': ['h5py'],
+      },
       classifiers=[
         "Development Status :: 3 - Alpha",
         "Topic :: Scientific/Engineering :: Bio-Informatics",
@@ -17,6 +20,8 @@ setup(
       entry_points={
         'console_scripts': [
             'nixtract-slurm = nslurm.nslurm:main',
+            'nixtract-slurm-worker = nslurm.worker:main',
+            'nixtract-slurm-stage = nslurm.stages:main',
         ],
       },
 )
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+from argparse import ArgumentParser
+import nslurm.nslurm as ns
+import nslurm.cost as cost
+import nslurm.extract as extract
+
+#Benchmark of nixtract-slurm on synthetic data, without a cluster: sbatch is replaced by a script printing a job id.
+#  planning    runs the submission path (read_config, get_todo, estimate_costs, get_slurm_params, get_batches,
+#              make_config, make_sh, submit_jobs) on 1k to 1M input files and times each step. Inputs are hard
+#              links to one small NIfTI file, so a million of them only cost directory entries.
+#  extraction  extracts distinct synthetic files in-process with a label atlas (needs a working nixtract) and reports
+#              the time per file, the throughput and the peak memory, with each extraction backend.
+#Peak memory is the peak resident memory of this process so far, sizes are run from small to large so it is the peak
+#of the current size. Extraction inputs are written, and each backend is run, in a child process, so the peak
+#memory of the extraction is its own.
+#Run with: python tests/benchmark.py --sizes 1000 10000 --out results.json
+SIZES = [1000, 10000, 100000, 1000000]
+
+#Input files per directory, as in a BIDS dataset with a directory per subject.
+FILES_PER_DIR = 1000
+
+def generate_parser():
+    parser = ArgumentParser()
+    parser.add_argument("--sizes",help='Optional: Numbers of input files to plan for. Default: 1000 10000 100000 1000000.',dest='sizes',type=int,nargs='+',default=SIZES)
+    parser.add_argument("--shape",help='Optional: Shape of a volume of the synthetic inputs. Default: 40 48 40.',dest='shape',type=int,nargs=3,default=[40,48,40])
+    parser.add_argument("--n_timepoints",help='Optional: Number of timepoints of the synthetic inputs. Default: 200.',dest='n_timepoints',type=int,default=200)
+    parser.add_argument("--n_regions",help='Optional: Number of regions of the synthetic atlas. Default: 64.',dest='n_regions',type=int,default=64)
+    parser.add_argument("--extract_files",help='Optional: Number of files to extract, 0 to skip extraction. Default: 20.',dest='extract_files',type=int,default=20)
+    parser.add_argument("--n_workers",help='Optional: Number of files extracted at the same time. Default: 1.',dest='n_workers',type=int,default=1)
+    parser.add_argument("--backends",help='Optional: Extraction backends to compare. Default: nilearn native.',dest='backends',nargs='+',choices=extract.BACKENDS,default=extract.BACKENDS)
+    parser.add_argument("--static_resources",help='Flag to plan without reading the headers of the inputs, as nixtract-slurm --static_resources.',dest='static_resources',action='store_true')
+    parser.add_argument("--work_dir",help='Optional: Directory for the synthetic data, removed at the end. Default: a temporary directory.',dest='work_dir')
+    parser.add_argument("--out",help='Optional: Path to write the results to as json.',dest='out')
+    return parser
+
+def make_atlas(path, shape, n_regions):
+    """Write a label atlas of n_regions slabs of about the same size.
+
+    Parameters
+    ----------
+    path : str
+        Path to the atlas.
+    shape : tuple
+        Shape of the atlas.
+    n_regions : int
+        Number of regions, labelled 1 to n_regions.
+    """
+    n = int(np.prod(shape))
+    labels = (np.arange(n) * n_regions // n + 1).reshape(shape).astype(np.int16)
+    nib.save(nib.Nifti1Image(labels, np.eye(4)), path)
+
+def make_input(path, shape, n_timepoints, seed=0):
+    """Write a synthetic 4D input of random float32 data."""
+    data = np.random.RandomState(seed).rand(*(tuple(shape) + (n_timepoints,))).astype(np.float32)
+    nib.save(nib.Nifti1Image(data, np.eye(4)), path)
+
+def make_inputs(data_dir, n_files, template):
+    """Make n_files inputs as hard links to a template, FILES_PER_DIR per directory.
+
+    Parameters
+    ----------
+    data_dir : str
+        Directory to make the inputs in.
+    n_files : int
+        Number of inputs.
+    template : str
+        Input file to link to, copied if the filesystem has no hard links.
+    Returns
+    -------
+    str
+        Glob matching the inputs, for the config.
+    """
+    for i in range(n_files):
+        d = os.path.join(data_dir, 'sub-{:04d}'.format(i // FILES_PER_DIR))
+        if i % FILES_PER_DIR == 0:
+            os.makedirs(d)
+        path = os.path.join(d, 'sub-{:07d}_bold.nii.gz'.format(i))
+        try:
+            os.link(template, path)
+        except OSError:
+            shutil.copy(template, path)
+    return os.path.join(data_dir, 'sub-*', '*_bold.nii.gz')
+
+def make_fake_sbatch(bin_dir):
+    """Write an sbatch stand-in that accepts any arguments and prints a job id, as sbatch --parsable does."""
+    path = os.path.join(bin_dir, 'sbatch')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\necho $$\n')
+    os.chmod(path, 0o755)
+    return path
+
+def get_peak():
+    """Get the peak resident memory of this process in bytes (ru_maxrss is in kilobytes on linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def bench_planning(work_dir, n_files, template, roi_file, sbatch, static_resources=False):
+    """Time each step of a submission of n_files inputs.
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory for the inputs and out_path, removed after.
+    n_files : int
+        Number of inputs.
+    template : str
+        Input file the inputs link to.
+    roi_file : str
+        Atlas of the config.
+    sbatch : str
+        sbatch command.
+    static_resources : bool
+        Skip reading the headers of the inputs to predict time and memory.
+    Returns
+    -------
+    dict
+        Seconds of each step, total seconds, number of jobs and peak memory in bytes.
+    """
+    data_dir = os.path.join(work_dir, 'data')
+    out_path = os.path.join(work_dir, 'out')
+    os.makedirs(data_dir)
+    os.makedirs(os.path.join(out_path, 'logs/slurm_output'))
+    config_path = os.path.join(work_dir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump({'input_files': make_inputs(data_dir, n_files, template), 'regressor_files': [], 'roi_file': roi_file}, f)
+
+    steps = {}
+
+    def step(name, func, *args):
+        start = time.time()
+        result = func(*args)
+        steps[name] = time.time() - start
+        return result
+
+    params = step('read_config', ns.read_config, config_path, os.path.join(out_path, 'logs/inventory.json'))
+    files, conf = step('get_todo', ns.get_todo, params['input_files'], params['regressor_files'], out_path, params)
+    costs = None
+    if not static_resources:
+        costs = step('estimate_costs', cost.estimate_costs, files, roi_file)
+    runtime, mem, n_jobs = step('get_slurm_params', ns.get_slurm_params, len(files), None, None, None, costs)
+    batches, batches_conf = step('get_batches', ns.get_batches, n_jobs, files, conf)
+    step('make_config', ns.make_config, batches, batches_conf, params, os.path.join(out_path, 'logs'))
+    submissions = ns.plan_submissions(n_jobs)
+    step('make_sh', ns.make_sh, 'ACCOUNT', runtime, mem, submissions[0]['size'], out_path)
+    step('submit_jobs', ns.submit_jobs, out_path, submissions, sbatch)
+    shutil.rmtree(data_dir)
+    shutil.rmtree(out_path)
+    return {'n_files': n_files, 'steps': steps, 'seconds': sum(steps.values()), 'n_jobs': n_jobs, 'peak_bytes': get_peak()}
+
+def bench_extraction(work_dir, n_files, shape, n_timepoints, roi_file, n_workers=1, backend='nilearn'):
+    """Extract n_files distinct synthetic inputs in-process, as a job does.
+
+    Parameters
+    ----------
+    work_dir : str
+        Directory for the inputs and outputs, removed after.
+    n_files : int
+        Number of inputs.
+    shape : tuple
+        Shape of a volume.
+    n_timepoints : int
+        Number of timepoints.
+    roi_file : str
+        Label atlas.
+    n_workers : int
+        Number of files extracted at the same time.
+    backend : str
+        Extraction backend.
+    Returns
+    -------
+    dict
+        Seconds per file (mean and max), files per second and peak memory in bytes of the worker processes.
+    """
+    out_path = os.path.join(work_dir, 'extract')
+    os.makedirs(os.path.join(out_path, 'logs'))
+    files = [os.path.join(out_path, 'sub-{:04d}_bold.nii.gz'.format(i)) for i in range(n_files)]
+    with ProcessPoolExecutor(1) as executor:
+        list(executor.map(make_input, files, [shape] * n_files, [n_timepoints] * n_files, range(n_files)))
+    ns.make_config([files], [[]], {'roi_file': roi_file}, os.path.join(out_path, 'logs'))
+
+    start = time.time()
+    with ProcessPoolExecutor(1) as executor:
+        returncode, timings = executor.submit(extract.run_in_process, os.path.join(out_path, 'logs', ns.PARAMS_FILE),
+                                              out_path, n_workers, tasks=[(f, None) for f in files],
+                                              backend=backend).result()
+    seconds = time.time() - start
+    shutil.rmtree(out_path)
+    if returncode != 0 or len(timings) == 0:
+        raise RuntimeError('Extraction failed, see the output above.')
+    return {'n_files': len(timings), 'n_workers': n_workers, 'backend': backend, 'mean_seconds': float(np.mean([t[1] for t in timings])),
+            'max_seconds': max([t[1] for t in timings]), 'files_per_second': len(timings) / seconds,
+            'peak_bytes': max([t[2] for t in timings])}
+
+def print_planning(results):
+    """Print the planning results as a table, one row per size."""
+    names = list(results[0]['steps'])
+    print(' '.join(['{:>10}'.format('n_files')] + ['{:>16}'.format(n) for n in names] +
+                   ['{:>10}'.format(n) for n in ['total', 'n_jobs', 'peak']]))
+    for r in results:
+        print(' '.join(['{:>10}'.format(r['n_files'])] + ['{:>16.3f}'.format(r['steps'][n]) for n in names] +
+                       ['{:>10.2f}'.format(r['seconds']), '{:>10}'.format(r['n_jobs']),
+                        '{:>10}'.format(cost.format_mem(r['peak_bytes']))]))
+
+def main():
+    parser = generate_parser()
+    args = parser.parse_args()
+    work_dir = tempfile.mkdtemp(prefix='nslurm-benchmark-', dir=args.work_dir)
+    results = {'shape': args.shape, 'n_timepoints': args.n_timepoints, 'n_regions': args.n_regions, 'planning': []}
+    try:
+        roi_file = os.path.join(work_dir, 'atlas.nii.gz')
+        make_atlas(roi_file, args.shape, args.n_regions)
+        template = os.path.join(work_dir, 'template.nii.gz')
+        make_input(template, args.shape, args.n_timepoints)
+        sbatch = make_fake_sbatch(work_dir)
+
+        for n_files in sorted(args.sizes):
+            print('Planning {} file(s)...'.format(n_files))
+            sys.stdout.flush()
+            results['planning'].append(bench_planning(os.path.join(work_dir, str(n_files)), n_files, template,
+                                                      roi_file, sbatch, args.static_resources))
+        if len(results['planning']) != 0:
+            print_planning(results['planning'])
+
+        results['extraction'] = []
+        for backend in args.backends if args.extract_files > 0 else []:
+            print('Extracting {} file(s) with {} worker(s), {} backend...'.format(args.extract_files, args.n_workers, backend))
+            r = bench_extraction(work_dir, args.extract_files, args.shape, args.n_timepoints, roi_file, args.n_workers,
+                                 backend)
+            results['extraction'].append(r)
+            print('{:.3f}s per file (max {:.3f}s), {:.2f} files/s, peak memory {}.'.format(
+                r['mean_seconds'], r['max_seconds'], r['files_per_second'], cost.format_mem(r['peak_bytes'])))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@ import time
 import json
 import os
 import subprocess
-import nslurm.nslurm as ns
 
         
 def make_test_config(batches,batches_conf,out_path,atlas):
@@ -26,7 +25,10 @@ def make_test_config(batches,batches_conf,out_path,atlas):
             "discard_scans": None,
             "n_jobs": 1
             }
-    ns.make_config(batches,batches_conf,params,out_path)
+    for i in range(len(batches)):
+        p = dict(params,input_files=batches[i],regressor_files=batches_conf[i])
+        with open(os.path.join(out_path,'config_{}.json'.format(i)),'w') as f:
+            json.dump(p,f)
 
 def get_data(name):
     if name == 'dev':
@@ -1,11 +1,27 @@
 import nslurm.nslurm as ns
+import nslurm.cost as cost
+import nslurm.worker as worker
+import nslurm.index as index
+import nslurm.extract as extract
+import nslurm.atlas as atlas
+import nslurm.workqueue as workqueue
+import nslurm.supervisor as supervisor
+import nslurm.stages as stages
+import nslurm.store as store
+import nslurm.telemetry as telemetry
+import nslurm.labels as labels
 import json
+import shlex
 import pytest
 import os
 import tempfile
 import subprocess
 import time
 import csv
+import multiprocessing
+import numpy as np
+import pandas as pd
+import nibabel as nib
 from subprocess import PIPE
 # from nilearn import datasets
 
@@ -43,6 +59,44 @@ class TestInternal:
         assert len(ls) == 2
         assert ls[0].endswith('a.py')
 
+    def test_check_glob_no_sort(self,tmpdir):
+        for i in range(3):
+            open(tmpdir / "{}.py".format(i),"x")
+        ls = ns.check_glob(str(os.path.join(tmpdir,'*.py')),sort=False)
+        assert sorted(ls) == [str(tmpdir / "{}.py".format(i)) for i in range(3)]
+        assert ns.check_glob(None) == []
+
+    def test_iter_glob_matches_glob(self,tmpdir):
+        import glob
+        for sub in ['sub-01','sub-02','.hidden']:
+            os.makedirs(tmpdir / sub / "func")
+            open(tmpdir / sub / "func" / "bold.nii.gz","x")
+            open(tmpdir / sub / "func" / "confounds.tsv","x")
+        open(tmpdir / "sub-03","x")
+        for pattern in ['*/func/*.nii.gz','sub-*/*/bold.nii.gz','sub-0[12]/func/*','*','sub-01/func/bold.nii.gz','nothing/*']:
+            pattern = os.path.join(str(tmpdir),pattern)
+            assert sorted(ns.scan.iter_glob(pattern,n_threads=2)) == sorted(glob.glob(pattern))
+
+    def test_read_config_inventory(self,tmpdir):
+        os.mkdir(tmpdir / "data")
+        for i in range(2):
+            open(tmpdir / "data" / "{}.nii.gz".format(i),"x")
+        d = {'input_files':str(tmpdir / "data" / "*.nii.gz"),'regressor_files':[]}
+        with open(tmpdir / 'test.json', 'w') as json_file:
+            json.dump(d, json_file)
+        inventory = str(tmpdir / "inventory.json")
+
+        assert len(ns.read_config(tmpdir/'test.json',inventory)['input_files']) == 2
+        assert os.path.exists(inventory)
+        key = json.dumps([os.getcwd(),d['input_files'],d['regressor_files']])
+        assert ns.scan.load_inventory(inventory,key)['input_files'] == ns.read_config(tmpdir/'test.json',inventory)['input_files']
+
+        #new file changes the directory mtime, so the inventory is out of date
+        time.sleep(0.01)
+        open(tmpdir / "data" / "2.nii.gz","x")
+        assert ns.scan.load_inventory(inventory,key) is None
+        assert len(ns.read_config(tmpdir/'test.json',inventory)['input_files']) == 3
+
     def test_replace_file_ext(self):
         ts = ['a_timeseries.tsv','/path/to/b_timeseries.tsv','../path/to/c_timeseries.tsv']
         nii = [ns.replace_file_ext(t) for t in ts]
@@ -59,6 +113,93 @@ class TestInternal:
         completed = ns.get_completed(tmpdir)
         assert len(completed) == 3
 
+    def test_get_completed_uses_index(self,tmpdir):
+        open(tmpdir / "a_timeseries.tsv","x")
+        assert ns.get_completed(tmpdir) == ['a.nii.gz']
+        assert os.path.exists(tmpdir / "logs/completed/index.txt")
+
+        #not rescanned once the index exists, jobs add to it instead
+        open(tmpdir / "b_timeseries.tsv","x")
+        index.record_completed(str(tmpdir / "logs/completed/0_1.txt"),[{'name':'c.nii.gz'}])
+        assert sorted(ns.get_completed(tmpdir)) == ['a.nii.gz','c.nii.gz']
+        assert sorted(os.listdir(tmpdir / "logs/completed")) == ['index.lock','index.txt']
+
+    def test_compact_index_running_job(self,tmpdir):
+        shard = str(tmpdir / "logs/completed/0_1.txt")
+        os.makedirs(tmpdir / "logs/completed")
+        index.record_completed(shard,[{'name':'a.nii.gz'}])
+        #a line still being written is kept for the next merge
+        with open(str(tmpdir / "logs/completed/0_2.txt"),"w") as f:
+            f.write("b.nii.gz\nc.nii")
+        assert sorted(index.compact_index(str(tmpdir))) == ['a.nii.gz','b.nii.gz']
+        assert sorted(os.listdir(tmpdir / "logs/completed")) == ['0_2' + index.COMPACTING_SUFFIX,'index.lock','index.txt']
+        with open(str(tmpdir / "logs/completed/0_2" + index.COMPACTING_SUFFIX),"a") as f:
+            f.write(".gz\n")
+        #records of the running job after the merge go to a new shard
+        index.record_completed(shard,[{'name':'d.nii.gz'}])
+        assert sorted(index.compact_index(str(tmpdir))) == ['a.nii.gz','b.nii.gz','c.nii.gz','d.nii.gz']
+        assert sorted(os.listdir(tmpdir / "logs/completed")) == ['index.lock','index.txt']
+
+    def test_compact_index_concurrent(self,tmpdir):
+        #jobs record files and merge the index at the same time, no record is lost
+        os.makedirs(tmpdir / "logs/completed")
+        procs = [multiprocessing.Process(target=record_and_compact,args=(str(tmpdir),p,20)) for p in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            assert p.exitcode == 0
+        completed = index.compact_index(str(tmpdir))
+        assert len(completed) == 80
+        assert sorted(os.listdir(tmpdir / "logs/completed")) == ['index.lock','index.txt']
+
+    def test_index_ignores_partial_line(self,tmpdir):
+        with open(tmpdir / "shard.txt","w") as f:
+            f.write("a.nii.gz\nb.nii")
+        assert index.read_shard(str(tmpdir / "shard.txt")) == [{'name':'a.nii.gz'}]
+
+    def test_index_record_round_trip(self,tmpdir):
+        make_nifti(tmpdir / "a.nii.gz",(2,2,2,3))
+        with open(tmpdir / "a_timeseries.tsv","w") as f:
+            f.write("region1\n1\n2\n3\n")
+        record = index.make_record(str(tmpdir / "a.nii.gz"),str(tmpdir / "a_timeseries.tsv"),'hash')
+        assert record['n_rows'] == 4
+        assert index.parse_record(index.format_record(record)[:-1]) == record
+
+    def test_count_rows_truncated(self,tmpdir):
+        with open(tmpdir / "a_timeseries.tsv","w") as f:
+            f.write("region1\n1\n2")
+        assert index.count_rows(str(tmpdir / "a_timeseries.tsv")) == -1
+
+    def test_get_todo_stale_and_truncated(self,tmpdir):
+        params = {'input_files':[],'regressor_files':[],'roi_file':'atlas.nii.gz','discard_scans':None}
+        inputs = []
+        os.makedirs(tmpdir / "logs/completed")
+        for name in ['a','b','c']:
+            make_nifti(tmpdir / "{}.nii.gz".format(name),(2,2,2,3))
+            with open(tmpdir / "{}_timeseries.tsv".format(name),"w") as f:
+                f.write("region1\n1\n2\n3\n")
+            record = index.make_record(str(tmpdir / "{}.nii.gz".format(name)),str(tmpdir / "{}_timeseries.tsv".format(name)),index.hash_params(params))
+            index.record_completed(str(tmpdir / "logs/completed/0_0.txt"),[record])
+            inputs.append(str(tmpdir / "{}.nii.gz".format(name)))
+
+        todo,_ = ns.get_todo(inputs,[],tmpdir,params,verify=True)
+        assert todo == []
+
+        #truncated output
+        with open(tmpdir / "b_timeseries.tsv","w") as f:
+            f.write("region1\n1\n")
+        todo,_ = ns.get_todo(inputs,[],tmpdir,params,verify=True)
+        assert todo == [inputs[1]]
+        #not checked without verify
+        todo,_ = ns.get_todo(inputs,[],tmpdir,params)
+        assert todo == []
+
+        #changed parameters
+        params['roi_file'] = 'other.nii.gz'
+        todo,_ = ns.get_todo(inputs,[],tmpdir,params)
+        assert todo == inputs
+
     def test_get_todo_none_completed_with_reg_files(self,tmpdir):
         todo,todo_conf = ns.get_todo(['a.nii.gz','b.nii.gz'],['a.csv','b.csv'],tmpdir)
 
@@ -101,6 +242,16 @@ class TestInternal:
         assert mem == '1G'
         assert n_jobs == 1
     
+    def test_get_batch_runtime(self):
+        #count batches put the remainder in the last one
+        batches,_ = ns.get_batches(3,['f{}'.format(i) for i in range(11)],[])
+        assert [len(b) for b in batches] == [3,3,5]
+        costs = dict([('f{}'.format(i),(100,0)) for i in range(11)])
+        assert ns.get_batch_runtime(batches,costs) == cost.format_time(2*500)
+        assert ns.get_batch_runtime(batches,costs,cpus=2) == cost.format_time(2*300)
+        assert ns.get_batch_runtime(batches) == '0:05:00'
+        assert ns.get_batch_runtime(batches+[['f{}'.format(i) for i in range(40)]]) == cost.format_time(2*40*5)
+
     def test_get_slurm_params_n2000(self):
         rtime,mem,n_jobs = ns.get_slurm_params(2000,runtime=None,mem=None,n_jobs=None)
         assert rtime == '0:33:20'
@@ -137,6 +288,148 @@ class TestInternal:
         assert mem == '1G'
         assert n_jobs == 10
 
+    def test_get_slurm_params_n2000_costs(self):
+        costs = [(10,2**30)]*2000
+        rtime,mem,n_jobs = ns.get_slurm_params(2000,runtime=None,mem=None,n_jobs=None,costs=costs)
+        assert rtime == '1:07:00'
+        assert mem == '1229M'
+        assert n_jobs == 10
+
+    def test_get_slurm_params_n2000_time_set_costs(self):
+        costs = [(10,2**30)]*2000
+        rtime,mem,n_jobs = ns.get_slurm_params(2000,runtime='1:00:00',mem='2G',n_jobs=None,costs=costs)
+        assert rtime == '1:00:00'
+        assert mem == '2G'
+        assert n_jobs == 11
+
+    def test_get_slurm_params_time_set_long_files(self, capsys):
+        #more predicted work than --time allows: never more jobs than files
+        costs = [(400,2**30)]*10
+        rtime,mem,n_jobs = ns.get_slurm_params(10,runtime='0:10:00',costs=costs)
+        assert rtime == '0:10:00'
+        assert n_jobs == 10
+        batches, _ = ns.get_batches(n_jobs, ['f{}'.format(i) for i in range(10)], [])
+        assert len(batches) == 10
+        assert 'Warning' not in capsys.readouterr().out
+        #a single file longer than --time cannot fit in any job
+        rtime,mem,n_jobs = ns.get_slurm_params(10,runtime='0:05:00',costs=costs)
+        assert n_jobs == 10
+        assert 'longest file' in capsys.readouterr().out
+
+    def test_get_slurm_params_max_jobs(self):
+        rtime,mem,n_jobs = ns.get_slurm_params(20000,runtime=None,mem=None,n_jobs=None,max_jobs=20)
+        assert n_jobs == 20
+        assert rtime == '2:46:40'
+        rtime,mem,n_jobs = ns.get_slurm_params(20000,runtime=None,mem=None,n_jobs=100,max_jobs=20)
+        assert n_jobs == 20
+
+    def test_get_slurm_params_costs_task_length(self):
+        #short files: few jobs, so that each runs at least TASK_MIN_SECONDS
+        rtime,mem,n_jobs = ns.get_slurm_params(2000,costs=[(1,2**30)]*2000)
+        assert n_jobs == 3
+        #long files: enough jobs that none is predicted above TASK_MAX_SECONDS
+        rtime,mem,n_jobs = ns.get_slurm_params(100,costs=[(1000,2**30)]*100)
+        assert n_jobs == 19
+
+    def test_get_slurm_params_cpus(self):
+        rtime,mem,n_jobs = ns.get_slurm_params(2000,runtime=None,mem=None,n_jobs=None,cpus=4)
+        assert rtime == '0:08:20'
+        assert mem == '4G'
+        assert n_jobs == 10
+        rtime,mem,n_jobs = ns.get_slurm_params(2000,costs=[(10,2**30)]*2000,cpus=4)
+        assert mem == '4916M'
+        assert n_jobs == 8
+        assert rtime == '0:21:10'
+
+    def test_parse_mem(self):
+        assert cost.parse_mem('1G') == 2**30
+        assert cost.parse_mem('500MB') == 500*2**20
+        assert cost.parse_mem('2048') == 2**31
+        with pytest.raises(ValueError):
+            cost.parse_mem('lots')
+        assert cost.get_n_workers('4G',2**30,8) == 3
+        assert cost.get_n_workers('1G',2**30,8) == 1
+
+    def test_get_atlas_info(self,tmpdir):
+        labels = np.zeros((4,4,4))
+        labels[0,0,0] = 1
+        labels[1,1,1] = 2
+        make_nifti(tmpdir / "labels.nii.gz",labels)
+        make_nifti(tmpdir / "maps.nii.gz",(4,4,4,5))
+        assert cost.get_atlas_info(str(tmpdir / "labels.nii.gz")) == (2,False,64)
+        assert cost.get_atlas_info(str(tmpdir / "maps.nii.gz")) == (5,True,64)
+        assert cost.get_atlas_info('nilearn:schaefer:100-7-2') == (0,False,0)
+
+    def test_estimate_costs(self,tmpdir):
+        make_nifti(tmpdir / "short.nii.gz",(4,4,4,10))
+        make_nifti(tmpdir / "long.nii.gz",(4,4,4,100))
+        make_nifti(tmpdir / "maps.nii.gz",(4,4,4,5))
+        files = [str(tmpdir / "short.nii.gz"),str(tmpdir / "long.nii.gz")]
+        costs = cost.estimate_costs(files,str(tmpdir / "maps.nii.gz"))
+        assert len(costs) == 2
+        assert costs[0][0] < costs[1][0]
+        assert costs[0][1] < costs[1][1]
+
+    def test_estimate_costs_streamed(self,tmpdir):
+        labels_data = np.zeros((40,40,40))
+        labels_data[:20] = 1
+        labels_data[20:] = 2
+        make_nifti(tmpdir / "labels.nii.gz",labels_data)
+        atlas_info = cost.get_atlas_info(str(tmpdir / "labels.nii.gz"))
+        short = cost.estimate_file_cost(64000,100,atlas_info,backend='native')
+        long = cost.estimate_file_cost(64000,2000,atlas_info,backend='native')
+        assert long[1] - short[1] < 2**20
+        assert long[1] < cost.estimate_file_cost(64000,2000,atlas_info)[1]
+        #probabilistic atlases are not streamed
+        assert cost.estimate_file_cost(64000,2000,(5,True,64000),backend='native') == cost.estimate_file_cost(64000,2000,(5,True,64000))
+        #inputs read ahead are held in memory, the current one too with the native backend
+        assert cost.estimate_file_cost(64000,100,atlas_info,prefetch=2)[1] - cost.estimate_file_cost(64000,100,atlas_info)[1] == 2*8*64000*100
+        assert cost.estimate_file_cost(64000,100,atlas_info,backend='native',prefetch=2)[1] - short[1] == 3*8*64000*100
+
+    def test_fit_model_small_files(self):
+        #observations growing faster than predicted give a negative intercept, small files must still cost something
+        history = []
+        for t,factor in [(100,1),(200,3),(400,7)]:
+            pred_sec,pred_mem = cost.estimate_file_cost(1000,t,(10,False,1000))
+            history.append({'n_voxels':1000,'n_timepoints':t,'n_rois':10,'probabilistic':False,'atlas_voxels':1000,
+                            'seconds':factor*pred_sec,'peak_bytes':factor*pred_mem})
+        model = cost.fit_model(history)
+        assert model['sec'][0] >= 0 and model['mem'][0] >= 0
+        sec,mem = cost.estimate_file_cost(1000,1,(10,False,1000),model)
+        assert sec > 0 and mem > 0
+
+    def test_format_mem(self):
+        assert cost.format_mem(2**30) == '1024M'
+        assert cost.format_mem(1) == '1M'
+
+    def test_fit_model(self,tmpdir):
+        history = []
+        for t in [100,200,400]:
+            pred_sec,pred_mem = cost.estimate_file_cost(1000,t,(10,False,1000))
+            history.append({'file':'{}.nii.gz'.format(t),'roi_file':'atlas.nii.gz','n_voxels':1000,'n_timepoints':t,
+                            'n_rois':10,'probabilistic':False,'atlas_voxels':1000,
+                            'seconds':3*pred_sec,'peak_bytes':2*pred_mem})
+        os.mkdir(tmpdir / "history")
+        cost.record_history(str(tmpdir / "history/0_0.jsonl"),history)
+        loaded = cost.load_history(str(tmpdir / "history"),'atlas.nii.gz')
+        assert len(loaded) == 3
+        assert cost.load_history(str(tmpdir / "history"),'other.nii.gz') == []
+        assert len(cost.load_history(str(tmpdir / "history"),'atlas.nii.gz','nilearn')) == 3
+        assert cost.load_history(str(tmpdir / "history"),'atlas.nii.gz','native') == []
+
+        model = cost.fit_model(loaded)
+        sec,mem = cost.estimate_file_cost(1000,400,(10,False,1000),model)
+        assert sec == pytest.approx(history[-1]['seconds'])
+        assert mem >= history[-1]['peak_bytes'] - 1
+        assert cost.fit_model([]) is None
+
+    def test_time_extraction(self):
+        command = ['sh','-c','echo "[00:00:00] Extracting a.nii.gz"; sleep 0.2; echo "[00:00:00] Extracting b.nii.gz"']
+        returncode,timings = worker.time_extraction(command,['/data/a.nii.gz','/data/b.nii.gz'])
+        assert returncode == 0
+        assert [t[0] for t in timings] == ['/data/a.nii.gz','/data/b.nii.gz']
+        assert timings[0][1] >= 0.2
+
     def test_split_list_non_empty(self):
         a = [1,2,3,4,5,6,7]
         splits = ns.split_list(3,a)
@@ -149,6 +442,51 @@ class TestInternal:
         assert len(splits) == 3
         assert splits[0] == []
 
+    def test_pack_list_balanced(self):
+        weights = [10,1,1,1,1,1,1,1,1,1,1]
+        chunks = ns.pack_list(2,weights)
+        assert sorted(sum(chunks,[])) == list(range(len(weights)))
+        assert chunks[0] == [0]
+        assert len(chunks[1]) == 10
+
+    def test_pack_list_more_chunks_than_items(self):
+        chunks = ns.pack_list(3,[5,2])
+        assert len(chunks) == 3
+        assert [] in chunks
+
+    def test_get_file_weights_voxels(self,tmpdir):
+        for i,t in enumerate([10,20]):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),(2,3,4,t))
+        files = [str(tmpdir / "0.nii.gz"),str(tmpdir / "1.nii.gz")]
+        assert ns.get_file_weights(files,'voxels') == [240,480]
+        assert ns.get_file_weights(files,'voxels',cost.read_headers(files)) == [240,480]
+
+    def test_get_batches_weighted_keeps_pairs(self):
+        files = ['a.nii.gz','b.nii.gz','c.nii.gz','d.nii.gz']
+        conf = ['a.csv','b.csv','c.csv','d.csv']
+        batches,batches_conf = ns.get_batches(2,files,conf,weights=[4,3,2,1])
+        assert batches == [['a.nii.gz','d.nii.gz'],['b.nii.gz','c.nii.gz']]
+        assert batches_conf == [['a.csv','d.csv'],['b.csv','c.csv']]
+
+    def test_get_batches_local_disk(self,tmpdir):
+        files,conf = [],[]
+        for i,size in enumerate([500,100,100,100,100,300]):
+            with open(tmpdir / "{}.nii.gz".format(i),"wb") as f:
+                f.write(b'0'*size)
+            with open(tmpdir / "{}.tsv".format(i),"wb") as f:
+                f.write(b'0'*10)
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+            conf.append(str(tmpdir / "{}.tsv".format(i)))
+        assert ns.get_file_sizes(files,conf) == [510,110,110,110,110,310]
+        #more batches than asked, each fitting in the local disk
+        for weights in [None,ns.get_file_weights(files)]:
+            batches,batches_conf = ns.get_batches(2,files,conf,weights,max_bytes=520)
+            assert len(batches) > 2 and sorted(sum(batches,[])) == sorted(files)
+            assert all([sum(ns.get_file_sizes(b,c)) <= 520 for b,c in zip(batches,batches_conf)])
+        assert len(ns.get_batches(2,files,conf,max_bytes=10000)[0]) == 2
+        with pytest.raises(ValueError):
+            ns.get_batches(2,files,conf,max_bytes=400)
+
     def test_log_batches(self,tmpdir):
         batches,_ = ns.get_batches(2,[1,2,3,4,5,6,7],[])
         os.mkdir(tmpdir/"logs")
@@ -165,7 +503,24 @@ class TestInternal:
         batches,batches_conf = ns.get_batches(2,[1,2,3,4,5,6,7],[])
         ns.make_config(batches,batches_conf,d,tmpdir)
         configs = [i for i in os.listdir(tmpdir) if i.endswith('.json')]
-        assert len(configs) == 2
+        assert len(configs) == 1
+
+    def test_read_batch(self,tmpdir):
+        os.mkdir(tmpdir / "logs")
+        d = {'input_files':['a'],'regressor_files':['b'],'roi_file':'atlas.nii.gz'}
+        files = ['{}.nii.gz'.format(i) for i in range(7)]
+        conf = ['{}.tsv'.format(i) for i in range(7)]
+        batches,batches_conf = ns.get_batches(3,files,conf)
+        ns.make_config(batches,batches_conf,d,str(tmpdir / "logs"))
+        with open(tmpdir / "logs" / ns.PARAMS_FILE) as f:
+            assert json.load(f) == {'roi_file':'atlas.nii.gz','verbose':True}
+        for i in range(3):
+            assert ns.read_batch(str(tmpdir),i) == (batches[i],batches_conf[i])
+
+        #without regressor files
+        batches,batches_conf = ns.get_batches(3,files,[])
+        ns.make_config(batches,batches_conf,d,str(tmpdir / "logs"))
+        assert ns.read_batch(str(tmpdir),2) == (batches[2],[])
 
     def test_make_sh(self,tmpdir):
         os.mkdir(tmpdir / "logs")
@@ -174,8 +529,765 @@ class TestInternal:
         with open(tmpdir / 'logs/submit.sh', 'r') as f:
             lines = f.readlines()
         assert lines[2] == "#SBATCH --time=TIME\n"
-        assert lines[-2] == "nixtract-nifti -c {}/logs/config_${{SLURM_ARRAY_TASK_ID}}.json {}\n".format(tmpdir,tmpdir)
-        assert len(lines) == 9
+        assert lines[5] == "#SBATCH --array=0-9\n"
+        assert lines[-1] == "nixtract-slurm-worker -c {}/logs/params.json --batch ${{BATCH}} {}\n".format(tmpdir,tmpdir)
+        assert len(lines) == 10
+
+    def test_make_sh_cpus(self,tmpdir):
+        os.mkdir(tmpdir / "logs")
+        ns.make_sh('ACCOUNT','TIME','MEM',10,tmpdir,cpus=8)
+        with open(tmpdir / 'logs/submit.sh', 'r') as f:
+            lines = f.readlines()
+        assert "#SBATCH --cpus-per-task=8\n" in lines
+        assert len(lines) == 11
+
+    def test_split_batch(self,tmpdir):
+        files = []
+        for i,size in enumerate([30,10,10,10]):
+            with open(tmpdir / "{}.nii.gz".format(i),"w") as f:
+                f.write("x"*size)
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        params = {'input_files':files,'regressor_files':['{}.tsv'.format(i) for i in range(4)],'n_jobs':4}
+        parts = worker.split_batch(params,2)
+        assert [p['input_files'] for p in parts] == [[files[0]],files[1:]]
+        assert parts[1]['regressor_files'] == ['1.tsv','2.tsv','3.tsv']
+        assert parts[0]['n_jobs'] == 1
+        assert len(worker.split_batch(params,8)) == 4
+
+    def test_run_in_process(self,tmpdir):
+        pytest.importorskip('nixtract.cli.nifti')
+        labels = np.zeros((4,4,4),dtype=np.int16)
+        labels[1:2] = 1
+        labels[2:] = 2
+        make_nifti(tmpdir / "atlas.nii.gz",labels)
+        files = []
+        for i in range(3):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),np.random.rand(4,4,4,10).astype(np.float32))
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        with open(tmpdir / "config.json","w") as f:
+            json.dump({'input_files':files,'roi_file':str(tmpdir / "atlas.nii.gz"),'discard_scans':2},f)
+
+        for n_workers in [1,2]:
+            done = []
+            returncode,timings = extract.run_in_process(str(tmpdir / "config.json"),str(tmpdir),n_workers,
+                                                        lambda *t: done.append(t[0]))
+            assert returncode == 0
+            assert sorted(done) == files
+            for f in files:
+                assert index.count_rows(index.get_output(f,str(tmpdir))) == 9
+
+        #same output from the resampled atlas cache
+        before = open(index.get_output(files[0],str(tmpdir))).read()
+        assert atlas.prepare_atlas_cache(files,{'roi_file':str(tmpdir / "atlas.nii.gz")},str(tmpdir)) == 1
+        assert extract.run_in_process(str(tmpdir / "config.json"),str(tmpdir))[0] == 0
+        assert open(index.get_output(files[0],str(tmpdir))).read() == before
+
+        #files claimed from the work queue, with an empty batch config
+        with open(tmpdir / "config_queue.json","w") as f:
+            json.dump({'input_files':[],'roi_file':str(tmpdir / "atlas.nii.gz"),'discard_scans':2},f)
+        workqueue.make_queue(files,[],str(tmpdir))
+        for n_workers in [1,2]:
+            claims = {}
+            tasks = workqueue.iter_claims(str(tmpdir),'a',claims)
+            returncode,timings = extract.run_in_process(str(tmpdir / "config_queue.json"),str(tmpdir),n_workers,tasks=tasks)
+            assert returncode == 0
+            assert len(timings) == (3 if n_workers == 1 else 0)
+            assert len(claims) == len(timings)
+
+    def test_label_signals(self):
+        from nilearn.regions import img_to_signals_labels
+        rng = np.random.RandomState(0)
+        labels_data = rng.randint(0,5,(6,5,4)).astype(np.int32)
+        mask = np.ones((6,5,4),dtype=np.int8)
+        mask[:3] = 0
+        data = rng.rand(6,5,4,7).astype(np.float32)
+        data[5,4,3,0] = np.nan
+        with pytest.warns(UserWarning):
+            expected,names = img_to_signals_labels(make_img(data),make_img(labels_data),mask_img=make_img(mask))[:2]
+        idx = labels.make_index(labels_data,mask)
+        signals = labels.get_signals(data,idx)
+        assert list(idx['labels']) == list(names)
+        assert signals.dtype == np.float32
+        np.testing.assert_allclose(signals,expected,rtol=1e-5)
+        #a region outside the mask gets a zero signal, as in the nilearn nixtract uses
+        mask[labels_data == 2] = 0
+        signals = labels.get_signals(data.astype(np.float64),labels.make_index(labels_data,mask))
+        assert signals.dtype == np.float64 and signals.shape == (7,4)
+        assert (signals[:,1] == 0).all() and (signals[:,0] != 0).all()
+
+    def test_label_signals_masker(self):
+        try:
+            from nilearn.maskers import NiftiLabelsMasker
+        except ImportError:
+            from nilearn.input_data import NiftiLabelsMasker
+        rng = np.random.RandomState(0)
+        labels_data = np.zeros((6,5,4),dtype=np.int32)
+        labels_data[:2] = 1
+        labels_data[2:4,:3] = 4
+        labels_data[4:] = 9
+        data = rng.rand(6,5,4,12).astype(np.float32)
+        masker = NiftiLabelsMasker(make_img(labels_data))
+        assert labels.is_supported(masker)
+        assert not labels.is_supported(NiftiLabelsMasker(make_img(labels_data),smoothing_fwhm=6))
+        expected = masker.fit_transform(make_img(data))
+        signals = labels.clean_signals(labels.get_signals(data,labels.make_index(labels_data)),masker)
+        np.testing.assert_allclose(signals,expected,rtol=1e-5)
+
+    def test_label_signals_masker_clean(self):
+        #older nilearn fails to clean signals with recent numpy
+        NiftiLabelsMasker = pytest.importorskip('nilearn.maskers').NiftiLabelsMasker
+        rng = np.random.RandomState(0)
+        labels_data = rng.randint(0,5,(6,5,4)).astype(np.int32)
+        data = rng.rand(6,5,4,40).astype(np.float32) + np.arange(40,dtype=np.float32)*0.01
+        confounds = rng.rand(40,3)
+        for kwargs in [{'detrend':True,'standardize':'zscore_sample'},{'detrend':True,'high_pass':0.01,'t_r':2.}]:
+            masker = NiftiLabelsMasker(make_img(labels_data),**kwargs)
+            expected = masker.fit_transform(make_img(data),confounds=confounds)
+            signals = labels.clean_signals(labels.get_signals(data,labels.make_index(labels_data)),masker,confounds)
+            np.testing.assert_allclose(signals,expected,rtol=1e-4,atol=1e-5)
+
+    def test_label_signals_streamed(self,tmpdir,monkeypatch):
+        rng = np.random.RandomState(0)
+        labels_data = rng.randint(0,4,(5,6,7)).astype(np.int32)
+        data = rng.rand(5,6,7,30).astype(np.float32)
+        idx = labels.make_index(labels_data)
+        expected = labels.get_signals(data,idx)
+        #a few volumes per block
+        monkeypatch.setattr(labels,'READ_BYTES',4*5*6*7*8)
+        for name in ["data.nii","data.nii.gz"]:
+            make_nifti(tmpdir / name,data)
+            img = nib.load(str(tmpdir / name),keep_file_open=True)
+            np.testing.assert_array_equal(labels.get_signals(img.dataobj,idx),expected)
+            np.testing.assert_array_equal(labels.get_signals(img.dataobj,idx,start=7),expected[7:])
+
+    def test_regress_confounds(self):
+        rng = np.random.RandomState(0)
+        signals = rng.rand(100,20) + np.arange(100)[:,np.newaxis] * 0.01
+        confounds = rng.rand(100,3)
+        #collinear and constant confounds are dropped
+        confounds = np.hstack([confounds,2*confounds[:,:1],np.ones((100,1))])
+        centered = confounds[:,:3] - confounds[:,:3].mean(axis=0)
+        expected = signals - centered.dot(np.linalg.lstsq(centered,signals,rcond=None)[0])
+        np.testing.assert_allclose(labels.regress_confounds(signals,confounds),expected,atol=1e-10)
+        #with detrending, residuals of the trend and the confounds together
+        design = np.hstack([np.ones((100,1)),np.arange(100)[:,np.newaxis],confounds[:,:3]])
+        expected = signals - design.dot(np.linalg.lstsq(design,signals,rcond=None)[0])
+        residuals = labels.regress_confounds(signals,confounds,detrend=True)
+        trend = design[:,:2]
+        residuals -= trend.dot(np.linalg.lstsq(trend,residuals,rcond=None)[0])
+        np.testing.assert_allclose(residuals,expected,atol=1e-10)
+        assert labels.regress_confounds(signals.astype(np.float32),confounds).dtype == np.float32
+
+    def test_pipeline_extraction(self,tmpdir):
+        pytest.importorskip('nixtract.cli.nifti')
+        labels_data = np.zeros((6,6,6),dtype=np.int16)
+        labels_data[:3] = 1
+        labels_data[3:] = 2
+        make_nifti(tmpdir / "atlas.nii.gz",labels_data)
+        files = []
+        for i in range(4):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),np.random.rand(6,6,6,10).astype(np.float32))
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        #a file that cannot be read fails alone
+        files.insert(2,str(tmpdir / "missing.nii.gz"))
+        with open(tmpdir / "config.json","w") as f:
+            json.dump({'input_files':files,'roi_file':str(tmpdir / "atlas.nii.gz"),'discard_scans':1},f)
+        for backend in extract.BACKENDS:
+            outputs = {}
+            for prefetch in [0,2]:
+                out = str(tmpdir / "{}_{}".format(backend,prefetch))
+                os.makedirs(out)
+                stats = []
+                returncode,timings = extract.run_in_process(str(tmpdir / "config.json"),out,backend=backend,
+                                                            on_stats=lambda *row: stats.append(row),prefetch_inputs=prefetch)
+                assert returncode == 1 and [t[0] for t in timings] == files[:2] + files[3:]
+                assert [r[0] for r in stats] == files and [r[3] for r in stats] == [False,False,True,False,False]
+                if prefetch > 0:
+                    assert set(stats[0][4]['stages']) == set(['setup','read','extract','write'])
+                outputs[prefetch] = [pd.read_table(index.get_output(f,out)).values for f,_,_ in timings]
+            for a,b in zip(outputs[0],outputs[2]):
+                np.testing.assert_array_equal(a,b)
+
+    def test_run_pipeline(self,monkeypatch):
+        #extraction stand-ins, so the threads of the pipeline are tested without nixtract
+        events = []
+        def load_input(fname):
+            if fname == 'bad.nii.gz':
+                raise IOError(fname)
+            events.append(('load',fname))
+            return 'img_' + fname
+        def compute_file(task,img=None):
+            events.append(('compute',task[0]))
+            return (task[0],1.,0,None,False,img is None,{'stages':{}}),img
+        monkeypatch.setattr(extract,'load_input',load_input)
+        monkeypatch.setattr(extract,'compute_file',compute_file)
+        monkeypatch.setattr(extract,'write_output',lambda result,img: result + (img,))
+
+        files = ['{}.nii.gz'.format(i) for i in range(6)]
+        files.insert(3,'bad.nii.gz')
+        for depth in [0,1,3]:
+            del events[:]
+            done = []
+            extract.run_pipeline([(f,None) for f in files],depth,done.append)
+            #written in order, each with its own prefetched input
+            assert [r[0] for r in done] == files
+            assert [r[-1] for r in done] == ['img_' + f if f != 'bad.nii.gz' else None for f in files]
+            #an input that cannot be read is left to compute_file, which reports it
+            assert [r[5] for r in done] == [f == 'bad.nii.gz' for f in files]
+            assert 'read' in done[0][6]['stages']
+            #never more than depth inputs read ahead of the file being extracted
+            for i,f in enumerate([f for f in files if f != 'bad.nii.gz']):
+                loaded = [e[1] for e in events[:events.index(('compute',f))] if e[0] == 'load']
+                assert len(loaded) <= i + 1 + depth
+
+        #a failed write is raised once the other outputs are written
+        done = []
+        def finish(result):
+            if result[0] == '1.nii.gz':
+                raise OSError('disk full')
+            done.append(result[0])
+        with pytest.raises(OSError):
+            extract.run_pipeline([(f,None) for f in files],2,finish)
+        assert done == [f for f in files if f != '1.nii.gz']
+
+        #an error while extracting stops the pipeline after writing the finished files
+        def compute_error(task,img=None):
+            if task[0] == '2.nii.gz':
+                raise MemoryError()
+            return compute_file(task,img)
+        monkeypatch.setattr(extract,'compute_file',compute_error)
+        done = []
+        with pytest.raises(MemoryError):
+            extract.run_pipeline([(f,None) for f in files],2,done.append)
+        assert [r[0] for r in done] == files[:2]
+
+    def test_prefetch_regressors(self,tmpdir):
+        pytest.importorskip('nixtract.cli.nifti')
+        tasks = []
+        for i in range(5):
+            conf = None
+            if i != 2:
+                conf = str(tmpdir / "{}.tsv".format(i))
+                pd.DataFrame({'a':np.arange(10)+i,'b':np.ones(10),'c':np.zeros(10)}).to_csv(conf,sep='\t',index=False)
+            tasks.append(('{}.nii.gz'.format(i),conf))
+        params = {'regressors':['a','b'],'load_confounds_kwargs':None}
+        prefetched = list(extract.prefetch_regressors(iter(tasks),params,depth=2))
+        assert [t[:2] for t in prefetched] == tasks
+        assert prefetched[2][2] is None
+        names,array,load_confounds = prefetched[3][2]
+        assert list(names) == ['a','b'] and not load_confounds
+        np.testing.assert_array_equal(array[:,0],np.arange(10)+3)
+        #errors are reported with their file
+        params['regressors'] = ['missing']
+        assert 'Not all regressors' in list(extract.prefetch_regressors(iter(tasks[:1]),params))[0][2]
+
+    def test_native_extraction(self,tmpdir):
+        pytest.importorskip('nixtract.cli.nifti')
+        labels_data = np.zeros((6,6,6),dtype=np.int16)
+        labels_data[:2] = 1
+        labels_data[2:4] = 3
+        labels_data[4:,:3] = 7
+        make_nifti(tmpdir / "atlas.nii.gz",labels_data)
+        mask = np.ones((6,6,6),dtype=np.int8)
+        mask[:,:,0] = 0
+        make_nifti(tmpdir / "mask.nii.gz",mask)
+        files = []
+        for i in range(2):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),np.random.rand(6,6,6,20).astype(np.float32))
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        with open(tmpdir / "config.json","w") as f:
+            json.dump({'input_files':files,'roi_file':str(tmpdir / "atlas.nii.gz"),'mask_img':str(tmpdir / "mask.nii.gz"),
+                       'discard_scans':2},f)
+
+        outputs = {}
+        for backend in extract.BACKENDS:
+            out = str(tmpdir / backend)
+            os.makedirs(out)
+            returncode,timings = extract.run_in_process(str(tmpdir / "config.json"),out,2,backend=backend)
+            assert returncode == 0 and len(timings) == 2
+            outputs[backend] = [pd.read_table(index.get_output(f,out)) for f in files]
+        for a,b in zip(outputs['nilearn'],outputs['native']):
+            assert list(a.columns) == list(b.columns) == ['region1','region3','region7']
+            np.testing.assert_allclose(a.values,b.values,atol=1e-5)
+
+        #regressors read ahead, and cut by discard_scans as nixtract does
+        confs = []
+        for i in range(2):
+            confs.append(str(tmpdir / "{}.tsv".format(i)))
+            pd.DataFrame(np.random.rand(20,2),columns=['a','b']).to_csv(confs[-1],sep='\t',index=False)
+        with open(tmpdir / "config_conf.json","w") as f:
+            json.dump({'input_files':files,'regressor_files':confs,'regressors':['a','b'],'roi_file':str(tmpdir / "atlas.nii.gz"),
+                       'mask_img':str(tmpdir / "mask.nii.gz"),'discard_scans':2},f)
+        out = str(tmpdir / "conf")
+        os.makedirs(out)
+        assert extract.run_in_process(str(tmpdir / "config_conf.json"),out,backend='native',prefetch=1)[0] == 0
+        idx = labels.make_index(labels_data,mask)
+        for f,conf in zip(files,confs):
+            signals = labels.get_signals(nib.load(f).dataobj,idx,start=2)
+            expected = labels.regress_confounds(signals,pd.read_table(conf).values[2:])
+            np.testing.assert_allclose(pd.read_table(index.get_output(f,out)).values,expected,atol=1e-5)
+
+    def test_worker_staged_outputs(self,tmpdir,monkeypatch):
+        pytest.importorskip('nixtract.cli.nifti')
+        labels = np.zeros((4,4,4),dtype=np.int16)
+        labels[2:] = 1
+        make_nifti(tmpdir / "atlas.nii.gz",labels)
+        files = []
+        for i in range(3):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),np.random.rand(4,4,4,5).astype(np.float32))
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        os.makedirs(tmpdir / "out/logs")
+        os.makedirs(tmpdir / "scratch")
+        batches,batches_conf = ns.get_batches(2,files,[])
+        ns.make_config(batches,batches_conf,{'roi_file':str(tmpdir / "atlas.nii.gz")},str(tmpdir / "out/logs"))
+
+        monkeypatch.setattr('sys.argv',['nixtract-slurm-worker','-c',str(tmpdir / "out/logs/params.json"),'--batch','1',
+                                        str(tmpdir / "out"),'--shard_outputs','--scratch',str(tmpdir / "scratch")])
+        with pytest.raises(SystemExit) as e:
+            worker.main()
+        assert e.value.code == 0
+        #outputs moved to their shards and recorded, scratch cleaned up
+        assert sorted(index.list_outputs(str(tmpdir / "out"))) == sorted([index.get_output(f,str(tmpdir / "out"),sharded=True) for f in batches[1]])
+        assert sorted(index.compact_index(str(tmpdir / "out"))) == sorted([os.path.basename(f) for f in batches[1]])
+        assert os.listdir(tmpdir / "scratch") == []
+        rows = telemetry.load_telemetry(str(tmpdir / "out"))
+        assert sorted([r['file'] for r in rows]) == sorted(batches[1])
+        assert set(rows[0]['stages']) == set(['setup','extract','write']) and rows[0]['batch'] == 1
+
+    def test_worker_staged_inputs(self,tmpdir,monkeypatch):
+        pytest.importorskip('nixtract.cli.nifti')
+        labels = np.zeros((4,4,4),dtype=np.int16)
+        labels[2:] = 1
+        make_nifti(tmpdir / "atlas.nii.gz",labels)
+        files,confs = [],[]
+        for i in range(3):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),np.random.rand(4,4,4,5).astype(np.float32))
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+            confs.append(str(tmpdir / "{}.tsv".format(i)))
+            pd.DataFrame(np.random.rand(5,2),columns=['a','b']).to_csv(confs[-1],sep='\t',index=False)
+        #a missing regressor file fails alone
+        os.remove(confs[1])
+        os.makedirs(tmpdir / "out/logs")
+        os.makedirs(tmpdir / "scratch")
+        ns.make_config([files],[confs],{'roi_file':str(tmpdir / "atlas.nii.gz"),'regressors':['a','b']},str(tmpdir / "out/logs"))
+
+        monkeypatch.setattr('sys.argv',['nixtract-slurm-worker','-c',str(tmpdir / "out/logs/params.json"),'--batch','0',
+                                        str(tmpdir / "out"),'--scratch',str(tmpdir / "scratch"),'--stage_inputs',
+                                        '--backend','native'])
+        with pytest.raises(SystemExit) as e:
+            worker.main()
+        assert e.value.code == 1
+        done = [files[0],files[2]]
+        assert sorted(index.list_outputs(str(tmpdir / "out"))) == sorted([index.get_output(f,str(tmpdir / "out")) for f in done])
+        assert sorted(index.compact_index(str(tmpdir / "out"))) == sorted([os.path.basename(f) for f in done])
+        assert os.listdir(tmpdir / "scratch") == []
+        #telemetry and history refer to the original files
+        assert sorted([r['file'] for r in telemetry.load_telemetry(str(tmpdir / "out"))]) == files
+        assert sorted([r['file'] for r in cost.load_history(str(tmpdir / "out/logs/history"))]) == done
+
+    def test_prepare_atlas_cache(self,tmpdir):
+        labels = np.zeros((8,8,8),dtype=np.int16)
+        labels[:4] = 1
+        labels[4:] = 2
+        make_nifti(tmpdir / "atlas.nii.gz",labels)
+        files = []
+        for i,affine in enumerate([np.eye(4),np.eye(4),np.diag([2,2,2,1])]):
+            nib.save(nib.Nifti1Image(np.zeros((4,4,4,3),dtype=np.float32),affine),str(tmpdir / "{}.nii.gz".format(i)))
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        params = {'roi_file':str(tmpdir / "atlas.nii.gz"),'mask_img':None}
+
+        assert atlas.prepare_atlas_cache(files,params,str(tmpdir)) == 2
+        assert atlas.prepare_atlas_cache(files,params,str(tmpdir)) == 0
+        img = atlas.load_resampled(str(tmpdir),params['roi_file'],nib.load(files[2]))
+        data = np.asarray(img.dataobj)
+        assert data.shape == (4,4,4)
+        assert not data.flags.writeable
+        assert (data[:2] == 1).all() and (data[2:] == 2).all()
+        assert atlas.load_resampled(str(tmpdir),'atlas.tsv',nib.load(files[2])) is None
+
+        #a modified atlas is resampled again
+        os.utime(params['roi_file'],ns=(0,0))
+        assert atlas.load_resampled(str(tmpdir),params['roi_file'],nib.load(files[2])) is None
+        assert atlas.prepare_atlas_cache(files,params,str(tmpdir)) == 2
+
+    def test_work_queue(self,tmpdir):
+        files = []
+        for i,size in enumerate([10,30,20]):
+            with open(tmpdir / "{}.nii.gz".format(i),"w") as f:
+                f.write("x"*size)
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        order = workqueue.get_order(files)
+        assert order == [1,2,0]
+        workqueue.make_queue(files,['{}.tsv'.format(i) for i in range(3)],str(tmpdir),order)
+
+        #two jobs pulling from the queue get each file exactly once, heaviest first
+        claims_a,claims_b = {},{}
+        a = workqueue.iter_claims(str(tmpdir),'a',claims_a)
+        b = workqueue.iter_claims(str(tmpdir),'b',claims_b)
+        assert next(a) == (files[1],'1.tsv')
+        assert next(b) == (files[2],'2.tsv')
+        assert list(a) == [(files[0],'0.tsv')]
+        assert list(b) == []
+        assert sorted(list(claims_a)) == [files[0],files[1]]
+
+        todo,claimed,failed = workqueue.get_queue_dirs(str(tmpdir))
+        workqueue.release(claims_a[files[1]])
+        workqueue.release(claims_b[files[2]],failed=True)
+        assert os.listdir(todo) == []
+        assert os.listdir(claimed) == [os.path.basename(claims_a[files[0]])]
+        assert os.listdir(failed) == [os.path.basename(claims_b[files[2]])]
+
+        #claiming stops when asked
+        workqueue.make_queue(files,[],str(tmpdir))
+        assert list(workqueue.iter_claims(str(tmpdir),'c',{},stop=lambda: True)) == []
+        assert len(os.listdir(todo)) == 3
+
+    def test_make_sh_queue(self,tmpdir):
+        os.mkdir(tmpdir / "logs")
+        ns.make_sh('ACCOUNT','1:00:00','MEM',10,tmpdir,queue=True)
+        with open(tmpdir / 'logs/submit.sh', 'r') as f:
+            lines = f.readlines()
+        assert lines[-1] == "nixtract-slurm-worker --queue --time_limit 3600 -c {}/logs/params.json --batch ${{BATCH}} {}\n".format(tmpdir,tmpdir)
+
+    def test_make_sh_staged(self,tmpdir):
+        os.mkdir(tmpdir / "logs")
+        ns.make_sh('ACCOUNT','1:00:00','MEM',10,tmpdir,shard=True,stage_outputs=True)
+        with open(tmpdir / 'logs/submit.sh', 'r') as f:
+            lines = f.readlines()
+        assert lines[-1].startswith("nixtract-slurm-worker --shard_outputs --scratch ${SLURM_TMPDIR:-/tmp} -c ")
+        ns.make_sh('ACCOUNT','1:00:00','MEM',10,tmpdir,backend='native')
+        with open(tmpdir / 'logs/submit.sh', 'r') as f:
+            lines = f.readlines()
+        assert lines[-1].startswith("nixtract-slurm-worker --backend native -c ")
+        ns.make_sh('ACCOUNT','1:00:00','MEM',10,tmpdir,prefetch=2)
+        with open(tmpdir / 'logs/submit.sh', 'r') as f:
+            lines = f.readlines()
+        assert lines[-1].startswith("nixtract-slurm-worker --prefetch 2 -c ")
+        ns.make_sh('ACCOUNT','1:00:00','MEM',10,tmpdir,stage_inputs=3*2**20)
+        with open(tmpdir / 'logs/submit.sh', 'r') as f:
+            lines = f.readlines()
+        assert "#SBATCH --tmp=3M\n" in lines
+        assert lines[-1].startswith("nixtract-slurm-worker --scratch ${SLURM_TMPDIR:-/tmp} --stage_inputs -c ")
+
+    def test_sharded_outputs(self,tmpdir):
+        params = {'input_files':[],'regressor_files':[],'roi_file':'atlas.nii.gz','discard_scans':None}
+        inputs = []
+        for name in ['a','b']:
+            make_nifti(tmpdir / "{}.nii.gz".format(name),(2,2,2,3))
+            inputs.append(str(tmpdir / "{}.nii.gz".format(name)))
+        out = index.get_output(inputs[0],str(tmpdir),sharded=True)
+        assert out == os.path.join(str(tmpdir),index.SHARD_DIR,index.get_shard('a.nii.gz'),'a_timeseries.tsv')
+        with open(tmpdir / "a_timeseries.tsv","w") as f:
+            f.write("region1\n1\n2\n3\n")
+        index.move_outputs([(str(tmpdir / "a_timeseries.tsv"),out)])
+        with open(tmpdir / "b_timeseries.tsv","w") as f:
+            f.write("region1\n1\n2\n3\n")
+        assert sorted(index.list_outputs(str(tmpdir))) == sorted([out,str(tmpdir / "b_timeseries.tsv")])
+        assert index.find_output(inputs[0],str(tmpdir)) == out
+        assert index.find_output(inputs[1],str(tmpdir)) == str(tmpdir / "b_timeseries.tsv")
+
+        #completion is found in both layouts
+        assert sorted(ns.get_completed(str(tmpdir))) == ['a.nii.gz','b.nii.gz']
+        assert ns.get_todo(inputs,[],str(tmpdir),params,verify=True)[0] == []
+        os.remove(out)
+        assert ns.get_todo(inputs,[],str(tmpdir),params,verify=True)[0] == [inputs[0]]
+
+    def test_benchmark_planning(self,tmpdir):
+        from tests import benchmark
+        benchmark.make_atlas(str(tmpdir / "atlas.nii.gz"),(4,4,4),3)
+        assert sorted(np.unique(nib.load(str(tmpdir / "atlas.nii.gz")).get_fdata())) == [1,2,3]
+        benchmark.make_input(str(tmpdir / "template.nii.gz"),(4,4,4),5)
+        sbatch = benchmark.make_fake_sbatch(str(tmpdir))
+        r = benchmark.bench_planning(str(tmpdir / "run"),25,str(tmpdir / "template.nii.gz"),str(tmpdir / "atlas.nii.gz"),sbatch)
+        assert r['n_files'] == 25 and r['n_jobs'] >= 1
+        assert list(r['steps'])[0] == 'read_config' and 'submit_jobs' in r['steps']
+        assert not os.path.exists(tmpdir / "run/data")
+
+    def test_telemetry_report(self,tmpdir):
+        assert telemetry.get_io() is None or min(telemetry.get_io()) >= 0
+        rows = []
+        for i in range(10):
+            stats = {'stages':{'setup':0.1,'extract':0.8,'write':0.1},'bytes_read':100,'bytes_written':10}
+            rows.append(telemetry.make_row('{}.nii.gz'.format(i),10. if i == 9 else 1.,2**20,False,stats,batch=0))
+        rows.append(telemetry.make_row('10.nii.gz',0.5,2**20,True))
+        os.makedirs(tmpdir / telemetry.TELEMETRY_DIR)
+        telemetry.record_telemetry(str(tmpdir / telemetry.TELEMETRY_DIR / "1_0.jsonl"),rows)
+
+        summary = telemetry.summarize(telemetry.load_telemetry(str(tmpdir)))
+        assert summary['n_files'] == 10 and summary['n_failed'] == 1
+        assert summary['n_stragglers'] == 1 and summary['stragglers'][0]['file'] == '9.nii.gz'
+        assert abs(summary['stages']['extract'] - 0.8*10/19) < 1e-9
+        assert summary['bytes_read'] == 1000
+        assert len(summary['jobs']) == 1 and summary['jobs'][0]['n_files'] == 10
+
+        result = subprocess.run('nixtract-slurm report {}'.format(tmpdir),shell=True,stdout=PIPE,universal_newlines=True,check=True)
+        assert result.stdout.startswith('10 file(s) done, 1 failed.')
+        assert '9.nii.gz' in result.stdout
+
+    def test_format_time(self):
+        assert cost.format_time(1270) == '0:21:10'
+        assert cost.format_time(90061) == '1-01:01:01'
+        assert cost.parse_time('1-01:01:01') == 90061
+        assert cost.parse_time('21:10') == 1270
+
+    def test_classify_failures(self):
+        states = supervisor.parse_sacct("123_0|COMPLETED\n123_1|TIMEOUT\n123_2|OUT_OF_MEMORY\n123_3|CANCELLED by 42\n124_[0-5%2]|PENDING\n")
+        assert states['123_3'] == 'CANCELLED'
+        assert not supervisor.is_finished(states)
+        del states['124_[0-5%2]']
+        assert supervisor.is_finished(states)
+        failures = supervisor.classify(states)
+        assert failures == {'time':1,'mem':1,'error':1}
+        assert supervisor.escalate('1:00:00','1000M',failures) == ('2:00:00','2000M')
+        assert supervisor.escalate('1:00:00','1000M',{'node':1}) == ('1:00:00','1000M')
+
+    def test_supervise(self,tmpdir):
+        #stub sacct printing the states written by the test
+        states = tmpdir / "states.txt"
+        sacct = tmpdir / "sacct"
+        with open(sacct,"w") as f:
+            f.write("#!/bin/sh\ncat {}\n".format(states))
+        os.chmod(sacct,0o755)
+        with open(states,"w") as f:
+            f.write("1_0|COMPLETED\n1_1|TIMEOUT\n")
+
+        left = [5]
+        submitted = []
+        def submit(runtime,mem,files_per_job):
+            submitted.append((runtime,mem,files_per_job))
+            with open(states,"w") as f:
+                f.write("2_0|COMPLETED\n")
+            left[0] = 0
+            return {'job_ids':['2'],'runtime':runtime,'mem':mem,'n_jobs':1,'n_files':5}
+
+        job = {'job_ids':['1'],'runtime':'1:00:00','mem':'1G','n_jobs':2,'n_files':10}
+        assert supervisor.supervise(submit,lambda: left[0],job,poll_interval=0,command=str(sacct))
+        assert submitted == [('2:00:00','1G',5)]
+
+        #gives up after max_retries
+        left[0] = 5
+        assert not supervisor.supervise(submit,lambda: 5,job,max_retries=1,poll_interval=0,command=str(sacct))
+
+    def test_submit_jobs(self,tmpdir):
+        sbatch = tmpdir / "sbatch"
+        with open(sbatch,"w") as f:
+            f.write("#!/bin/sh\necho \"$@\" >> {}\necho '42;cluster'\n".format(tmpdir / "calls.txt"))
+        os.chmod(sbatch,0o755)
+        os.mkdir(tmpdir / "logs")
+        job_ids = ns.submit_jobs(str(tmpdir),ns.plan_submissions(1500,max_array_size=1000),command=str(sbatch))
+        assert job_ids == ['42','42']
+        with open(tmpdir / "calls.txt") as f:
+            calls = f.readlines()
+        assert calls[1].startswith('--parsable --array=0-499 --export=ALL,NSLURM_OFFSET=1000 ')
+
+        os.remove(tmpdir / "calls.txt")
+        ns.submit_jobs(str(tmpdir),ns.plan_submissions(3000,max_array_size=1000,max_concurrent=2),command=str(sbatch),dependency='afterany:7')
+        with open(tmpdir / "calls.txt") as f:
+            calls = f.readlines()
+        assert calls[1].startswith('--dependency=afterany:7 --parsable --array=0-999%1 ')
+        assert calls[2].startswith('--dependency=afterany:7,afterany:42 --parsable --array=0-999%1 --export=ALL,NSLURM_OFFSET=2000 ')
+
+    def test_stages(self,tmpdir):
+        labels = np.zeros((4,4,4),dtype=np.int16)
+        labels[2:] = 1
+        make_nifti(tmpdir / "atlas.nii.gz",labels)
+        make_nifti(tmpdir / "0.nii.gz",(4,4,4,3))
+        params = {'roi_file':str(tmpdir / "atlas.nii.gz")}
+        missing = atlas.get_missing([str(tmpdir / "0.nii.gz")],params,str(tmpdir))
+        stages.save_prep(missing,str(tmpdir))
+        assert stages.run_prep(str(tmpdir)) == 1
+        assert atlas.get_missing([str(tmpdir / "0.nii.gz")],params,str(tmpdir)) == []
+        assert stages.run_prep(str(tmpdir)) == 0
+
+        for i in range(3):
+            open(tmpdir / "logs/config_{}.json".format(i),"w").close()
+        os.makedirs(index.get_index_dir(str(tmpdir)))
+        index.record_completed(os.path.join(index.get_index_dir(str(tmpdir)),'1_0.txt'),[{'name':'0.nii.gz'}])
+        assert stages.run_cleanup(str(tmpdir)) == 1
+        assert [f for f in os.listdir(tmpdir / "logs") if f.startswith('config')] == []
+        assert sorted(os.listdir(index.get_index_dir(str(tmpdir)))) == [index.LOCK_FILE,index.INDEX_FILE]
+
+    def test_read_headers(self,tmpdir,monkeypatch):
+        labels = np.zeros((4,4,4),dtype=np.int16)
+        labels[2:] = 1
+        make_nifti(tmpdir / "atlas.nii.gz",labels)
+        files = []
+        for i,affine in enumerate([np.eye(4),np.eye(4),np.diag([2,2,2,1])]):
+            nib.save(nib.Nifti1Image(np.zeros((4,4,4,3+i),dtype=np.float32),affine),str(tmpdir / "{}.nii.gz".format(i)))
+            files.append(str(tmpdir / "{}.nii.gz".format(i)))
+        headers = cost.read_headers(files)
+        assert headers[files[2]][0] == (4,4,4,5)
+        assert headers[files[0]][1] is headers[files[1]][1]
+        params = {'roi_file':str(tmpdir / "atlas.nii.gz")}
+        costs = cost.estimate_costs(files,None)
+        missing = atlas.get_missing(files,params,str(tmpdir))
+        #no input header is read again
+        loaded = []
+        load = nib.load
+        monkeypatch.setattr(nib,'load',lambda f,*a,**k: loaded.append(f) or load(f,*a,**k))
+        assert cost.estimate_costs(files,None,headers=headers) == costs
+        assert atlas.get_missing(files,params,str(tmpdir),headers) == missing
+        assert [f for f in loaded if f in files] == []
+
+    def test_submit_stage_quoting(self,tmpdir):
+        #fake sbatch running the --wrap command as SLURM would
+        sbatch = tmpdir / "sbatch"
+        with open(sbatch,"w") as f:
+            f.write("#!/bin/sh\nfor a in \"$@\"; do case \"$a\" in --wrap=*) echo \"${a#--wrap=}\" > " + str(tmpdir / "wrap.sh") + ";; esac; done\necho 5\n")
+        os.chmod(sbatch,0o755)
+        out = str(tmpdir / "out $(touch injected); dir")
+        assert stages.submit_stage(out,'ACCOUNT','cleanup','0:15:00','1G',command=str(sbatch),options=['--store']) == '5'
+        with open(tmpdir / "wrap.sh") as f:
+            wrap = f.read().strip()
+        assert shlex.split(wrap) == ['nixtract-slurm-stage','cleanup',out,'--store']
+        assert not os.path.exists(tmpdir / "injected") and not os.path.exists("injected")
+
+    def test_check_record_stored(self,tmpdir):
+        make_nifti(tmpdir / "a.nii.gz",(2,2,2,3))
+        with open(tmpdir / "a_timeseries.tsv","w") as f:
+            f.write("region1\n1\n2\n3\n")
+        record = index.make_record(str(tmpdir / "a.nii.gz"),str(tmpdir / "a_timeseries.tsv"),'hash')
+        os.remove(tmpdir / "a_timeseries.tsv")
+        assert not index.check_record(record,str(tmpdir / "a.nii.gz"),str(tmpdir / "a_timeseries.tsv"))
+        #output in the store: only the input is checked
+        assert index.check_record(record,str(tmpdir / "a.nii.gz"),None)
+        assert index.check_record({'name':'a.nii.gz'},str(tmpdir / "a.nii.gz"),None)
+        make_nifti(tmpdir / "a.nii.gz",(2,2,2,4))
+        assert not index.check_record(record,str(tmpdir / "a.nii.gz"),None)
+
+    def test_store(self,tmpdir):
+        pytest.importorskip('h5py')
+        dfs = {}
+        for i in range(3):
+            dfs[i] = pd.DataFrame(np.random.rand(5,3),columns=['region1','region2','region3'])
+            dfs[i].to_csv(tmpdir / "{}_timeseries.tsv".format(i),sep='\t',index=False)
+        #only completed files are stored
+        assert store.aggregate(str(tmpdir),completed=['0.nii.gz','1.nii.gz']) == 2
+        assert sorted(os.listdir(tmpdir)) == ['2_timeseries.tsv',store.STORE_FILE]
+        assert sorted(store.list_stored(store.get_store_path(str(tmpdir)))) == ['0','1']
+        df = store.read_timeseries(store.get_store_path(str(tmpdir)),'1.nii.gz')
+        assert list(df.columns) == ['region1','region2','region3']
+        assert np.allclose(df.to_numpy(),dfs[1].to_numpy())
+
+        #stored outputs count as completed when seeding the index
+        assert sorted(ns.get_completed(str(tmpdir))) == ['0.nii.gz','1.nii.gz','2.nii.gz']
+
+        #a copy left by a killed round is discarded, the store is replaced with the earlier subjects kept
+        with open(store.get_store_path(str(tmpdir)) + store.TMP_SUFFIX,"w") as f:
+            f.write("partial")
+        assert store.aggregate(str(tmpdir)) == 1
+        assert index.list_outputs(str(tmpdir)) == [] and not os.path.exists(store.get_store_path(str(tmpdir)) + store.TMP_SUFFIX)
+        assert sorted(store.list_stored(store.get_store_path(str(tmpdir)))) == ['0','1','2']
+
+    def test_cleanup_resources(self):
+        runtime,mem = stages.get_cleanup_resources(0)
+        assert runtime == '0:15:00' and mem == '1024M'
+        assert cost.parse_time(stages.get_cleanup_resources(100000)[0]) > cost.parse_time(runtime)
+        assert cost.parse_time(stages.get_cleanup_resources(100000,aggregate=True)[0]) > cost.parse_time(stages.get_cleanup_resources(100000)[0])
+        assert cost.parse_mem(stages.get_cleanup_resources(100000)[1]) > cost.parse_mem(mem)
+
+    def test_prep_resources(self,tmpdir):
+        make_nifti(tmpdir / "labels.nii.gz",(4,4,4))
+        make_nifti(tmpdir / "maps.nii.gz",(4,4,4,50))
+        grids = [atlas.get_grid((100,100,100),np.eye(4)),atlas.get_grid((50,50,50),np.eye(4))]
+        runtime,mem = stages.get_prep_resources([(str(tmpdir / "labels.nii.gz"),grids[0],None)])
+        assert runtime == '0:10:01' and cost.parse_mem(mem) >= stages.PREP_MEM
+        #a probabilistic atlas resamples every map
+        runtime4d,mem4d = stages.get_prep_resources([(str(tmpdir / "maps.nii.gz"),grids[0],None)])
+        assert cost.parse_mem(mem4d) > cost.parse_mem(mem) + 50*10**6*stages.PREP_BYTES_PER_VALUE*0.9
+        assert cost.parse_time(runtime4d) > cost.parse_time(runtime)
+        #grids are resampled one at a time: more time, not more memory
+        runtime2,mem2 = stages.get_prep_resources([(str(tmpdir / "maps.nii.gz"),g,None) for g in grids])
+        assert cost.parse_time(runtime2) > cost.parse_time(runtime4d) and mem2 == mem4d
+
+    def test_submit_chain(self,tmpdir):
+        #fake sbatch recording its arguments, on the PATH of nixtract-slurm
+        os.mkdir(tmpdir / "bin")
+        with open(tmpdir / "bin/sbatch","w") as f:
+            f.write("#!/bin/sh\necho \"$@\" >> {}\nwc -l < {}\n".format(tmpdir / "calls.txt",tmpdir / "calls.txt"))
+        os.chmod(tmpdir / "bin/sbatch",0o755)
+        labels = np.zeros((4,4,4),dtype=np.int16)
+        labels[2:] = 1
+        make_nifti(tmpdir / "atlas.nii.gz",labels)
+        for i in range(3):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),(4,4,4,3))
+        with open(tmpdir / "config.json","w") as f:
+            json.dump({'input_files':str(tmpdir / "*.nii.gz").replace('*','[0-9]'),'regressor_files':[],'roi_file':str(tmpdir / "atlas.nii.gz")},f)
+        os.mkdir(tmpdir / "out")
+
+        command = 'nixtract-slurm --out_path {} --config_path {} --account ACCOUNT'.format(tmpdir / "out",tmpdir / "config.json")
+        env = dict(os.environ,PATH='{}:{}'.format(tmpdir / "bin",os.environ['PATH']))
+        subprocess.run(command,shell=True,env=env,stdout=PIPE,check=True)
+        with open(tmpdir / "calls.txt") as f:
+            calls = f.readlines()
+        assert len(calls) == 3
+        assert '--job-name=nixtract-slurm-prep' in calls[0]
+        assert calls[1].startswith('--dependency=afterany:1 --parsable ')
+        assert '--dependency=afterany:2 ' in calls[2] and 'nixtract-slurm-stage cleanup' in calls[2]
+        with open(tmpdir / "out/logs/submit.sh") as f:
+            assert 'rm ' not in f.read()
+
+        #with --max_jobs, the prep and cleanup jobs leave room for one extraction job
+        os.remove(tmpdir / "calls.txt")
+        subprocess.run(command + ' --rerun_completed --n_jobs 3 --max_jobs 3',shell=True,env=env,stdout=PIPE,check=True)
+        with open(tmpdir / "calls.txt") as f:
+            assert len(f.readlines()) == 3
+        with open(tmpdir / "out/logs/submit.sh") as f:
+            assert '#SBATCH --array=0-0\n' in f.read()
+        with pytest.raises(subprocess.CalledProcessError):
+            subprocess.run(command + ' --rerun_completed --max_jobs 2',shell=True,env=env,stdout=PIPE,stderr=PIPE,check=True)
+
+    def test_dry_run(self,tmpdir):
+        os.mkdir(tmpdir / "bin")
+        with open(tmpdir / "bin/sbatch","w") as f:
+            f.write("#!/bin/sh\necho \"$@\" >> {}\necho 1\n".format(tmpdir / "calls.txt"))
+        os.chmod(tmpdir / "bin/sbatch",0o755)
+        for i in range(6):
+            make_nifti(tmpdir / "{}.nii.gz".format(i),(4,4,4,3))
+        with open(tmpdir / "config.json","w") as f:
+            json.dump({'input_files':str(tmpdir / "*.nii.gz"),'regressor_files':[]},f)
+        os.mkdir(tmpdir / "out")
+
+        command = 'nixtract-slurm --out_path {} --config_path {} --account ACCOUNT --n_jobs 2 --dry-run'.format(tmpdir / "out",tmpdir / "config.json")
+        env = dict(os.environ,PATH='{}:{}'.format(tmpdir / "bin",os.environ['PATH']))
+        stdout = subprocess.run(command,shell=True,env=env,stdout=PIPE,universal_newlines=True,check=True).stdout
+        assert 'Plan for 6 file(s) in 2 job(s)' in stdout
+        assert not os.path.exists(tmpdir / "calls.txt")
+        assert not os.path.exists(tmpdir / "out/logs/submit.sh")
+
+    def test_get_plan(self):
+        assert cost.get_makespan([10,10,10,10]) == 10
+        assert cost.get_makespan([10,10,10,10],slots=2) == 20
+        assert cost.get_makespan([30,10,10,10],slots=2) == 30
+        costs = {'a':(10,0),'b':(20,0),'c':(30,0)}
+        plan = ns.get_plan([['a','b'],['c']],costs,'0:01:00','1G',cpus=2)
+        assert plan['seconds'] == [20,30]
+        assert plan['largest'] == {'batch':1,'n_files':1,'seconds':30}
+        assert plan['makespan'] == 30
+        assert abs(plan['core_hours'] - 100/3600.) < 1e-9
+        assert abs(plan['requested_core_hours'] - 2*2*60/3600.) < 1e-9
+        assert plan['over_time'] == 0
+
+    def test_make_sh_throttle(self,tmpdir):
+        os.mkdir(tmpdir / "logs")
+        ns.make_sh('ACCOUNT','TIME','MEM',10,tmpdir,throttle=4)
+        with open(tmpdir / 'logs/submit.sh', 'r') as f:
+            lines = f.readlines()
+        assert lines[5] == "#SBATCH --array=0-9%4\n"
+
+    def test_plan_submissions(self):
+        assert ns.plan_submissions(10) == [{'offset':0,'size':10,'throttle':None,'after':None}]
+        submissions = ns.plan_submissions(2500,max_array_size=1000,max_concurrent=100)
+        assert [s['offset'] for s in submissions] == [0,1000,2000]
+        assert [s['size'] for s in submissions] == [1000,1000,500]
+        assert sum([s['throttle'] for s in submissions]) == 100
+        assert [s['after'] for s in submissions] == [None,None,None]
+        #more arrays than max_concurrent: the others wait for a slot, so at most max_concurrent tasks run
+        submissions = ns.plan_submissions(5000,max_array_size=1000,max_concurrent=2)
+        assert [s['throttle'] for s in submissions] == [1,1,1,1,1]
+        assert [s['after'] for s in submissions] == [None,None,0,1,2]
+        submissions = ns.plan_submissions(3000,max_array_size=1000,max_concurrent=5)
+        assert [s['throttle'] for s in submissions] == [2,2,1]
     
     def test_invalid_out_path(self,tmpdir):
         out = os.path.join(tmpdir,'doesnt_exist')
@@ -204,6 +1316,20 @@ class TestInternal:
 #    datasets.fetch_atlas_talairach('hemisphere', data_dir=atlas_dir)
 #    return os.path.join(atlas_dir,'talairach_atlas/talairach.nii')
 
+def make_nifti(path,data):
+    if isinstance(data,tuple):
+        data = np.zeros(data,dtype=np.float32)
+    nib.save(nib.Nifti1Image(data,np.eye(4)),str(path))
+
+def record_and_compact(out_path,job,n):
+    for i in range(n):
+        shard = os.path.join(index.get_index_dir(out_path),'{}_{}.txt'.format(job,i))
+        index.record_completed(shard,[{'name':'{}_{}.nii.gz'.format(job,i)}])
+        index.compact_index(out_path)
+
+def make_img(data):
+    return nib.Nifti1Image(data,np.eye(4))
+
 def make_test_config(batches,batches_conf,out_path):
     params = {
             "input_files": [],
@@ -224,7 +1350,10 @@ def make_test_config(batches,batches_conf,out_path):
             "discard_scans": None,
             "n_jobs": 1
             }
-    ns.make_config(batches,batches_conf,params,out_path)
+    for i in range(len(batches)):
+        p = dict(params,input_files=batches[i],regressor_files=batches_conf[i])
+        with open(os.path.join(out_path,'config_{}.json'.format(i)),'w') as f:
+            json.dump(p,f)
 
 def get_test_data():
     data_base = '/home/harveyaa/nixtract-slurm_aux/development_fmri/development_fmri'